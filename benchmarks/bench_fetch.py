@@ -0,0 +1,87 @@
+# compares how much gets downloaded from gmail, and how long it takes,
+# fetching whole raw messages against fetching in two phases (metadata
+# first, then the text of the messages triage keeps), and with the query
+# narrowed by hit_history.json.
+#
+# it talks to gmail unless REPLAY is set (see replay.py), so record once
+# with REPLAY=record and compare changes offline with REPLAY=replay.
+#
+# run from the root of the repo:
+#   python -m benchmarks.bench_fetch [--query "your flight itinerary"] [--pages 5]
+
+import argparse
+import time
+
+import metrics
+import replay
+from gmail import GmailSearcher
+from triage import HitHistory, MetadataTriage
+
+MODES = ("raw", "two-phase", "learned-query")
+
+
+def run_mode(mode, query, pages, page_size, history):
+    """Fetch `pages` pages of a search without a store, so everything is downloaded.
+
+    Returns:
+        Dict with the messages listed and kept, the bytes downloaded and
+        the wall-clock seconds.
+    """
+    searcher = GmailSearcher()
+    searcher.use_batch_requests = True
+    # pulls out the same text as two-phase mode does
+    searcher.use_streaming_parser = True
+    replay.install(searcher)
+    if mode != "raw":
+        searcher.two_phase = True
+        searcher.triage = MetadataTriage(history)
+    if mode == "learned-query":
+        # always narrowed, to compare with the other modes
+        query = history.query(query, explore_every=0)
+
+    metrics.registry.reset()
+    kept = 0
+    next_token = None
+    start = time.perf_counter()
+    for _ in range(pages):
+        page = searcher.search_messages(query, max_results=page_size, next_token=next_token)
+        kept += len(page["messages"])
+        next_token = page["next_token"]
+        if not next_token:
+            break
+    seconds = time.perf_counter() - start
+    stats = metrics.registry.to_dict()
+    return {
+        "query": query,
+        "listed": stats.get("gmail_listed_messages_total", {}).get("value", 0),
+        "kept": kept,
+        "bytes": stats.get("gmail_downloaded_bytes_total", {}).get("value", 0),
+        "seconds": seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--query", default="your flight itinerary")
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--history", default="hit_history.json", help="what generate.py learned about past hits")
+    parser.add_argument("--mode", choices=MODES, action="append", help="only run these modes")
+    args = parser.parse_args()
+
+    history = HitHistory(args.history)
+    print(f"{'mode':<14} {'listed':>7} {'kept':>6} {'MB':>8} {'seconds':>8} {'KB/1000 msgs':>13} {'s/1000 msgs':>12}")
+    for mode in args.mode or MODES:
+        result = run_mode(mode, args.query, args.pages, args.page_size, history)
+        listed = max(result["listed"], 1)
+        print(
+            f"{mode:<14} {result['listed']:>7} {result['kept']:>6} {result['bytes'] / 1e6:>8.2f}"
+            f" {result['seconds']:>8.2f} {result['bytes'] * 1000 / listed / 1e3:>13.1f}"
+            f" {result['seconds'] * 1000 / listed:>12.2f}"
+        )
+        if result["query"] != args.query:
+            print(f"  query: {result['query']}")
+
+
+if __name__ == "__main__":
+    main()
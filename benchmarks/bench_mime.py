@@ -0,0 +1,128 @@
+# compares the three ways GmailSearcher can turn a raw message into text
+# on a corpus of synthetic .eml files: plain text, HTML itineraries, and
+# messages with big PDF attachments.
+#
+# run from the root of the repo:
+#   python -m benchmarks.bench_mime [--count 50] [--corpus some/dir]
+
+import argparse
+import base64
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from email.message import EmailMessage
+
+from gmail import GmailSearcher
+
+ITINERARY_HTML = """<html><head><style>td {{ font-family: Arial; }}</style></head>
+<body><table>
+<tr><td>Confirmation code</td><td><b>{code}</b></td></tr>
+<tr><td>06:00 AM</td><td>{origin}</td><td>&rarr;</td><td>02:49 PM</td><td>{destination}</td></tr>
+</table>{filler}</body></html>"""
+
+
+def make_corpus(directory, count):
+    rng = random.Random(1234)
+    airports = ["SFO", "JFK", "OAK", "SEA", "HNL", "BOS", "LAX", "PDX"]
+    paths = []
+    for i in range(count):
+        origin, destination = rng.sample(airports, 2)
+        filler = "<p>Thanks for flying with us, we hope you enjoy your trip.</p>" * rng.randint(10, 500)
+        html = ITINERARY_HTML.format(
+            code="".join(rng.choices("ABCDEFGHJKLMNPQRSTUVWXYZ", k=6)),
+            origin=origin,
+            destination=destination,
+            filler=filler,
+        )
+        msg = EmailMessage()
+        msg["From"] = "itinerary@example-airline.com"
+        msg["To"] = "traveler@example.com"
+        msg["Subject"] = f"Your flight itinerary {i}"
+        kind = i % 3
+        if kind == 0:
+            msg.set_content(f"Your flight from {origin} to {destination} is confirmed.\n" * 20)
+        else:
+            msg.set_content(html, subtype="html", cte="quoted-printable")
+        if kind == 2:
+            # a boarding pass or receipt, a few MB of incompressible PDF
+            msg.add_attachment(
+                b"%PDF-1.4\n" + rng.randbytes(rng.randint(500_000, 3_000_000)),
+                maintype="application",
+                subtype="pdf",
+                filename="receipt.pdf",
+            )
+        path = os.path.join(directory, f"{i:05d}.eml")
+        with open(path, "wb") as f:
+            f.write(msg.as_bytes())
+        paths.append(path)
+    return paths
+
+
+def load_corpus(paths):
+    # shaped like a format="raw" response from messages.get
+    messages = []
+    for path in paths:
+        with open(path, "rb") as f:
+            raw = f.read()
+        messages.append({"raw": base64.urlsafe_b64encode(raw).decode("ascii")})
+    return messages
+
+
+def run(name, extract, messages, measure_memory):
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    total_chars = 0
+    for message in messages:
+        total_chars += len(extract(message))
+    elapsed = time.perf_counter() - start
+    peak = None
+    if measure_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    print(
+        f"{name:<12} {len(messages) / elapsed:>10.1f} msg/s"
+        f" {1000 * elapsed / len(messages):>9.2f} ms/msg"
+        f" {total_chars / len(messages):>12.0f} chars/msg"
+        + (f" {peak / 1e6:>9.1f} MB peak" if peak is not None else "")
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=60, help="number of messages to generate")
+    parser.add_argument("--corpus", help="directory of .eml files to use instead of generating them")
+    parser.add_argument("--memory", action="store_true", help="also measure peak memory (slower)")
+    args = parser.parse_args()
+
+    searcher = GmailSearcher()
+    extractors = [
+        ("streaming", searcher.extract_message_body_streaming),
+        ("iterative", searcher.extract_message_body_iterative),
+    ]
+    try:
+        import bs4 # noqa: F401
+        extractors.append(("default", searcher.extract_message_body))
+    except ImportError:
+        print("beautifulsoup4 isn't installed, skipping the default extractor")
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.corpus:
+            paths = sorted(
+                os.path.join(args.corpus, name)
+                for name in os.listdir(args.corpus)
+                if name.endswith(".eml")
+            )
+        else:
+            paths = make_corpus(directory, args.count)
+        messages = load_corpus(paths)
+        size = sum(len(m["raw"]) for m in messages)
+        print(f"{len(messages)} messages, {size / 1e6:.1f} MB base64")
+        for name, extract in extractors:
+            run(name, extract, messages, args.memory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# runs summarize.py and generate.py end to end against traffic recorded
+# with REPLAY=record (see replay.py), with no network, and reports how
+# fast they get through the mailbox.
+#
+# each script runs in a fresh temporary directory, so its message store,
+# LLM cache and sync checkpoint start empty every time and runs are
+# comparable.
+#
+# run from the root of the repo:
+#   REPLAY=record python summarize.py          # once, with real accounts
+#   REPLAY=record python generate.py
+#   python -m benchmarks.bench_pipeline [--archive fixtures.db] [--latency 0]
+
+import argparse
+import contextlib
+import io
+import os
+import runpy
+import sys
+import tempfile
+import time
+
+import metrics
+
+SCRIPTS = ("summarize.py", "generate.py")
+
+
+def run_script(script, archive, latency, verbose=False):
+    """Run a script in replay mode in a scratch directory.
+
+    Returns:
+        Dict with the wall-clock seconds, the number of messages parsed
+        and LLM calls made, and the error that stopped the script, if any.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = {
+        "REPLAY": "replay",
+        "REPLAY_ARCHIVE": os.path.abspath(archive),
+        "REPLAY_LATENCY": latency,
+    }
+    saved_environment = {name: os.environ.get(name) for name in environment}
+    saved_cwd = os.getcwd()
+    metrics.registry.reset()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    error = None
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.update(environment)
+        os.chdir(directory)
+        start = time.perf_counter()
+        try:
+            with output:
+                runpy.run_path(os.path.join(root, script), run_name="__main__")
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            seconds = time.perf_counter() - start
+            os.chdir(saved_cwd)
+            for name, value in saved_environment.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+    stats = metrics.registry.to_dict()
+    return {
+        "seconds": seconds,
+        "messages": stats.get("body_extract_seconds", {}).get("count", 0),
+        "llm_calls": stats.get("llm_seconds", {}).get("count", 0),
+        "error": error,
+        "metrics": stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--archive", default="fixtures.db", help="recorded traffic, from REPLAY=record")
+    parser.add_argument("--latency", default="recorded", help='"recorded", or seconds to wait per call')
+    parser.add_argument("--script", choices=SCRIPTS, action="append", help="only run these scripts")
+    parser.add_argument("--verbose", action="store_true", help="show the scripts' output")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.archive):
+        print(f"No recorded traffic at {args.archive}, run the scripts with REPLAY=record first")
+        sys.exit(1)
+    # the scripts import their neighbours by name
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    print(f"{'script':<14} {'seconds':>9} {'messages':>9} {'msgs/sec':>9} {'LLM calls':>10} {'calls/sec':>10}")
+    for script in args.script or SCRIPTS:
+        result = run_script(script, args.archive, args.latency, args.verbose)
+        seconds = result["seconds"]
+        print(
+            f"{script:<14} {seconds:>9.2f} {result['messages']:>9} {result['messages'] / seconds:>9.1f}"
+            f" {result['llm_calls']:>10} {result['llm_calls'] / seconds:>10.1f}"
+        )
+        if result["error"]:
+            print(f"  stopped early: {result['error']}")
+        for name in ("gmail_list_seconds", "gmail_get_seconds", "body_extract_seconds", "truncate_seconds", "llm_seconds"):
+            stage = result["metrics"].get(name)
+            if stage and stage["count"]:
+                print(f"  {name:<22} {stage['sum']:>8.2f}s total over {stage['count']} calls")
+
+
+if __name__ == "__main__":
+    main()
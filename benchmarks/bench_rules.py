@@ -0,0 +1,88 @@
+# checks that rules.RuleEngine gives the same results as running a
+# generated extractor directly, and compares their throughput.
+#
+# run from the root of the repo:
+#   python -m benchmarks.bench_rules [--extractor sample_generated_code.py] [--count 2000]
+
+import argparse
+import random
+import time
+
+from rules import DEFAULT_FUNCTION_NAME, RuleEngine
+
+# bits of real-looking airline emails, some of which trigger the rules in
+# sample_generated_code.py
+SNIPPETS = [
+    "Thanks for flying alaskaair.com, your trip from SEA to SFO is booked. ",
+    "Confirmation code HXYZQP\n06:00 AM  SEA <br /> Seattle, WA <br /> 02:49 PM  HNL <br /> Honolulu, HI ",
+    "Prices shown: OAK to BOS. ",
+    "Your confirmation receipt: * SEA * to * PDX * ",
+    "Alaska\nFlight 123\n06:00 AM\nSEA Seattle\nnonstop\n02:49 PM\nHNL Honolulu\n",
+    "Your flight from Boston departs tomorrow. Check in for your flight to Oakland. ",
+    "mi_origin=3DJFK&mi_destination=3DSFO& ",
+    "your trip to Lisbon starts in 3 days. ",
+    "<td style=3D=22font-size:16px=22>Book now and save 20%</td>\n",
+    "Unsubscribe from these emails at any time. ",
+    "&nbsp;=20\n",
+]
+
+FILLER = "<tr><td style=3D=22padding:0=22>&nbsp;</td></tr>\n"
+
+
+def make_corpus(count, rng):
+    bodies = []
+    for _ in range(count):
+        parts = rng.choices(SNIPPETS, k=rng.randint(1, 4))
+        parts.append(FILLER * rng.choice([10, 100, 1000, 5000]))
+        rng.shuffle(parts)
+        bodies.append("".join(parts))
+    return bodies
+
+
+def outcome(extract, body):
+    # the generated code has bugs, so raising is part of the behaviour
+    try:
+        return ("ok", extract(body))
+    except Exception as e:
+        return ("error", type(e).__name__, str(e))
+
+
+def throughput(extract, bodies):
+    start = time.perf_counter()
+    for body in bodies:
+        outcome(extract, body)
+    return len(bodies) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--extractor", default="sample_generated_code.py")
+    parser.add_argument("--function", default=DEFAULT_FUNCTION_NAME)
+    parser.add_argument("--count", type=int, default=2000)
+    args = parser.parse_args()
+
+    with open(args.extractor) as f:
+        source = f.read()
+    namespace = {}
+    exec(compile(source, args.extractor, "exec"), namespace)
+    original = namespace[args.function]
+    engine = RuleEngine(source, args.function, filename=args.extractor)
+    print(
+        f"{len(engine.rules)} rules, {len(engine.patterns)} distinct patterns"
+    )
+
+    bodies = make_corpus(args.count, random.Random(1234))
+    mismatches = 0
+    for body in bodies:
+        if outcome(original, body) != outcome(engine.extract, body):
+            mismatches += 1
+    print(f"{mismatches} of {len(bodies)} emails gave different results")
+
+    original_rate = throughput(original, bodies)
+    engine_rate = throughput(engine.extract, bodies)
+    print(f"original {original_rate:>10.1f} emails/sec")
+    print(f"engine   {engine_rate:>10.1f} emails/sec ({engine_rate / original_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# compares the old sliceUntilFits loop from generate.py with
+# tokens.fit_prompt on large email bodies, counting how many times the
+# text gets tokenized and how long it takes.
+#
+# run from the root of the repo:
+#   python -m benchmarks.bench_truncate [--max-tokens 128000]
+
+import argparse
+import random
+import time
+
+import tiktoken
+
+import tokens
+
+MODEL = "gpt-3.5-turbo"
+
+
+class CountingEncoding:
+    """Wraps a tiktoken encoding and counts calls to encode."""
+
+    def __init__(self, enc):
+        self.enc = enc
+        self.encodes = 0
+
+    def encode(self, text, **kwargs):
+        self.encodes += 1
+        return self.enc.encode(text, **kwargs)
+
+    def decode(self, tokens):
+        return self.enc.decode(tokens)
+
+
+def slice_until_fits(string, max_tokens, counter):
+    # the loop generate.py used to run, minus the printing
+    enc = tiktoken.encoding_for_model(MODEL)
+    counter.enc = enc
+    while True:
+        encoded = counter.encode(string)
+        if len(encoded) > 300000:
+            string = string[-300000:]
+        elif len(encoded) > max_tokens:
+            string = string[:-10000]
+        else:
+            return string
+
+
+def make_body(chars, rng):
+    # quoted-printable HTML like the airline emails, which tokenizes poorly
+    words = ["itinerary", "=3D", "<td", "style=3D=22font-size:16px=22>", "SFO", "JFK", "&nbsp;", "confirmation", "\n"]
+    parts = []
+    size = 0
+    while size < chars:
+        word = rng.choice(words)
+        parts.append(word)
+        size += len(word) + 1
+    return " ".join(parts)[:chars]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-tokens", type=int, default=128000)
+    args = parser.parse_args()
+
+    rng = random.Random(1234)
+    instructions = "Attached is the body of an email message, and a block of python code.\n" * 50
+    print(f"{'body chars':>10} {'old encodes':>12} {'old ms':>10} {'new encodes':>12} {'new ms':>10}")
+    for chars in (50_000, 300_000, 600_000, 1_200_000):
+        body = make_body(chars, rng)
+
+        old_counter = CountingEncoding(None)
+        start = time.perf_counter()
+        slice_until_fits(instructions + body, args.max_tokens, old_counter)
+        old_ms = 1000 * (time.perf_counter() - start)
+
+        new_counter = CountingEncoding(tokens.get_encoding(MODEL))
+        original = tokens.get_encoding
+        tokens.get_encoding = lambda model: new_counter
+        try:
+            start = time.perf_counter()
+            tokens.fit_prompt(instructions, body, args.max_tokens, MODEL)
+            new_ms = 1000 * (time.perf_counter() - start)
+        finally:
+            tokens.get_encoding = original
+
+        print(f"{chars:>10} {old_counter.encodes:>12} {old_ms:>10.1f} {new_counter.encodes:>12} {new_ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
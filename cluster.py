@@ -0,0 +1,169 @@
+# groups emails by the template they were generated from. airline emails
+# are mail-merged from a handful of templates, so once the LLM has seen
+# one or two copies of a template there's nothing new to learn from the
+# rest; they're more useful for checking the generated code still works.
+#
+# each email gets a MinHash signature over shingles of its words (with
+# numbers and other details that change between copies blanked out), and
+# an LSH index finds earlier emails whose signatures mostly agree.
+# the index only keeps a bounded number of clusters, forgetting the least
+# recently seen ones, so memory stays flat on huge mailboxes.
+
+import hashlib
+import random
+import re
+import struct
+from collections import OrderedDict
+
+# things that differ between copies of the same template
+_VARIABLE = re.compile(r"\d+|[A-Z0-9]{6}\b|\S+@\S+|https?://\S+")
+_WORD = re.compile(r"\w+")
+
+
+class TemplateIndex:
+    """An incremental MinHash/LSH index of email templates.
+
+    Args:
+        num_perm: number of hash functions in each signature.
+        bands: the signature is split into this many bands for LSH; two
+            emails are candidates if any band matches exactly. More bands
+            finds less similar pairs.
+        threshold: estimated Jaccard similarity needed to join a cluster.
+        shingle_size: words per shingle.
+        max_chars: only the start of each email is used.
+        max_clusters: the least recently seen clusters are forgotten past this.
+    """
+
+    def __init__(self, num_perm=64, bands=16, threshold=0.7, shingle_size=4, max_chars=20000, max_clusters=20000, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm has to be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.max_chars = max_chars
+        self.max_clusters = max_clusters
+        rng = random.Random(seed)
+        self._masks = [rng.getrandbits(64) for _ in range(num_perm)]
+        # cluster id -> {"signature", "size", "buckets"}, oldest first
+        self._clusters = OrderedDict()
+        # (band number, band hash) -> cluster id
+        self._buckets = {}
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._clusters)
+
+    def signature(self, text: str):
+        text = _VARIABLE.sub("#", text[:self.max_chars]).lower()
+        words = _WORD.findall(text)
+        size = self.shingle_size
+        shingles = {
+            " ".join(words[i:i + size]) for i in range(max(1, len(words) - size + 1))
+        }
+        hashes = [
+            struct.unpack("<Q", hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest())[0]
+            for s in shingles
+        ]
+        if not hashes:
+            return (0,) * self.num_perm
+        # xoring with a random mask and taking the min is a cheap stand-in
+        # for a family of independent hash functions
+        return tuple(min(h ^ mask for h in hashes) for mask in self._masks)
+
+    def _bands(self, signature):
+        rows = self.rows
+        for band in range(self.bands):
+            yield band, hash(signature[band * rows:(band + 1) * rows])
+
+    def add(self, text: str) -> int:
+        """Add an email and return the id of the cluster it belongs to.
+
+        Returns:
+            The cluster id; a new cluster is created if nothing similar
+            enough has been seen.
+        """
+        signature = self.signature(text)
+        bands = list(self._bands(signature))
+
+        best_id = None
+        best_similarity = self.threshold
+        for key in bands:
+            cluster_id = self._buckets.get(key)
+            if cluster_id is None or cluster_id == best_id:
+                continue
+            similarity = self.similarity(signature, self._clusters[cluster_id]["signature"])
+            if similarity >= best_similarity:
+                best_id, best_similarity = cluster_id, similarity
+
+        if best_id is not None:
+            cluster = self._clusters[best_id]
+            cluster["size"] += 1
+            self._clusters.move_to_end(best_id)
+            return best_id
+
+        cluster_id = self._next_id
+        self._next_id += 1
+        self._clusters[cluster_id] = {"signature": signature, "size": 1, "buckets": bands}
+        for key in bands:
+            self._buckets.setdefault(key, cluster_id)
+        if len(self._clusters) > self.max_clusters:
+            self._forget_oldest()
+        return cluster_id
+
+    def size(self, cluster_id: int) -> int:
+        cluster = self._clusters.get(cluster_id)
+        return cluster["size"] if cluster else 0
+
+    def similarity(self, a, b) -> float:
+        return sum(x == y for x, y in zip(a, b)) / self.num_perm
+
+    def _forget_oldest(self):
+        cluster_id, cluster = self._clusters.popitem(last=False)
+        for key in cluster["buckets"]:
+            if self._buckets.get(key) == cluster_id:
+                del self._buckets[key]
+
+
+class ExemplarSelector:
+    """Splits emails into exemplars for the LLM and a validation set.
+
+    The first `exemplars_per_cluster` emails of each template are
+    exemplars; the rest of each cluster goes into a bounded validation set.
+    """
+
+    def __init__(self, index: TemplateIndex = None, exemplars_per_cluster: int = 2, max_validation: int = 2000):
+        self.index = index or TemplateIndex()
+        self.exemplars_per_cluster = exemplars_per_cluster
+        self.max_validation = max_validation
+        self.validation = []
+        self._validation_seen = 0
+        self._rng = random.Random(1)
+
+    def split(self, messages):
+        """Return the messages that should go to the LLM.
+
+        The others are added to `self.validation` as (cluster id, message).
+        """
+        exemplars = []
+        for message in messages:
+            cluster_id = self.index.add(message["text"])
+            message["extra_info"]["cluster"] = cluster_id
+            if self.index.size(cluster_id) <= self.exemplars_per_cluster:
+                exemplars.append(message)
+            else:
+                print(f"Message {message['extra_info']['id']} is another copy of template {cluster_id}, keeping it for validation")
+                self._add_validation((cluster_id, message))
+        return exemplars
+
+    def _add_validation(self, item):
+        # reservoir sampling keeps a fair sample of everything seen in a
+        # fixed amount of memory
+        self._validation_seen += 1
+        if len(self.validation) < self.max_validation:
+            self.validation.append(item)
+        else:
+            slot = self._rng.randrange(self._validation_seen)
+            if slot < self.max_validation:
+                self.validation[slot] = item
@@ -0,0 +1,321 @@
+# shrinks the extraction code generate.py builds up. the LLM tends to add
+# a new block for every email even when an earlier block already does the
+# same thing (see the two identical JetBlue blocks and the two mi_origin
+# blocks in sample_generated_code.py), and every email pays for every
+# block.
+#
+# the top-level `if` statements of the extraction function are its rules
+# (the same ones RuleEngine profiles). compact() moves regexes used more
+# than once into module-level compiled patterns, then merges
+#   * rules with identical bodies, into one rule whose test is `A or B`,
+#     leaving out a test another one subsumes (`A or (A and B)` is `A`)
+#   * rules with identical tests, into one rule running both bodies
+# merges are tried one at a time, and each is only kept if the
+# code gives exactly the same output as before on every email it's
+# checked against.
+#
+#   python compact.py generated_code.py --store messages.db --output compacted.py
+
+import argparse
+import ast
+import re
+
+from rules import DEFAULT_FUNCTION_NAME, RuleEngine, _Rewriter, _assigns, _find_function, _imports_re
+from sandbox import TimeLimitExceeded, time_limit
+
+# flags written out by name when hoisting a pattern
+_FLAG_NAMES = ("ASCII", "IGNORECASE", "LOCALE", "MULTILINE", "DOTALL", "VERBOSE", "UNICODE")
+
+
+def compact(source: str, texts, function_name: str = DEFAULT_FUNCTION_NAME, timeout: float = 2.0):
+    """Merge duplicate rules in some extraction code.
+
+    Args:
+        source: the Python source of the generated module.
+        texts: email bodies to check that the compacted code gives the
+            same output on.
+        function_name: the name of the extraction function.
+        timeout: seconds allowed per email. An email that times out
+            counts as different output, so no merge is accepted on it.
+
+    Returns:
+        (compacted source, report). The source comes back unchanged
+        (comments and all) if nothing could be merged; otherwise it's
+        regenerated from the syntax tree and loses its comments.
+    """
+    texts = list(texts)
+    tree = ast.parse(source)
+    function = _find_function(tree, function_name)
+    report = {
+        "rules_before": _count_rules(function),
+        "rules_after": _count_rules(function),
+        "merged": [],
+        "rejected": 0,
+        "patterns_hoisted": 0,
+        "chars_before": len(source),
+        "chars_after": len(source),
+    }
+    if function is None or not texts:
+        return source, report
+
+    expected = _outputs(source, texts, function_name, timeout)
+    if expected is None:
+        return source, report
+
+    def same_output(candidate):
+        return _outputs(candidate, texts, function_name, timeout, expected) is not None
+
+    # hoisting first also makes calls that only differed in how they
+    # passed flags identical, so more rules can be merged
+    hoisted = _hoist_patterns(tree, function)
+    if hoisted and same_output(ast.unparse(tree)):
+        report["patterns_hoisted"] = hoisted
+    elif hoisted:
+        # shouldn't happen, but never hand back code that behaves differently
+        tree = ast.parse(source)
+        function = _find_function(tree, function_name)
+
+    rejected = set()
+    merged_any = True
+    while merged_any:
+        merged_any = False
+        for first, second in _candidates(function):
+            key = (ast.dump(first), ast.dump(second))
+            if key in rejected:
+                continue
+            original_body = function.body
+            merged = _merge(first, second)
+            function.body = [merged if s is first else s for s in original_body if s is not second]
+            if same_output(ast.unparse(tree)):
+                report["merged"].append((first.lineno, second.lineno))
+                merged_any = True
+                break
+            function.body = original_body
+            report["rejected"] += 1
+            rejected.add(key)
+
+    if not report["merged"] and not report["patterns_hoisted"]:
+        return source, report
+    compacted = ast.unparse(tree)
+    report["rules_after"] = _count_rules(function)
+    report["chars_after"] = len(compacted)
+    return compacted, report
+
+
+def format_report(report) -> str:
+    return (
+        f"Compaction: {report['rules_before']} rules down to {report['rules_after']}"
+        f" ({len(report['merged'])} merges kept, {report['rejected']} rejected),"
+        f" {report['patterns_hoisted']} shared patterns,"
+        f" {report['chars_before']} -> {report['chars_after']} characters"
+    )
+
+
+def _count_rules(function):
+    if function is None:
+        return 0
+    return sum(1 for statement in function.body if _is_rule(statement))
+
+
+def _is_rule(statement):
+    return isinstance(statement, ast.If) and not statement.orelse
+
+
+def _candidates(function):
+    """Pairs of rules (earlier, later) with the same body or the same test."""
+    rules = [statement for statement in function.body if _is_rule(statement)]
+    dumps = [(ast.dump(rule.test), _dump_body(rule)) for rule in rules]
+    for i, first in enumerate(rules):
+        for j in range(i + 1, len(rules)):
+            if dumps[i][0] == dumps[j][0] or dumps[i][1] == dumps[j][1]:
+                yield first, rules[j]
+
+
+def _dump_body(rule):
+    return "\n".join(ast.dump(statement) for statement in rule.body)
+
+
+def _merge(first, second):
+    """One rule doing the work of both, in the place of the first."""
+    if _dump_body(first) == _dump_body(second):
+        merged = ast.If(test=_or(first.test, second.test), body=first.body, orelse=[])
+    else:
+        merged = ast.If(test=first.test, body=first.body + second.body, orelse=[])
+    return ast.copy_location(merged, first)
+
+
+def _or(a, b):
+    operands = []
+    seen = set()
+    for test in (a, b):
+        parts = test.values if isinstance(test, ast.BoolOp) and isinstance(test.op, ast.Or) else [test]
+        for part in parts:
+            dump = ast.dump(part)
+            if dump not in seen:
+                seen.add(dump)
+                operands.append(part)
+    # a rule that only fires when another one does adds nothing to the test
+    conjuncts = [_conjuncts(operand) for operand in operands]
+    operands = [
+        operand for i, operand in enumerate(operands)
+        if not any(
+            conjuncts[j] < conjuncts[i] or (conjuncts[j] == conjuncts[i] and j < i)
+            for j in range(len(operands)) if j != i
+        )
+    ]
+    if len(operands) == 1:
+        return operands[0]
+    return ast.BoolOp(op=ast.Or(), values=operands)
+
+
+def _conjuncts(test):
+    """The parts of `A and B and ...`, as a set of dumps."""
+    parts = test.values if isinstance(test, ast.BoolOp) and isinstance(test.op, ast.And) else [test]
+    return frozenset(ast.dump(part) for part in parts)
+
+
+def _outputs(source, texts, function_name, timeout, expected=None):
+    """Run the code over every text.
+
+    Returns:
+        The list of outputs, or None if the code couldn't be loaded, an
+        email timed out, or an output differed from `expected`.
+    """
+    try:
+        engine = RuleEngine(source, function_name)
+    except Exception:
+        return None
+    outputs = []
+    for i, text in enumerate(texts):
+        try:
+            with time_limit(timeout):
+                output = ("ok", engine.extract(text))
+        except TimeLimitExceeded:
+            return None
+        except Exception as e:
+            output = ("error", f"{type(e).__name__}: {e}")
+        if expected is not None and output != expected[i]:
+            return None
+        outputs.append(output)
+    return outputs
+
+
+class _PatternCounter(_Rewriter):
+    def __init__(self):
+        super().__init__(rewrite_patterns=True)
+        self.counts = {}
+
+    def _compiled(self, pattern, flags):
+        self.counts[(pattern, flags)] = self.counts.get((pattern, flags), 0) + 1
+        return None
+
+
+class _PatternHoister(_Rewriter):
+    def __init__(self, names):
+        super().__init__(rewrite_patterns=True)
+        self.names = names
+
+    def _compiled(self, pattern, flags):
+        name = self.names.get((pattern, flags))
+        return ast.Name(id=name, ctx=ast.Load()) if name else None
+
+
+def _hoist_patterns(tree, function):
+    """Compile regexes used more than once at module level.
+
+    Returns:
+        The number of patterns hoisted.
+    """
+    if not _imports_re(tree) or _assigns(function, "re"):
+        return 0
+    counter = _PatternCounter()
+    for statement in function.body:
+        counter.visit(statement)
+    shared = [key for key, count in counter.counts.items() if count > 1]
+    if not shared:
+        return 0
+
+    taken = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+    taken.update(node.name for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef)))
+    names = {}
+    number = 0
+    for key in shared:
+        number += 1
+        while f"_PATTERN_{number}" in taken:
+            number += 1
+        names[key] = f"_PATTERN_{number}"
+
+    hoister = _PatternHoister(names)
+    function.body = [hoister.visit(statement) for statement in function.body]
+
+    definitions = []
+    for (pattern, flags), name in names.items():
+        args = [ast.Constant(value=pattern)]
+        if flags:
+            args.append(_flags_expression(flags))
+        definitions.append(ast.Assign(
+            targets=[ast.Name(id=name, ctx=ast.Store())],
+            value=ast.Call(
+                func=ast.Attribute(value=ast.Name(id="re", ctx=ast.Load()), attr="compile", ctx=ast.Load()),
+                args=args,
+                keywords=[],
+            ),
+            lineno=0,
+        ))
+    # right after the imports at the top of the module
+    position = 0
+    for index, statement in enumerate(tree.body):
+        if isinstance(statement, (ast.Import, ast.ImportFrom)):
+            position = index + 1
+    tree.body[position:position] = definitions
+    ast.fix_missing_locations(tree)
+    return len(names)
+
+
+def _flags_expression(flags):
+    names = []
+    remaining = int(flags)
+    for name in _FLAG_NAMES:
+        value = int(getattr(re, name))
+        if remaining & value:
+            names.append(name)
+            remaining &= ~value
+    parts = [ast.Attribute(value=ast.Name(id="re", ctx=ast.Load()), attr=name, ctx=ast.Load()) for name in names]
+    if remaining:
+        parts.append(ast.Constant(value=remaining))
+    expression = parts[0]
+    for part in parts[1:]:
+        expression = ast.BinOp(left=expression, op=ast.BitOr(), right=part)
+    return expression
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge duplicate rules in a generated extractor.")
+    parser.add_argument("extractor", help="Python file with the generated extraction function")
+    parser.add_argument("--function", default=DEFAULT_FUNCTION_NAME)
+    parser.add_argument("--store", default="messages.db", help="message store to check the output against")
+    parser.add_argument("--output", help="where to write the compacted code (default: print it)")
+    parser.add_argument("--timeout", type=float, default=2.0, help="seconds allowed per email")
+    args = parser.parse_args()
+
+    from store import MessageStore
+
+    with open(args.extractor) as f:
+        source = f.read()
+    store = MessageStore(args.store)
+    texts = [message["body"] for message in store.iter_messages()]
+    store.close()
+    if not texts:
+        print(f"No messages in {args.store} to check against")
+
+    compacted, report = compact(source, texts, args.function, args.timeout)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(compacted)
+    else:
+        print(compacted)
+
+
+if __name__ == "__main__":
+    main()
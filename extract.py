@@ -0,0 +1,223 @@
+# runs an extractor written by generate.py (saved to generated_code.py)
+# over a whole mailbox, using every core.
+#
+#   python extract.py --source store --output itineraries.jsonl
+#   python extract.py --source gmail --query "your flight itinerary" --output itineraries.parquet
+#   python extract.py --source gmail --two-phase --output itineraries.itab
+#   python extract.py --extractor sample_generated_code.py --raw --source gmail
+#   python itineraries.py itineraries.parquet
+#
+# messages come from the local message store (see store.py) or straight
+# from gmail, and are handed to a pool of worker processes in chunks.
+# generate.py writes its extractor against the text of the message parts
+# gmail splits out (GmailSearcher.two_phase), so that's the text used
+# here too, and only messages stored with it are read from the store.
+# --raw downloads whole messages and pulls the text out itself instead,
+# which is what sample_generated_code.py was written against (its rules
+# look for raw HTML, so without --raw it finds nothing).
+# each message gets a time limit, so a regex that backtracks forever only
+# costs that one message instead of hanging a worker.
+
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+import itineraries as itinerary_files
+from rules import DEFAULT_FUNCTION_NAME, RuleEngine
+from sandbox import TimeLimitExceeded, time_limit
+
+# set in each worker process by _init_worker
+_engine = None
+_timeout = None
+
+
+def _init_worker(extractor_path, function_name, timeout):
+    global _engine, _timeout
+    _engine = RuleEngine.from_file(extractor_path, function_name, trace=True)
+    _timeout = timeout
+
+
+def _extract(message):
+    message_id, thread_id, date, body = message
+    try:
+        with time_limit(_timeout):
+            itineraries, rules = _engine.extract_traced(body)
+    except TimeLimitExceeded:
+        return message_id, thread_id, [], "timeout"
+    except Exception as e:
+        return message_id, thread_id, [], f"{type(e).__name__}: {e}"
+    rows = []
+    for i, itinerary in enumerate(itineraries or []):
+        if isinstance(itinerary, dict) and itinerary.get("isItinerary", True):
+            rule = rules[i] if rules else None
+            rows.append({
+                "id": message_id,
+                "threadId": thread_id,
+                "date": date,
+                "origin": itinerary.get("origin"),
+                "destination": itinerary.get("destination"),
+                "rule": _engine.rules[rule]["lineno"] if rule is not None else None,
+            })
+    return message_id, thread_id, rows, None
+
+
+def make_searcher(raw=False):
+    from gmail import GmailSearcher
+
+    searcher = GmailSearcher()
+    searcher.use_batch_requests = True
+    if raw:
+        searcher.use_streaming_parser = True
+    else:
+        searcher.two_phase = True
+    return searcher
+
+
+def store_messages(path, raw=False):
+    from store import MessageStore
+
+    store = MessageStore(path)
+    for message in store.iter_messages(extractor=make_searcher(raw).extractor):
+        yield message["id"], message["threadId"], message["date"], message["body"]
+
+
+def gmail_messages(query, max_results, store_path=None, two_phase=False, narrow_query=False, raw=False):
+    from pipeline import prefetch_pages
+
+    searcher = make_searcher(raw)
+    if store_path:
+        from store import MessageStore
+        searcher.store = MessageStore(store_path)
+    if two_phase:
+        from triage import HitHistory, MetadataTriage
+
+        # learn from what generate.py found
+        history = HitHistory()
+        searcher.two_phase = True
+        searcher.triage = MetadataTriage(history)
+        if narrow_query:
+            query = history.query(query, explore_every=0)
+            print(f"Searching for: {query}")
+    for page in prefetch_pages(searcher, query, max_results=max_results, prefetch=4):
+        for message in page["messages"]:
+            info = message["extra_info"]
+            yield info["id"], info["threadId"], info.get("date"), message["text"]
+
+
+class JsonlSink:
+    def __init__(self, path):
+        self.file = open(path, "w")
+
+    def write(self, rows):
+        for row in rows:
+            self.file.write(json.dumps(row) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def _bounded(messages, limit):
+    # Pool.imap reads its input as fast as it can, which would pull a whole
+    # mailbox into memory. Only let `limit` messages be in flight at once;
+    # the caller releases a slot for every result it takes.
+    slots = threading.Semaphore(limit)
+
+    def generate():
+        for message in messages:
+            slots.acquire()
+            yield message
+
+    return generate(), slots
+
+
+def run(messages, sink, extractor_path, function_name=DEFAULT_FUNCTION_NAME, workers=None, chunksize=64, timeout=5.0):
+    """Extract itineraries from `messages` in a process pool and write them to `sink`.
+
+    Args:
+        messages: iterable of (message id, thread id, date, body) tuples.
+
+    Returns:
+        Dict of counts: messages, itineraries, errors, timeouts, seconds.
+    """
+    workers = workers or os.cpu_count()
+    stats = {"messages": 0, "itineraries": 0, "errors": 0, "timeouts": 0}
+    start = time.perf_counter()
+    messages, slots = _bounded(messages, workers * chunksize * 4)
+    with multiprocessing.Pool(
+        workers,
+        initializer=_init_worker,
+        initargs=(extractor_path, function_name, timeout),
+    ) as pool:
+        for message_id, _, rows, error in pool.imap_unordered(_extract, messages, chunksize):
+            slots.release()
+            stats["messages"] += 1
+            if error == "timeout":
+                stats["timeouts"] += 1
+                print(f"Timed out extracting from message {message_id}")
+            elif error:
+                stats["errors"] += 1
+            sink.write(rows)
+            stats["itineraries"] += len(rows)
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a generated extractor over a mailbox")
+    parser.add_argument("--extractor", default="generated_code.py", help="file with the generated code (sample_generated_code.py needs --raw)")
+    parser.add_argument("--function", default=DEFAULT_FUNCTION_NAME, help="name of the extraction function")
+    parser.add_argument("--source", choices=["store", "gmail"], default="store")
+    parser.add_argument("--store", default="messages.db", help="message store to read from (or to cache into, with --source gmail)")
+    parser.add_argument("--query", default="your flight itinerary", help="gmail search, with --source gmail")
+    parser.add_argument("--page-size", type=int, default=100, help="messages per gmail page, with --source gmail")
+    parser.add_argument("--two-phase", action="store_true", help="with --source gmail, check each email's metadata before downloading it (see triage.py)")
+    parser.add_argument("--narrow-query", action="store_true", help="with --two-phase, only search for emails like the itineraries generate.py found")
+    parser.add_argument("--raw", action="store_true", help="use text pulled out of whole raw messages, not the text generate.py trains on")
+    parser.add_argument("--output", default="itineraries.jsonl", help="a .jsonl, .parquet or .itab file (see itineraries.py)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--chunksize", type=int, default=64, help="messages sent to a worker at a time")
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds allowed per message, 0 for no limit")
+    args = parser.parse_args()
+
+    if args.two_phase and args.raw:
+        parser.error("--two-phase and --raw can't be used together")
+    if not os.path.exists(args.extractor):
+        parser.error(f"{args.extractor} doesn't exist, run generate.py first or pass --extractor")
+    if args.source == "store":
+        messages = store_messages(args.store, args.raw)
+    else:
+        messages = gmail_messages(args.query, args.page_size, args.store, args.two_phase, args.narrow_query, args.raw)
+
+    if args.output.endswith(".jsonl"):
+        sink = JsonlSink(args.output)
+    else:
+        sink = itinerary_files.open_writer(args.output)
+    try:
+        stats = run(
+            messages,
+            sink,
+            args.extractor,
+            args.function,
+            workers=args.workers,
+            chunksize=args.chunksize,
+            timeout=args.timeout,
+        )
+    finally:
+        sink.close()
+
+    print(
+        f"{stats['messages']} messages, {stats['itineraries']} itineraries,"
+        f" {stats['errors']} errors, {stats['timeouts']} timeouts"
+        f" in {stats['seconds']:.1f}s ({stats['messages'] / max(stats['seconds'], 1e-9):.1f} messages/sec)"
+    )
+    if args.source == "gmail":
+        from gmail import fetch_report
+
+        print(fetch_report())
+
+
+if __name__ == "__main__":
+    main()
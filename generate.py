@@ -7,11 +7,42 @@ from llama_index.core import Settings
 from llama_index.llms.openai import OpenAI
 from llama_index.llms.gemini import Gemini
 from llama_index.llms.ollama import Ollama
-import tiktoken
 import json
+import time
 
-from gmail import GmailSearcher
+import metrics
+
+from cluster import ExemplarSelector
+from compact import compact, format_report as format_compaction
+from gmail import GmailSearcher, fetch_report
+from harness import Corpus, RegressionHarness
+from llm import complete
+from pipeline import prefetch_pages
+from prefilter import ItineraryPrefilter
+from regex_audit import audit, format_report, is_dangerous
+import replay
+from response_cache import ResponseCache
+from rules import RuleEngine
+from store import MessageStore
+from tokens import count_tokens, fit_prompt, truncate_tokens
+from triage import HitHistory, MetadataTriage
 searcher = GmailSearcher()
+# keep downloaded emails on disk so re-runs don't fetch them again
+searcher.store = MessageStore("messages.db")
+# set REPLAY=record to save everything gmail and the LLM send back, and
+# REPLAY=replay to run from the saved copy offline (see replay.py)
+replay.install(searcher)
+# look at each email's sender and size before downloading the whole
+# thing, and skip the ones that can't be itineraries. the LLM's verdicts
+# are remembered in hit_history.json.
+hits = HitHistory("hit_history.json")
+searcher.two_phase = True
+searcher.triage = MetadataTriage(hits)
+# set to True to only search for emails like the itineraries found on
+# earlier runs (see HitHistory.query). it's much less to download, but
+# misses itineraries unlike any before, except on every fifth run, which
+# searches for everything.
+NARROW_QUERY = False
 
 # if using openAI, this specifies which model to use
 # and it will use the same model for counting tokens.
@@ -21,34 +52,117 @@ searcher = GmailSearcher()
 MODEL = "gpt-3.5-turbo"
 #Settings.llm = OpenAI(model=MODEL)
 
-Settings.llm = Gemini(
+Settings.llm = replay.llm(lambda: Gemini(
     model="models/gemini-1.5-pro-latest",
     temperature=0.1
-)
+))
 
 # Settings.llm = Ollama(model="llama3", request_timeout=30.0)
 
-# some emails have attachments and are enormous and hard to parse
-# so we slice everything down to 128k tokens or less.
-def sliceUntilFits(string, max_tokens):
-    enc = tiktoken.encoding_for_model(MODEL)
-    while True:
-        encoded = enc.encode(string)    
-        print(f"Number of tokens: {len(encoded)}")
-        if len(encoded) > 300000: # like, WAY too long
-            string = string[-300000:] # get the last 300k chars
-        elif len(encoded) > max_tokens:
-            print("Message too long, slicing it down")
-            string = string[:-10000] # remove the last 10k chars to shorten it
-        else:
-            return string
+# remember the LLM's answer for every (email, code) pair so re-runs after a
+# crash don't pay for them again. bump PROMPT_VERSION whenever you change
+# the prompt below.
+PROMPT_VERSION = 1
+cache = ResponseCache("responses.db")
+
+# timings, sizes, tokens and LLM cost for every stage are written here at
+# the end (Prometheus text format, or JSON if the name ends in .json)
+METRICS_FILE = "metrics.prom"
+
+# the final extraction code is saved here, for extract.py to run over the
+# whole mailbox
+EXTRACTOR_FILE = "generated_code.py"
+
+# every email the LLM has classified, and a harness that checks each new
+# version of the code against all of them. a version that finds fewer of
+# the known itineraries, or takes more than 50ms per email, is thrown
+# away and we carry on with the best version so far.
+corpus = Corpus()
+harness = RegressionHarness(corpus, email_budget_ms=50)
+
+# the regexes in each new version are fuzzed with inputs built to make them
+# backtrack. a version with a regex that blows up on big emails is thrown
+# away, and what went wrong is passed along in the next prompt so the LLM
+# can write something safer. what was found for each pattern is kept, so
+# only the patterns a version adds get fuzzed.
+regexFeedback = ""
+auditCache = {}
 
 # this processes a batch of emails and modifies the python code via the LLM
 def summarizeMessages(messages,extraction_code):
     for message in messages:
         print("Handling a message")
         print(message['extra_info'])
-        instructions = f"""
+        key = ResponseCache.key(
+            Settings.llm.metadata.model_name, PROMPT_VERSION, extraction_code, regexFeedback, message['text']
+        )
+        response = cache.get(key)
+        fresh = response is None
+        if fresh:
+            response = completeMessage(message, extraction_code, regexFeedback)
+        try:
+            result = json.loads(str(response))
+            was_itinerary = result['was_itinerary']
+            new_code = result['code']
+        except Exception as e:
+            # not cached, so a re-run asks again instead of replaying it
+            print("Error parsing response")
+            print(e)
+            continue
+        if fresh:
+            cache.put(key, response)
+        print(f"Was itinerary: {was_itinerary}")
+        corpus.add(message['extra_info']['id'], message['text'], was_itinerary)
+        hits.record(message['extra_info'], was_itinerary)
+        extraction_code = considerCode(new_code, extraction_code)
+    return extraction_code
+
+# checks a new version of the code from the LLM, and returns whichever
+# version we should carry on with
+def considerCode(new_code, extraction_code):
+    global regexFeedback
+    if new_code == extraction_code:
+        return extraction_code
+    with metrics.timer("regex_audit_seconds"):
+        audit_reports = audit(new_code, cache=auditCache)
+    if is_dangerous(audit_reports):
+        regexFeedback = format_report(audit_reports, only_problems=True)
+        print("Rejected new extraction code, some regexes are too slow:")
+        print(regexFeedback)
+        return extraction_code
+    with metrics.timer("harness_seconds"):
+        accepted, _ = harness.consider(new_code)
+    if accepted:
+        regexFeedback = ""
+        return compactCode(new_code)
+    return extraction_code
+
+# the LLM keeps adding blocks that duplicate earlier ones, so merge them
+# whenever the code changes, as long as the result gives exactly the same
+# output on every email seen so far
+def compactCode(code):
+    texts = [email['text'] for email in corpus.emails]
+    texts += [message['text'] for _, message in selector.validation]
+    with metrics.timer("compaction_seconds"):
+        compacted, report = compact(code, texts)
+    print(format_compaction(report))
+    if compacted != code and harness.replace_best(compacted):
+        return compacted
+    return code
+
+# tells the LLM why its last version was rejected, if it was
+def regexFeedbackInstructions(regex_feedback):
+    if not regex_feedback:
+        return ""
+    return f"""
+            Your last change to the code was rejected because some of its regular expressions take far too long on large emails. Avoid .* between parts of a pattern, nested quantifiers like (\\w+\\s?)+, and quantifiers that can match the same text one after another. Prefer bounded quantifiers like {{1,40}} and negated character classes like [^<]*. Here is what was found:
+            {regex_feedback}
+            """
+
+# asks the LLM to update the code for a single email
+def completeMessage(message, extraction_code, regex_feedback=""):
+    regex_feedback = regexFeedbackInstructions(regex_feedback)
+    instructions = f"""
             Attached is the body of an email message, and a block of python code (which might be empty). The Python code's job is to extract flight itineraries from emails. If you detect that the email is a flight itinerary, modify the Python code such that it would correctly extract the origin and destination of the flight from this email as well as the emails it already knows how to parse. The code should return JSON listing the origin and destination, like this:
             {{
                 "isItinerary": true,
@@ -56,7 +170,7 @@ def summarizeMessages(messages,extraction_code):
                 "destination": "New York City, USA"
             }}
             If the email is not an itinerary (most will not be), you do not need to modify the python code.
-            
+            {regex_feedback}
             In either case, or if you can't figure out what to do, return the following JSON:
             {{
                 "was_itinerary": True or False depending if it was an itinerary,
@@ -72,39 +186,220 @@ def summarizeMessages(messages,extraction_code):
 
             And the text of the email is below this line:
             ------------
-            {message['text']}
             """
-        # openai has a maximum string length it can handle
-        instructions = sliceUntilFits(instructions, 128000)
-        response = Settings.llm.complete(instructions)
+    # some emails have attachments and are enormous and hard to parse
+    # so we cut the email down until everything fits in 128k tokens
+    instructions, token_count = fit_prompt(instructions, message['text'], 128000, MODEL)
+    print(f"Number of tokens: {token_count}")
+    start = time.perf_counter()
+    response = complete(Settings.llm, instructions, token_count)
+    recordPrompt("single", 1, token_count, time.perf_counter() - start)
+    return response
+
+# sending one email per call means resending the whole extraction code
+# every time, so by default emails are packed into prompts of up to
+# BATCH_TOKENS tokens (each cut down to EMAIL_TOKENS first) and the LLM
+# updates the code for all of them at once. emails are saved up across
+# pages of search results until they fill a batch. if its answer can't be parsed
+# we fall back to one call per email. set BATCH_TOKENS to 0 to always send
+# one email per call.
+BATCH_TOKENS = 64000
+EMAIL_TOKENS = 16000
+
+# tokens sent and seconds spent waiting for the LLM, to compare the two modes
+promptStats = {
+    mode: {"calls": 0, "emails": 0, "tokens": 0, "seconds": 0.0}
+    for mode in ("single", "batched")
+}
+
+def recordPrompt(mode, emails, tokens, seconds):
+    stats = promptStats[mode]
+    stats["calls"] += 1
+    stats["emails"] += emails
+    stats["tokens"] += tokens
+    stats["seconds"] += seconds
+
+def printPromptStats():
+    for mode, stats in promptStats.items():
+        if stats["emails"]:
+            print(
+                f"{mode}: {stats['emails']} emails in {stats['calls']} LLM calls,"
+                f" {stats['tokens'] / stats['emails']:.0f} tokens and"
+                f" {stats['seconds'] / stats['emails']:.2f}s per email"
+            )
+
+# splits emails into groups that fit in BATCH_TOKENS along with the code.
+# returns a list of batches, each a list of (message, text to put in the prompt)
+def packMessages(messages, extraction_code, regex_feedback):
+    overhead = count_tokens(batchInstructions(extraction_code, regex_feedback), MODEL)
+    batches = []
+    batch = []
+    used = overhead
+    for message in messages:
+        text, _ = truncate_tokens(message['text'], EMAIL_TOKENS, MODEL)
+        section = f"\n------------ email {message['extra_info']['id']} ------------\n{text}\n"
+        tokens = count_tokens(section, MODEL)
+        if batch and used + tokens > BATCH_TOKENS:
+            batches.append(batch)
+            batch = []
+            used = overhead
+        batch.append((message, section))
+        used += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+# like summarizeMessages, but asks about several emails in each LLM call.
+# unless flush is set, the last batch is handed back unsent, since the
+# emails on the next page might fill it up.
+# returns the extraction code and the emails that weren't sent
+def summarizeBatches(messages, extraction_code, flush=True):
+    batches = packMessages(messages, extraction_code, regexFeedback)
+    held = []
+    if batches and not flush:
+        held = [message for message, _ in batches.pop()]
+    for batch in batches:
+        print(f"Handling a batch of {len(batch)} messages")
+        key = ResponseCache.key(
+            Settings.llm.metadata.model_name, PROMPT_VERSION, "batch", extraction_code, regexFeedback,
+            *(section for _, section in batch)
+        )
+        response = cache.get(key)
+        fresh = response is None
+        if fresh:
+            response = completeBatch(batch, extraction_code, regexFeedback)
         try:
             result = json.loads(str(response))
-            print(f"Was itinerary: {result['was_itinerary']}")
-            extraction_code = result['code']
+            verdicts = {str(email['id']): bool(email['was_itinerary']) for email in result['emails']}
+            missing = [m['extra_info']['id'] for m, _ in batch if str(m['extra_info']['id']) not in verdicts]
+            if missing:
+                raise ValueError(f"no verdict for {', '.join(missing)}")
+            new_code = result['code']
         except Exception as e:
-            print("Error parsing response")
-            print(e)
-    return extraction_code
+            print(f"Couldn't parse the batched response ({e}), asking about each email separately")
+            extraction_code = summarizeMessages([message for message, _ in batch], extraction_code)
+            continue
+        if fresh:
+            cache.put(key, response)
+        for message, _ in batch:
+            was_itinerary = verdicts[str(message['extra_info']['id'])]
+            print(f"Message {message['extra_info']['id']} was itinerary: {was_itinerary}")
+            corpus.add(message['extra_info']['id'], message['text'], was_itinerary)
+            hits.record(message['extra_info'], was_itinerary)
+        extraction_code = considerCode(new_code, extraction_code)
+    return extraction_code, held
+
+def batchInstructions(extraction_code, regex_feedback):
+    regex_feedback = regexFeedbackInstructions(regex_feedback)
+    return f"""
+            Attached are several email messages, and a block of python code (which might be empty). The Python code's job is to extract flight itineraries from emails. Decide for each email whether it is a flight itinerary. Modify the Python code such that it would correctly extract the origin and destination of the flight from every itinerary below as well as the emails it already knows how to parse. The code should return JSON listing the origin and destination, like this:
+            {{
+                "isItinerary": true,
+                "origin": "San Francisco, USA",
+                "destination": "New York City, USA"
+            }}
+            If none of the emails are itineraries (most will not be), you do not need to modify the python code.
+            {regex_feedback}
+            In either case, or if you can't figure out what to do, return the following JSON:
+            {{
+                "emails": [
+                    {{"id": the id from the line above the email, "was_itinerary": true or false}},
+                    ...one entry like this for every email
+                ],
+                "modified_code": true or false depending if you modified the code,
+                "code": the python code, correctly enclosed in quotes and escaped for JSON
+            }}
+            You don't need to enclose the JSON in backticks or any other quoting, and you don't need to include any other information.
+            
+            The python code is between the next two lines of dashes:
+            ------------
+            {extraction_code}
+            ------------
+
+            The emails are below, each one starting with a line like "------------ email <id> ------------".
+            """
+
+# asks the LLM to update the code for a batch of emails
+def completeBatch(batch, extraction_code, regex_feedback):
+    instructions = batchInstructions(extraction_code, regex_feedback) + "".join(section for _, section in batch)
+    token_count = count_tokens(instructions, MODEL)
+    print(f"Number of tokens: {token_count}")
+    start = time.perf_counter()
+    response = complete(Settings.llm, instructions, token_count)
+    recordPrompt("batched", len(batch), token_count, time.perf_counter() - start)
+    return response
+
+# most emails matching the search are airline spam, so skip the ones that
+# obviously aren't itineraries without asking the LLM. lower the threshold
+# if real itineraries are being skipped.
+prefilter = ItineraryPrefilter(threshold=3)
+
+# airline emails are generated from a few templates, so only show the LLM
+# the first couple of copies of each one. the other copies are kept to
+# check the code against at the end.
+selector = ExemplarSelector(exemplars_per_cluster=2)
 
 # this iterates through all emails matching the search
 # it prints out the resulting python after each batch
-next_token = None
+# the next few batches are fetched from gmail while the LLM works on this one
 extraction_code = ""
-while True:
-    # TODO: get the LLM to think of good searches
-    messageResults = searcher.search_messages(
-        "your flight itinerary", 
-        max_results=4, # number of messages in a batch 
-        next_token=next_token
-    )
+# emails waiting for enough others to fill a batch
+pending = []
+# TODO: get the LLM to think of good searches
+query = hits.query("your flight itinerary") if NARROW_QUERY else "your flight itinerary"
+print(f"Searching for: {query}")
+for messageResults in prefetch_pages(
+    searcher,
+    query,
+    max_results=4, # number of messages in a page of search results
+    prefetch=2 # number of pages to fetch ahead
+):
     try:
-        extraction_code = summarizeMessages(messageResults['messages'],extraction_code)
+        pending += selector.split(prefilter.filter(messageResults['messages']))
+        if BATCH_TOKENS:
+            extraction_code, pending = summarizeBatches(pending, extraction_code, flush=False)
+        else:
+            extraction_code = summarizeMessages(pending, extraction_code)
+            pending = []
     except Exception as e:
         print("Error summarizing messages")
         print(e)
+        pending = []
     print("==== Current extraction code ====:")
     print(extraction_code)
-    if messageResults['next_token']:
-        next_token = messageResults['next_token']
-    else:
-        break
+if pending:
+    try:
+        extraction_code, _ = summarizeBatches(pending, extraction_code)
+    except Exception as e:
+        print("Error summarizing messages")
+        print(e)
+    print("==== Current extraction code ====:")
+    print(extraction_code)
+if extraction_code:
+    with open(EXTRACTOR_FILE, "w") as f:
+        f.write(extraction_code)
+    print(f"Saved the extraction code to {EXTRACTOR_FILE}")
+hits.save()
+searcher.triage.report()
+print(fetch_report())
+prefilter.report()
+cache.report()
+printPromptStats()
+metrics.registry.summary()
+metrics.registry.write(METRICS_FILE)
+
+# how many of the copies the LLM never saw does the final code handle?
+if selector.validation:
+    try:
+        engine = RuleEngine(extraction_code)
+        detected = 0
+        for cluster_id, message in selector.validation:
+            try:
+                if engine.extract(message['text']):
+                    detected += 1
+            except Exception as e:
+                print(f"Extraction code failed on message {message['extra_info']['id']}: {e}")
+        print(f"Extraction code found itineraries in {detected} of {len(selector.validation)} held-out emails from {len(selector.index)} templates")
+    except Exception as e:
+        print("Couldn't load the extraction code")
+        print(e)
@@ -5,118 +5,568 @@
 import os
 import base64
 import email
+import json
+import threading
+import time
 from email.message import EmailMessage
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from typing import Any, List, Optional
 
-SCOPES = [
-    # "https://www.googleapis.com/auth/gmail.compose",
-    "https://www.googleapis.com/auth/gmail.readonly",
-]
+import metrics
+from gmail_client import SCOPES, ServicePool
+
+# guards creating a searcher's service pool
+_pool_lock = threading.Lock()
+
+# bump when a parser changes the text it gets out of a message, so the
+# store doesn't hand back text from the old one
+EXTRACTOR_VERSION = 1
+# headers fetched for triage in two-phase mode
+METADATA_HEADERS = ["From", "Subject", "Date"]
+# the time spent waiting on gmail, for fetch_report
+_GMAIL_TIMERS = (
+    "gmail_list_seconds",
+    "gmail_get_seconds",
+    "gmail_batch_seconds",
+    "gmail_metadata_seconds",
+    "gmail_full_seconds",
+)
+
+class SyncCheckpoint:
+    """Progress of syncing a query, saved to a JSON file after every change.
+
+    `history_id` and `synced_at` describe the last completed sync: the
+    mailbox historyId and the time the sync started. `crawl` is the sync
+    currently in progress, if any, so an interrupted run can pick up from
+    the page after the last one the caller finished with. `failed` is
+    the ids of messages the caller couldn't handle, which the next sync
+    hands back before anything new.
+    """
+
+    def __init__(self, path: str = "sync_checkpoint.json"):
+        self.path = path
+        self.query = None
+        self.history_id = None
+        self.synced_at = None
+        self.crawl = None
+        self.failed = []
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.query = data.get("query")
+            self.history_id = data.get("history_id")
+            self.synced_at = data.get("synced_at")
+            self.crawl = data.get("crawl")
+            self.failed = data.get("failed", [])
+
+    def reset(self, query: str):
+        self.query = query
+        self.history_id = None
+        self.synced_at = None
+        self.crawl = None
+        # everything is synced again, failed messages included
+        self.failed = []
+        self.save()
+
+    def start_crawl(self, query: str, history_id: str):
+        self.crawl = {
+            "query": query,
+            "next_token": None,
+            "history_id": history_id,
+            "started_at": time.time(),
+        }
+        self.save()
+
+    def page_done(self, page, failed=()):
+        """Record that the caller has finished with a page from sync_messages.
+
+        Args:
+            failed: ids of messages on the page the caller couldn't
+                handle, to be retried by the next sync.
+        """
+        if page.get("retry"):
+            # the page of earlier failures, so only the new ones are left
+            self.failed = list(failed)
+            self.save()
+            return
+        self.failed += [message_id for message_id in failed if message_id not in self.failed]
+        if not self.crawl:
+            if failed:
+                self.save()
+            return
+        self.crawl["next_token"] = page["next_token"]
+        if not page["next_token"]:
+            self.history_id = self.crawl["history_id"]
+            self.synced_at = self.crawl["started_at"]
+            self.crawl = None
+        self.save()
+
+    def save(self):
+        data = {
+            "query": self.query,
+            "history_id": self.history_id,
+            "synced_at": self.synced_at,
+            "crawl": self.crawl,
+            "failed": self.failed,
+        }
+        # write to a temporary file first so a crash can't leave a
+        # half-written checkpoint behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
 
 class GmailSearcher:
     query: str = None
     use_iterative_parser: bool = False
+    # use mimetext.extract_text, which skips attachments without decoding
+    # them and caps the amount of text extracted from each message
+    use_streaming_parser: bool = False
+    max_body_chars: int = 200000
+    # fetch each page of messages with batched HTTP requests instead of
+    # one round trip per message. Gmail allows at most 100 calls per batch
+    # but recommends 50 or fewer to avoid rate limiting.
+    use_batch_requests: bool = False
+    batch_size: int = 50
     max_results: int = 10
-    service = None
+    # without batch requests, download the messages on each page from this
+    # many threads at once, each with its own connection
+    fetch_threads: int = 1
+    # download messages in two steps: first just the headers and size of
+    # each (format="metadata"), which `triage` (a triage.MetadataTriage)
+    # uses to drop the ones that can't be itineraries, then the text of
+    # the rest (format="full", which leaves attachments on the server)
+    two_phase: bool = False
+    triage = None
+    # an optional store.MessageStore; messages already in it are never
+    # downloaded again
+    store = None
+    # a gmail_client.ServicePool, created the first time it's needed.
+    # credentials are loaded once and refreshed in the background.
+    pool = None
+    _service = None
+    _executor = None
 
-    def _cache_service(self) -> None:
-        from googleapiclient.discovery import build
+    @property
+    def service(self):
+        """The gmail service for the calling thread.
 
-        credentials = self._get_credentials()
-        if not self.service:
-            self.service = build("gmail", "v1", credentials=credentials)
-
-    def _get_credentials(self) -> Any:
-        """Get valid user credentials from storage.
+        Assigning a service (like replay.py does) makes every thread use
+        that one instead.
+        """
+        if self._service is not None:
+            return self._service
+        return self.thread_service()
 
-        The file token.json stores the user's access and refresh tokens, and is
-        created automatically when the authorization flow completes for the first
-        time.
+    @service.setter
+    def service(self, service):
+        self._service = service
 
-        Returns:
-            Credentials, the obtained credential.
-        """
-        import os
-
-        from google.auth.transport.requests import Request
-        from google.oauth2.credentials import Credentials
-        from google_auth_oauthlib.flow import InstalledAppFlow
-
-        creds = None
-        if os.path.exists("token.json"):
-            creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    "credentials.json", SCOPES
-                )
-                creds = flow.run_local_server(port=8080)
-            # Save the credentials for the next run
-            with open("token.json", "w") as token:
-                token.write(creds.to_json())
+    @property
+    def extractor(self):
+        """Names the way message text is extracted with the current settings,
+        like "payload-1". The store keeps text from each one apart."""
+        if self.two_phase:
+            name = "payload"
+        elif self.use_streaming_parser:
+            name = "streaming"
+        elif self.use_iterative_parser:
+            name = "iterative"
+        else:
+            name = "bs4"
+        return f"{name}-{EXTRACTOR_VERSION}"
 
-        return creds
+    def thread_service(self):
+        """The calling thread's own service from the pool, ignoring any assigned one."""
+        if self.pool is None:
+            with _pool_lock:
+                if self.pool is None:
+                    self.pool = ServicePool()
+        return self.pool.get()
     
     def search_messages(self, query: str, max_results = None, next_token = None):
         if not max_results:
             max_results = self.max_results
 
-        self._cache_service()
-
         # https://googleapis.github.io/google-api-python-client/docs/dyn/gmail_v1.users.messages.html#list
-        messagesResult = (
-            self.service.users()
-            .messages()
-            .list(userId="me", q=query, maxResults=int(max_results), pageToken=next_token)
-            .execute()
-        )
+        with metrics.timer("gmail_list_seconds"):
+            messagesResult = (
+                self.service.users()
+                .messages()
+                .list(userId="me", q=query, maxResults=int(max_results), pageToken=next_token)
+                .execute()
+            )
         messages = messagesResult.get("messages", [])
         next_token = messagesResult.get("nextPageToken", None)
+        metrics.inc("gmail_listed_messages_total", len(messages))
+        return self._page(messages, next_token)
 
+    def _page(self, messages, next_token):
         results = []
-        try:
-            for message in messages:
-                message_data = self.get_message_data(message)
-                text = message_data.pop("body")
-                extra_info = message_data
-                results.append({
-                    "text":text, 
-                    "extra_info":extra_info
-                })
-        except Exception as e:
-            raise Exception("Can't get message data" + str(e))
+        for message_data in self.get_messages_data(messages):
+            text = message_data.pop("body")
+            extra_info = message_data
+            results.append({
+                "text":text, 
+                "extra_info":extra_info
+            })
 
         return {
             "messages": results,
             "next_token": next_token
         }
+
+    def sync_messages(self, query: str, checkpoint: SyncCheckpoint, max_results = None):
+        """Iterate over pages of messages matching `query` that haven't been synced yet.
+
+        The first sync walks every result. After that, the mailbox history
+        is checked for new messages since the last sync, and only messages
+        received since then are listed, so a run costs time in proportion
+        to new mail rather than the whole mailbox. If a sync is
+        interrupted, the next one resumes after the last page that was
+        passed to `checkpoint.page_done`.
+
+        Callers must call `checkpoint.page_done(page)` once they've
+        finished with each page, passing the ids of any messages they
+        couldn't handle. Those come back on a page of their own, marked
+        with "retry", at the start of the next sync.
+
+        Yields:
+            Dicts with "messages" and "next_token", like search_messages.
+        """
+        if checkpoint.query != query:
+            checkpoint.reset(query)
+
+        if checkpoint.failed:
+            page = self._page([{"id": message_id} for message_id in checkpoint.failed], None)
+            page["retry"] = True
+            yield page
+
+        if not checkpoint.crawl:
+            if checkpoint.history_id:
+                latest_history_id, has_new_messages = self._check_history(checkpoint.history_id)
+                if latest_history_id is None:
+                    print("Mailbox history has expired, syncing everything again")
+                    checkpoint.reset(query)
+                elif not has_new_messages:
+                    checkpoint.history_id = latest_history_id
+                    checkpoint.save()
+                    return
+                else:
+                    # a message can arrive while a sync is running, so look
+                    # back to when the last one started rather than ended
+                    checkpoint.start_crawl(
+                        f"{query} after:{int(checkpoint.synced_at)}",
+                        latest_history_id,
+                    )
+            if not checkpoint.crawl:
+                profile = self.service.users().getProfile(userId="me").execute()
+                checkpoint.start_crawl(query, profile["historyId"])
+
+        crawl_query = checkpoint.crawl["query"]
+        next_token = checkpoint.crawl["next_token"]
+        while True:
+            page = self.search_messages(crawl_query, max_results=max_results, next_token=next_token)
+            yield page
+            next_token = page["next_token"]
+            if not next_token:
+                break
+
+    def _check_history(self, start_history_id):
+        """Check whether any messages were added to the mailbox since a historyId.
+
+        Returns:
+            (latest historyId, whether any messages were added). The
+            historyId is None if the start point is too old for Gmail to
+            still have the history, in which case a full sync is needed.
+        """
+        from googleapiclient.errors import HttpError
+
+        # https://googleapis.github.io/google-api-python-client/docs/dyn/gmail_v1.users.history.html#list
+        page_token = None
+        while True:
+            try:
+                with metrics.timer("gmail_history_seconds"):
+                    historyResult = (
+                        self.service.users()
+                        .history()
+                        .list(
+                            userId="me",
+                            startHistoryId=start_history_id,
+                            historyTypes=["messageAdded"],
+                            pageToken=page_token,
+                        )
+                        .execute()
+                    )
+            except HttpError as e:
+                if e.resp.status == 404:
+                    return None, True
+                raise
+            if any(h.get("messagesAdded") for h in historyResult.get("history", [])):
+                return historyResult["historyId"], True
+            page_token = historyResult.get("nextPageToken")
+            if not page_token:
+                return historyResult["historyId"], False
+
+    def get_messages_data(self, messages):
+        """Get the data for a list of messages returned by messages.list.
+
+        If there is a store, messages already in it (with text from the
+        same extractor) are read from disk and only the missing ones are
+        downloaded (and then added to the store). Messages without a body
+        are remembered too, so they aren't downloaded again. Messages
+        triage skipped aren't, since triage keeps learning and may want
+        them next time.
+
+        Returns:
+            List of message data dicts, in the same order as `messages`.
+            Messages without a body are left out.
+        """
+        extractor = self.extractor
+        cached = self.store.get_many((m["id"] for m in messages), extractor) if self.store is not None else {}
+        # older stores remembered messages triage skipped
+        cached = {i: d for i, d in cached.items() if d.get("skipped") != "triage"}
+        missing = [m for m in messages if m["id"] not in cached]
+
+        if self.two_phase:
+            fetched = self.get_messages_data_two_phase(missing)
+        elif self.use_batch_requests:
+            fetched = self.get_messages_data_batched(missing)
+        else:
+            fetched = self.get_messages_data_each(missing)
+        fetched = {d["id"]: d for d in fetched if d}
+
+        if self.store is not None and fetched:
+            self.store.put_many((d for d in fetched.values() if d.get("skipped") != "triage"), extractor)
+
+        results = []
+        for message in messages:
+            message_data = cached.get(message["id"]) or fetched.get(message["id"])
+            if message_data and not message_data.get("skipped"):
+                results.append(message_data)
+        return results
     
+    def _fetch_executor(self):
+        # the threads live as long as the searcher, so each one keeps its
+        # service and connection from page to page
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(self.fetch_threads, thread_name_prefix="gmail-fetch")
+        return self._executor
+
     def get_message_data(self, message):
         message_id = message["id"]
-        message_data = (
-            self.service.users()
-            .messages()
-            .get(format="raw", userId="me", id=message_id)
-            .execute()
-        )
-        if self.use_iterative_parser:
-            body = self.extract_message_body_iterative(message_data)
+        with metrics.timer("gmail_get_seconds"):
+            message_data = (
+                self.service.users()
+                .messages()
+                .get(format="raw", userId="me", id=message_id)
+                .execute()
+            )
+        _record_download(message_data)
+        return self._parse_message_data(message_data)
+
+    def get_messages_data_batched(self, messages):
+        """Fetch a list of messages using Gmail batch HTTP requests.
+
+        Messages are grouped into batches of `batch_size` calls. A message
+        that fails to download or parse is reported and skipped, so one bad
+        message doesn't lose the rest of the page.
+
+        Returns:
+            List of message data dicts, in the same order as `messages`.
+            Messages without a body have "skipped" instead (see
+            _skipped).
+        """
+        responses = self._get_batched(messages, "gmail_batch_seconds", _record_download, format="raw")
+        return self._parse_each(messages, responses)
+
+    def get_messages_data_each(self, messages):
+        """Fetch a list of messages with one request each, on `fetch_threads` threads.
+
+        Like get_messages_data_batched, a message that fails to download
+        or parse is reported and skipped.
+        """
+        responses = self._get_each(messages, "gmail_get_seconds", _record_download, format="raw")
+        return self._parse_each(messages, responses)
+
+    def _parse_each(self, messages, responses):
+        # parse raw responses in the order of `messages`, skipping any
+        # that are missing or can't be parsed
+        results = []
+        for message in messages:
+            message_id = message["id"]
+            if message_id not in responses:
+                continue
+            try:
+                message_data = self._parse_message_data(responses[message_id])
+            except Exception as e:
+                print(f"Can't parse message {message_id}: {e}")
+                continue
+            if message_data:
+                results.append(message_data)
+        return results
+
+    def _get_batched(self, messages, timer, record, **get_args):
+        """messages.get every message with batch requests.
+
+        Returns:
+            Dict of message id to response. Messages that couldn't be
+            fetched are reported and left out.
+        """
+        responses = {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                print(f"Can't get message data for {request_id}: {exception}")
+            else:
+                responses[request_id] = response
+                record(response)
+
+        for start in range(0, len(messages), self.batch_size):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for message in messages[start:start + self.batch_size]:
+                batch.add(
+                    self.service.users()
+                    .messages()
+                    .get(userId="me", id=message["id"], **get_args),
+                    request_id=message["id"],
+                )
+            with metrics.timer(timer):
+                batch.execute()
+        return responses
+
+    def _get_each(self, messages, timer, record, **get_args):
+        """messages.get every message, one request each, on `fetch_threads` threads.
+
+        Returns:
+            Dict of message id to response. Messages that couldn't be
+            fetched are reported and left out, like _get_batched.
+        """
+        def get(message):
+            try:
+                with metrics.timer(timer):
+                    response = (
+                        self.service.users()
+                        .messages()
+                        .get(userId="me", id=message["id"], **get_args)
+                        .execute()
+                    )
+            except Exception as e:
+                print(f"Can't get message data for {message['id']}: {e}")
+                return None
+            record(response)
+            return response
+
+        if self.fetch_threads > 1 and len(messages) > 1:
+            responses = list(self._fetch_executor().map(get, messages))
         else:
-            body = self.extract_message_body(message_data)
+            responses = [get(m) for m in messages]
+        return {m["id"]: response for m, response in zip(messages, responses) if response is not None}
+
+    def get_messages_data_two_phase(self, messages):
+        """Fetch messages' metadata, then the text of the ones worth having.
 
-        if not body:
-            return None
+        Each message's From, Subject, Date and size are fetched first and
+        passed to `triage`. Only the messages it keeps are fetched in
+        full, and the text is taken from the parsed message gmail returns,
+        so attachments are never downloaded. Without a triage, every
+        message is fetched in full straight away.
+
+        Returns:
+            List of message data dicts for the messages kept, in the same
+            order as `messages`, with "from", "subject", "sizeEstimate" and
+            "hasAttachment" as well as the usual keys, then the messages
+            triage skipped. Those, and messages without a body, have
+            "skipped" instead (see _skipped).
+        """
+        get = self._get_batched if self.use_batch_requests else self._get_each
+        kept = []
+        skipped = []
+        if self.triage is None:
+            # nothing to decide, and the full message has the same headers
+            kept = [(message, None) for message in messages]
+        else:
+            metadata = get(
+                messages,
+                "gmail_metadata_seconds",
+                lambda response: _record_json_download(response, "gmail_metadata_bytes"),
+                format="metadata",
+                metadataHeaders=METADATA_HEADERS,
+            )
+            for message in messages:
+                if message["id"] not in metadata:
+                    continue
+                info = _metadata_info(metadata[message["id"]])
+                keep, reason = self.triage.keep(info)
+                if not keep:
+                    metrics.inc("gmail_triaged_out_total")
+                    print(f"Not downloading message {message['id']} ({reason})")
+                    skipped.append(_skipped(message, "triage"))
+                    continue
+                kept.append((message, info))
+
+        full = get(
+            [message for message, _ in kept],
+            "gmail_full_seconds",
+            lambda response: _record_json_download(response, "gmail_full_bytes"),
+            format="full",
+        )
+
+        results = []
+        for message, info in kept:
+            message_id = message["id"]
+            if message_id not in full:
+                continue
+            try:
+                message_data = self._parse_full_message_data(full[message_id])
+            except Exception as e:
+                print(f"Can't parse message {message_id}: {e}")
+                continue
+            if message_data:
+                if not message_data.get("skipped"):
+                    message_data.update(info or _metadata_info(full[message_id]))
+                results.append(message_data)
+        return results + skipped
+
+    def _parse_full_message_data(self, message_data):
+        from mimetext import extract_payload_text
+
+        payload = message_data.get("payload", {})
+        with metrics.timer("body_extract_seconds"):
+            body = extract_payload_text(payload, self.max_body_chars)
+        if not body or body.isspace():
+            return _skipped(message_data, "empty")
+        metrics.observe("body_text_chars", len(body))
+        return {
+            "id": message_data["id"],
+            "threadId": message_data["threadId"],
+            "snippet": message_data["snippet"],
+            "date": int(message_data["internalDate"]) // 1000 if message_data.get("internalDate") else None,
+            "body": body,
+            "hasAttachment": _has_attachment(payload),
+        }
+
+    def _parse_message_data(self, message_data):
+        with metrics.timer("body_extract_seconds"):
+            if self.use_streaming_parser:
+                body = self.extract_message_body_streaming(message_data)
+            elif self.use_iterative_parser:
+                body = self.extract_message_body_iterative(message_data)
+            else:
+                body = self.extract_message_body(message_data)
+
+        if not body or body.isspace():
+            return _skipped(message_data, "empty")
+        metrics.observe("body_text_chars", len(body))
 
         return {
             "id": message_data["id"],
             "threadId": message_data["threadId"],
             "snippet": message_data["snippet"],
+            # when gmail received it, in seconds since the epoch
+            "date": int(message_data["internalDate"]) // 1000 if message_data.get("internalDate") else None,
             "body": body,
         }
 
@@ -140,6 +590,12 @@ class GmailSearcher:
 
         return body_text
 
+    def extract_message_body_streaming(self, message: dict):
+        from mimetext import extract_text
+
+        body = base64.urlsafe_b64decode(message["raw"].encode("utf-8"))
+        return extract_text(body, self.max_body_chars)
+
     def extract_message_body(self, message: dict):
         from bs4 import BeautifulSoup
 
@@ -155,6 +611,62 @@ class GmailSearcher:
         except Exception as e:
             raise Exception("Can't parse message body" + str(e))
 
+def _skipped(message, reason):
+    """Stands in for a message that has no text to give, so the store
+    remembers not to download it again."""
+    return {"id": message["id"], "threadId": message.get("threadId"), "skipped": reason}
+
+def _record_download(message_data):
+    size = len(message_data.get("raw") or "")
+    metrics.inc("gmail_downloaded_bytes_total", size)
+    metrics.observe("gmail_message_bytes", size)
+
+def _record_json_download(response, histogram):
+    size = len(response.get("snippet") or "") + _payload_bytes(response.get("payload", {}))
+    metrics.inc("gmail_downloaded_bytes_total", size)
+    metrics.observe(histogram, size)
+
+def _payload_bytes(part):
+    # the base64 body data and the headers are most of what gmail sends,
+    # and adding up their lengths is much cheaper than serializing the
+    # whole response again to measure it
+    size = len(part.get("body", {}).get("data") or "")
+    size += sum(len(h["name"]) + len(h["value"]) for h in part.get("headers", ()))
+    return size + sum(_payload_bytes(p) for p in part.get("parts", ()))
+
+def _metadata_info(message_data):
+    headers = {h["name"].lower(): h["value"] for h in message_data.get("payload", {}).get("headers", [])}
+    return {
+        "from": headers.get("from"),
+        "subject": headers.get("subject"),
+        "sizeEstimate": message_data.get("sizeEstimate"),
+    }
+
+def _has_attachment(payload):
+    if payload.get("filename") or payload.get("body", {}).get("attachmentId"):
+        return True
+    return any(_has_attachment(part) for part in payload.get("parts", []))
+
+def fetch_report():
+    """How much was downloaded from gmail, and how long was spent waiting
+    on it, per 1000 messages listed.
+
+    The time is summed over every request, so with fetch_threads it can
+    be more than the time that actually passed.
+    """
+    stats = metrics.registry.to_dict()
+    listed = stats.get("gmail_listed_messages_total", {}).get("value", 0)
+    if not listed:
+        return "No messages listed"
+    downloaded = stats.get("gmail_downloaded_bytes_total", {}).get("value", 0)
+    seconds = sum(stats.get(name, {}).get("sum", 0) for name in _GMAIL_TIMERS)
+    skipped = stats.get("gmail_triaged_out_total", {}).get("value", 0)
+    return (
+        f"Gmail: {listed} messages listed, {skipped} skipped after reading their metadata,"
+        f" {downloaded / 1e6:.1f}MB downloaded in {seconds:.1f}s"
+        f" ({downloaded * 1000 / listed / 1e6:.2f}MB and {seconds * 1000 / listed:.1f}s per 1000 messages)"
+    )
+
 # # authorize accessing gmail.
 # # your app needs a credentials.json with access to the scopes listed above
 # # unless you get your app verified by google, you'll need to set it to test mode
@@ -0,0 +1,150 @@
+# gmail API clients that can be used from several threads at once.
+#
+# credentials are loaded from token.json once, and a background thread
+# refreshes them a few minutes before they expire, so nothing on the hot
+# path ever reads the disk or waits for a token refresh.
+#
+# googleapiclient service objects aren't thread-safe (they share one
+# httplib2 connection), so every thread gets its own service, with its
+# own keep-alive connection, built on the shared credentials.
+
+import datetime
+import os
+import threading
+
+SCOPES = [
+    # "https://www.googleapis.com/auth/gmail.compose",
+    "https://www.googleapis.com/auth/gmail.readonly",
+]
+
+DEFAULT_REFRESH_MARGIN = 300 # seconds before expiry to refresh
+_RETRY_SECONDS = 60 # wait after a failed refresh
+_CHECK_SECONDS = 600 # how often to look again when there's no expiry
+
+
+class CredentialsManager:
+    """Loads gmail credentials once and keeps them fresh in the background.
+
+    Args:
+        token_path: where the user's access and refresh tokens are kept.
+            It's created by the authorization flow the first time.
+        client_secrets_path: the app's OAuth client, used to log in when
+            there's no usable token.
+        refresh_margin: refresh this many seconds before the token expires.
+    """
+
+    def __init__(self, token_path: str = "token.json", client_secrets_path: str = "credentials.json", scopes=SCOPES, refresh_margin: float = DEFAULT_REFRESH_MARGIN):
+        self.token_path = token_path
+        self.client_secrets_path = client_secrets_path
+        self.scopes = list(scopes)
+        self.refresh_margin = refresh_margin
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self):
+        """Get valid credentials, loading them (or logging in) the first time."""
+        if self._credentials is None:
+            with self._lock:
+                if self._credentials is None:
+                    self._credentials = self._load()
+                    self._start()
+        return self._credentials
+
+    def _load(self):
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        creds = None
+        if os.path.exists(self.token_path):
+            creds = Credentials.from_authorized_user_file(self.token_path, self.scopes)
+        # If there are no (valid) credentials available, let the user log in.
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    self.client_secrets_path, self.scopes
+                )
+                creds = flow.run_local_server(port=8080)
+            self._save(creds)
+        return creds
+
+    def _save(self, creds):
+        # write then rename, so a crash never leaves half a token file
+        tmp_path = self.token_path + ".tmp"
+        with open(tmp_path, "w") as token:
+            token.write(creds.to_json())
+        os.replace(tmp_path, self.token_path)
+
+    def refresh(self):
+        """Refresh the access token now, and save it for the next run."""
+        from google.auth.transport.requests import Request
+
+        with self._lock:
+            self._credentials.refresh(Request())
+            self._save(self._credentials)
+
+    def _start(self):
+        if self._credentials.refresh_token is None:
+            # nothing to refresh with
+            return
+        self._thread = threading.Thread(target=self._refresh_loop, name="gmail-token-refresh", daemon=True)
+        self._thread.start()
+
+    def _seconds_until_refresh(self):
+        expiry = self._credentials.expiry
+        if expiry is None:
+            return _CHECK_SECONDS
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if expiry.tzinfo is None:
+            now = now.replace(tzinfo=None)
+        return max(0.0, (expiry - now).total_seconds() - self.refresh_margin)
+
+    def _refresh_loop(self):
+        wait = self._seconds_until_refresh()
+        while not self._stop.wait(wait):
+            try:
+                self.refresh()
+                wait = self._seconds_until_refresh()
+            except Exception as e:
+                print(f"Couldn't refresh gmail credentials, trying again in {_RETRY_SECONDS}s: {e}")
+                wait = _RETRY_SECONDS
+
+    def stop(self):
+        """Stop refreshing in the background."""
+        self._stop.set()
+
+
+class ServicePool:
+    """A gmail service for each thread, sharing one set of credentials.
+
+    Each service has its own httplib2 connection, which is kept alive
+    between requests, so a thread fetching a page of messages only
+    connects once.
+    """
+
+    def __init__(self, credentials: CredentialsManager = None, timeout: float = 60):
+        self.credentials = credentials or CredentialsManager()
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self):
+        """The calling thread's service, built the first time it asks."""
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = self._local.service = self._build()
+        return service
+
+    def _build(self):
+        import google_auth_httplib2
+        import httplib2
+        from googleapiclient.discovery import build
+
+        http = google_auth_httplib2.AuthorizedHttp(
+            self.credentials.get(), http=httplib2.Http(timeout=self.timeout)
+        )
+        return build("gmail", "v1", http=http, cache_discovery=False)
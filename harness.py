@@ -0,0 +1,286 @@
+# checks each new version of the extraction code generate.py gets back
+# from the LLM against every email seen so far, before accepting it.
+#
+# the LLM is told to keep handling the emails it has already seen, but
+# nothing stops it from breaking them, or from writing a regex that takes
+# seconds per email. every revision is run over the labelled corpus in a
+# separate process with time and memory limits, and is rejected if it
+# finds fewer of the known itineraries than the best version so far, or
+# if it's too slow.
+#
+# the emails go to the subprocess through a temporary file, one JSON line
+# each, so neither side builds one string of the whole corpus, and the
+# best version is only re-run when the corpus has changed since it was
+# last scored.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+DEFAULT_TIMEOUT = 60 # seconds for a whole evaluation, on top of the per email allowance
+DEFAULT_TIMEOUT_PER_EMAIL = 0.2 # seconds added to the timeout for each email in the corpus
+DEFAULT_MEMORY_MB = 1024
+DEFAULT_EMAIL_BUDGET_MS = 50 # 95th percentile time allowed per email
+DEFAULT_SLOW_RULE_MS = 10 # rules slower than this per hit get flagged
+
+
+class Corpus:
+    """The emails seen so far, labelled with whether the LLM said they were itineraries.
+
+    Only the most recent `max_size` emails are kept.
+    """
+
+    def __init__(self, max_size: int = 5000):
+        self.emails = deque(maxlen=max_size)
+        # goes up every time an email is added
+        self.version = 0
+
+    def __len__(self):
+        return len(self.emails)
+
+    def add(self, message_id, text, is_itinerary: bool):
+        self.emails.append({"id": message_id, "text": text, "is_itinerary": bool(is_itinerary)})
+        self.version += 1
+
+
+class EvaluationError(Exception):
+    pass
+
+
+def evaluate(code: str, corpus: Corpus, timeout: float = None, memory_mb: int = DEFAULT_MEMORY_MB, email_timeout: float = 2.0):
+    """Run extraction code over a corpus in a sandboxed subprocess.
+
+    Args:
+        timeout: seconds for the whole evaluation. By default
+            DEFAULT_TIMEOUT plus DEFAULT_TIMEOUT_PER_EMAIL for each email,
+            so a bigger corpus gets longer.
+
+    Returns:
+        Dict with recall, false_positives, errors, timeouts, p95_ms,
+        mean_ms and per-rule stats.
+
+    Raises:
+        EvaluationError: if the code doesn't load, or the subprocess
+            crashes or runs out of time or memory.
+    """
+    emails = list(corpus.emails)
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT + DEFAULT_TIMEOUT_PER_EMAIL * len(emails)
+
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".jsonl", delete=False) as bodies:
+        for email in emails:
+            bodies.write(json.dumps(email["text"]) + "\n")
+    request = json.dumps({
+        "code": code,
+        "email_timeout": email_timeout,
+        "bodies_path": bodies.name,
+        "memory_mb": memory_mb,
+        "cpu_seconds": int(timeout) + 1,
+    })
+    try:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker"],
+            input=request,
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+    except subprocess.TimeoutExpired:
+        raise EvaluationError(f"Evaluation of {len(emails)} emails took longer than {timeout:.0f}s")
+    finally:
+        os.unlink(bodies.name)
+    if completed.returncode != 0:
+        raise EvaluationError(
+            f"Evaluation failed with exit code {completed.returncode}: {completed.stderr.strip()[-2000:]}"
+        )
+    result = json.loads(completed.stdout)
+    if "error" in result:
+        raise EvaluationError(result["error"])
+    return _score(emails, result)
+
+
+def _score(labelled, result):
+    emails = result["emails"]
+    positives = 0
+    found = 0
+    false_positives = 0
+    for email, outcome in zip(labelled, emails):
+        if email["is_itinerary"]:
+            positives += 1
+            if outcome["detected"]:
+                found += 1
+        elif outcome["detected"]:
+            false_positives += 1
+    times = sorted(outcome["seconds"] * 1000 for outcome in emails)
+    return {
+        "recall": found / positives if positives else 1.0,
+        "found": found,
+        "positives": positives,
+        "false_positives": false_positives,
+        "errors": sum(1 for outcome in emails if outcome["error"] and outcome["error"] != "timeout"),
+        "timeouts": sum(1 for outcome in emails if outcome["error"] == "timeout"),
+        "mean_ms": sum(times) / len(times) if times else 0.0,
+        "p95_ms": times[int(0.95 * (len(times) - 1))] if times else 0.0,
+        "rules": result["rules"],
+    }
+
+
+class RegressionHarness:
+    """Keeps the best extraction code seen so far.
+
+    Args:
+        corpus: the labelled emails to check every revision against.
+        email_budget_ms: revisions whose 95th percentile time per email is
+            over this are rejected.
+        slow_rule_ms: rules that take longer than this per hit are flagged.
+    """
+
+    def __init__(self, corpus: Corpus, email_budget_ms: float = DEFAULT_EMAIL_BUDGET_MS, slow_rule_ms: float = DEFAULT_SLOW_RULE_MS, **evaluate_options):
+        self.corpus = corpus
+        self.email_budget_ms = email_budget_ms
+        self.slow_rule_ms = slow_rule_ms
+        self.evaluate_options = evaluate_options
+        self.best_code = ""
+        self.best_report = None
+        # the corpus version best_report was measured on
+        self._best_version = None
+
+    def consider(self, code: str):
+        """Evaluate a new revision and keep it if it's at least as good.
+
+        The best code is re-measured first if emails have been added to
+        the corpus since it was last scored.
+
+        Returns:
+            (accepted, report). The report is None if the code couldn't
+            be evaluated at all.
+        """
+        version = self.corpus.version
+        try:
+            report = evaluate(code, self.corpus, **self.evaluate_options)
+        except EvaluationError as e:
+            print(f"Rejected new extraction code: {e}")
+            return False, None
+        self.print_report(report)
+        self._rescore_best(version)
+        problem = self._problem(report)
+        if problem:
+            print(f"Rejected new extraction code: {problem}")
+            return False, report
+
+        self.best_code = code
+        self.best_report = report
+        self._best_version = version
+        return True, report
+
+    def replace_best(self, code: str):
+        """Swap the best code for a version that should behave the same,
+        like a compacted one.
+
+        The replacement is evaluated on the corpus like any other
+        revision, and the best code is kept if it's slower or finds fewer
+        itineraries.
+
+        Returns:
+            Whether the best code was replaced.
+        """
+        version = self.corpus.version
+        try:
+            report = evaluate(code, self.corpus, **self.evaluate_options)
+        except EvaluationError as e:
+            print(f"Kept the previous extraction code, the replacement doesn't evaluate: {e}")
+            return False
+        self._rescore_best(version)
+        problem = self._problem(report)
+        if problem:
+            print(f"Kept the previous extraction code: {problem}")
+            return False
+        self.best_code = code
+        self.best_report = report
+        self._best_version = version
+        return True
+
+    def _rescore_best(self, version):
+        """Re-evaluate the best code if the corpus has changed since its report."""
+        if not self.best_code or self._best_version == version:
+            return
+        try:
+            self.best_report = evaluate(self.best_code, self.corpus, **self.evaluate_options)
+        except EvaluationError as e:
+            print(f"The previous best code no longer evaluates: {e}")
+            self.best_report = None
+        self._best_version = version
+
+    def _problem(self, report):
+        """Why a report isn't good enough to replace the best one, or None."""
+        if report["p95_ms"] > self.email_budget_ms:
+            return f"{report['p95_ms']:.1f}ms per email is over the {self.email_budget_ms}ms budget"
+        if self.best_report and report["recall"] < self.best_report["recall"]:
+            return f"recall went from {self.best_report['recall']:.2f} to {report['recall']:.2f}"
+        return None
+
+    def print_report(self, report):
+        print(
+            f"Found {report['found']} of {report['positives']} itineraries"
+            f" (recall {report['recall']:.2f}), {report['false_positives']} false positives,"
+            f" {report['errors']} errors, {report['timeouts']} timeouts,"
+            f" {report['mean_ms']:.2f}ms mean / {report['p95_ms']:.2f}ms p95 per email"
+        )
+        for rule in report["rules"]:
+            if not rule["hits"]:
+                continue
+            per_hit_ms = 1000 * rule["seconds"] / rule["hits"]
+            slow = "  <-- slow" if per_hit_ms > self.slow_rule_ms else ""
+            markers = ", ".join(repr(m) for m in rule["markers"]) or "(no marker)"
+            print(f"  line {rule['lineno']:>4} {markers[:60]:<60} {rule['hits']:>6} hits {per_hit_ms:>8.2f}ms/hit{slow}")
+
+
+def _worker():
+    # runs in the sandboxed subprocess
+    from rules import RuleEngine
+    from sandbox import TimeLimitExceeded, time_limit
+
+    request = json.load(sys.stdin)
+    # the limits are set here rather than with preexec_fn, which isn't
+    # safe to use when the parent has other threads running
+    if os.name == "posix":
+        import resource
+        memory = request["memory_mb"] * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        cpu = request["cpu_seconds"]
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu))
+    try:
+        engine = RuleEngine(request["code"], profile=True)
+    except Exception as e:
+        json.dump({"error": f"Couldn't load the code: {type(e).__name__}: {e}"}, sys.stdout)
+        return
+
+    emails = []
+    with open(request["bodies_path"], encoding="utf-8") as bodies:
+        for line in bodies:
+            body = json.loads(line)
+            error = None
+            detected = False
+            start = time.perf_counter()
+            try:
+                with time_limit(request["email_timeout"]):
+                    detected = bool(engine.extract(body))
+            except TimeLimitExceeded:
+                error = "timeout"
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            emails.append({
+                "detected": detected,
+                "error": error,
+                "seconds": time.perf_counter() - start,
+            })
+    json.dump({"emails": emails, "rules": engine.rule_stats()}, sys.stdout)
+
+
+if __name__ == "__main__" and sys.argv[1:] == ["--worker"]:
+    _worker()
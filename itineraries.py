@@ -0,0 +1,371 @@
+# a compact columnar file of the itineraries extract.py finds, one row
+# per trip, and the questions people ask of it: where have I been, which
+# airports do I use most, how many trips a year, which routes.
+#
+# columns: id, threadId, date (when gmail received the email, seconds
+# since the epoch), origin, destination, and rule (the line of the
+# generated extractor where the rule that found the trip starts).
+#
+# a .parquet file needs pyarrow (poetry install -E parquet). origin and destination are dictionary
+# encoded, and queries are arrow group-bys. without pyarrow, use a .itab
+# file: each column is a typed array (ids as 64 bit ints, airports as
+# codes into one shared list of names), and queries count codes with
+# collections.Counter, which loops in C rather than Python.
+#
+#   python extract.py --output itineraries.parquet
+#   python itineraries.py itineraries.parquet
+
+import argparse
+import datetime
+import itertools
+import json
+import operator
+import os
+import sys
+import zlib
+from array import array
+from collections import Counter
+
+COLUMNS = ("id", "threadId", "date", "origin", "destination", "rule")
+
+_MAGIC = b"ITAB1\n"
+# stands in for None in the integer columns
+_MISSING = -1
+_DAY = 86400
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("Parquet files need pyarrow: pip install pyarrow, or write a .itab file instead")
+    return pyarrow
+
+
+def _airport(value):
+    return None if value is None else str(value)
+
+
+def _year(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).year
+
+
+def _ranked(counts):
+    """(key, count) pairs, most common first, then by key."""
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+class ParquetWriter:
+    def __init__(self, path, batch_size=10000):
+        pa = self.pa = _pyarrow()
+        airport = pa.dictionary(pa.int32(), pa.string())
+        self.schema = pa.schema([
+            ("id", pa.string()),
+            ("threadId", pa.string()),
+            ("date", pa.timestamp("s", tz="UTC")),
+            ("origin", airport),
+            ("destination", airport),
+            ("rule", pa.int32()),
+        ])
+        self.writer = pa.parquet.ParquetWriter(path, self.schema, compression="zstd")
+        self.batch_size = batch_size
+        self.pending = []
+
+    def write(self, rows):
+        self.pending.extend(rows)
+        if len(self.pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            rows = [
+                dict(row, origin=_airport(row.get("origin")), destination=_airport(row.get("destination")))
+                for row in self.pending
+            ]
+            self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+            self.pending = []
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+class ParquetTable:
+    """Queries over an itinerary parquet file, done by pyarrow."""
+
+    def __init__(self, table):
+        self.pa = _pyarrow()
+        # each row group has its own dictionary, make them one
+        self.table = table.unify_dictionaries()
+
+    @classmethod
+    def load(cls, path):
+        return cls(_pyarrow().parquet.read_table(path))
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def rows(self):
+        return iter(self.table.to_pylist())
+
+    def unique_destinations(self):
+        return sorted(d for d in self.table.column("destination").unique().to_pylist() if d is not None)
+
+    def airport_counts(self):
+        """How often each airport appears as an origin or a destination."""
+        pa = self.pa
+        airports = pa.chunked_array(
+            self.table.column("origin").cast(pa.string()).chunks
+            + self.table.column("destination").cast(pa.string()).chunks
+        )
+        return self._value_counts(airports)
+
+    def trips_per_year(self):
+        years = self.pa.compute.year(self.table.column("date"))
+        return sorted(self._value_counts(years))
+
+    def pair_counts(self):
+        """How often each (origin, destination) route was flown."""
+        table = self.table.select(["origin", "destination"]).drop_null()
+        grouped = table.group_by(["origin", "destination"]).aggregate([([], "count_all")])
+        return _ranked({
+            (origin, destination): count
+            for origin, destination, count in zip(
+                grouped.column("origin").to_pylist(),
+                grouped.column("destination").to_pylist(),
+                grouped.column("count_all").to_pylist(),
+            )
+        })
+
+    def _value_counts(self, values):
+        counts = values.drop_null().value_counts()
+        return _ranked(dict(zip(counts.field("values").to_pylist(), counts.field("counts").to_pylist())))
+
+
+class _Ids:
+    """A column of gmail ids, kept as 64 bit ints while they're all hex
+    (without leading zeros, so they come back the same)."""
+
+    def __init__(self, numbers=None, strings=None):
+        self.numbers = array("Q") if numbers is None else numbers
+        self.strings = strings
+
+    def append(self, value):
+        if self.strings is None:
+            try:
+                number = int(value, 16)
+                if format(number, "x") == value:
+                    self.numbers.append(number)
+                    return
+            except (TypeError, ValueError, OverflowError):
+                pass
+            self.strings = [format(n, "x") for n in self.numbers]
+        self.strings.append(value)
+
+    def __getitem__(self, index):
+        if self.strings is not None:
+            return self.strings[index]
+        return format(self.numbers[index], "x")
+
+
+class ItineraryTable:
+    """Itineraries held in typed arrays, one per column.
+
+    Build one by appending rows, or read one with `load`.
+    """
+
+    def __init__(self):
+        self.ids = _Ids()
+        self.thread_ids = _Ids()
+        self.dates = array("q")
+        self.origins = array("i")
+        self.destinations = array("i")
+        self.rules = array("i")
+        # airport names, shared by origins and destinations so the codes
+        # in both columns can be compared
+        self.airports = []
+        self._codes = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def _code(self, airport):
+        if airport is None:
+            return _MISSING
+        code = self._codes.get(airport)
+        if code is None:
+            code = self._codes[airport] = len(self.airports)
+            self.airports.append(airport)
+        return code
+
+    def _name(self, code):
+        return None if code == _MISSING else self.airports[code]
+
+    def append(self, row):
+        self.ids.append(row.get("id"))
+        self.thread_ids.append(row.get("threadId"))
+        date = row.get("date")
+        self.dates.append(_MISSING if date is None else int(date))
+        self.origins.append(self._code(_airport(row.get("origin"))))
+        self.destinations.append(self._code(_airport(row.get("destination"))))
+        rule = row.get("rule")
+        self.rules.append(_MISSING if rule is None else rule)
+
+    def rows(self):
+        """Iterate over the rows as dicts, like the ones appended."""
+        for i in range(len(self)):
+            yield {
+                "id": self.ids[i],
+                "threadId": self.thread_ids[i],
+                "date": None if self.dates[i] == _MISSING else self.dates[i],
+                "origin": self._name(self.origins[i]),
+                "destination": self._name(self.destinations[i]),
+                "rule": None if self.rules[i] == _MISSING else self.rules[i],
+            }
+
+    def unique_destinations(self):
+        return sorted(self.airports[code] for code in set(self.destinations) if code != _MISSING)
+
+    def airport_counts(self):
+        """How often each airport appears as an origin or a destination."""
+        counts = Counter(self.origins)
+        counts.update(self.destinations)
+        counts.pop(_MISSING, None)
+        return _ranked({self.airports[code]: count for code, count in counts.items()})
+
+    def trips_per_year(self):
+        # count days first, so only distinct days need turning into years
+        days = Counter(map(operator.floordiv, self.dates, itertools.repeat(_DAY)))
+        # a missing date is day -1; no email is from 1969
+        days.pop(_MISSING // _DAY, None)
+        years = Counter()
+        for day, count in days.items():
+            years[_year(day * _DAY)] += count
+        return sorted(years.items())
+
+    def pair_counts(self):
+        """How often each (origin, destination) route was flown."""
+        counts = Counter(zip(self.origins, self.destinations))
+        return _ranked({
+            (self.airports[origin], self.airports[destination]): count
+            for (origin, destination), count in counts.items()
+            if origin != _MISSING and destination != _MISSING
+        })
+
+    def save(self, path):
+        # ids that aren't all hex are kept as strings in the header instead
+        columns = [
+            (name, column) for name, column in (
+                ("ids", self.ids.numbers if self.ids.strings is None else None),
+                ("thread_ids", self.thread_ids.numbers if self.thread_ids.strings is None else None),
+                ("dates", self.dates),
+                ("origins", self.origins),
+                ("destinations", self.destinations),
+                ("rules", self.rules),
+            )
+            if column is not None
+        ]
+        header = json.dumps({
+            "rows": len(self),
+            "byteorder": sys.byteorder,
+            "airports": self.airports,
+            "ids": self.ids.strings,
+            "thread_ids": self.thread_ids.strings,
+            "arrays": [[name, column.typecode] for name, column in columns],
+        }).encode("utf-8")
+        compressor = zlib.compressobj(6)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_MAGIC)
+            f.write(compressor.compress(len(header).to_bytes(4, "little") + header))
+            for _, column in columns:
+                f.write(compressor.compress(column.tobytes()))
+            f.write(compressor.flush())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError(f"{path} isn't an itinerary table")
+            data = zlib.decompress(f.read())
+        header_length = int.from_bytes(data[:4], "little")
+        header = json.loads(data[4:4 + header_length])
+        offset = 4 + header_length
+        arrays = {}
+        for name, typecode in header["arrays"]:
+            column = array(typecode)
+            size = column.itemsize * header["rows"]
+            column.frombytes(data[offset:offset + size])
+            if header["byteorder"] != sys.byteorder:
+                column.byteswap()
+            arrays[name] = column
+            offset += size
+
+        table = cls()
+        table.ids = _Ids(arrays.get("ids"), header["ids"])
+        table.thread_ids = _Ids(arrays.get("thread_ids"), header["thread_ids"])
+        table.dates = arrays["dates"]
+        table.origins = arrays["origins"]
+        table.destinations = arrays["destinations"]
+        table.rules = arrays["rules"]
+        table.airports = header["airports"]
+        table._codes = {airport: code for code, airport in enumerate(table.airports)}
+        return table
+
+
+class TableWriter:
+    """Collects rows into an ItineraryTable and saves it to a .itab file on close."""
+
+    def __init__(self, path):
+        self.path = path
+        self.table = ItineraryTable()
+
+    def write(self, rows):
+        for row in rows:
+            self.table.append(row)
+
+    def close(self):
+        self.table.save(self.path)
+
+
+def open_writer(path):
+    """A writer for a .parquet or .itab file, with write(rows) and close()."""
+    if path.endswith(".parquet"):
+        return ParquetWriter(path)
+    if path.endswith(".itab"):
+        return TableWriter(path)
+    raise ValueError(f"Don't know how to write {path}, it should end in .parquet or .itab")
+
+
+def load(path):
+    """Read a .parquet or .itab file of itineraries for querying."""
+    if path.endswith(".parquet"):
+        return ParquetTable.load(path)
+    return ItineraryTable.load(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the itineraries extract.py found")
+    parser.add_argument("path", help="a .parquet or .itab file written by extract.py")
+    parser.add_argument("--top", type=int, default=20, help="how many airports and routes to show")
+    args = parser.parse_args()
+
+    table = load(args.path)
+    print(f"{len(table)} trips")
+    print(f"\nDestinations: {', '.join(table.unique_destinations())}")
+    print("\nTrips per year:")
+    for year, count in table.trips_per_year():
+        print(f"  {year}  {count}")
+    print("\nAirports:")
+    for airport, count in table.airport_counts()[:args.top]:
+        print(f"  {airport:<8} {count}")
+    print("\nRoutes:")
+    for (origin, destination), count in table.pair_counts()[:args.top]:
+        print(f"  {origin} -> {destination:<8} {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+# helpers for calling the LLM on lots of emails at once: a rate limiter
+# that respects requests-per-minute and tokens-per-minute quotas, and
+# retries with backoff when the provider says we're going too fast.
+# every call records its latency, tokens and estimated cost in metrics.
+
+import asyncio
+import random
+import time
+
+import metrics
+from tokens import count_tokens
+
+# US dollars per million (prompt, completion) tokens. models are matched
+# by the longest of these that appears in their name; anything else
+# (like a local ollama model) is counted as free.
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (5.00, 15.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gemini-1.5-flash": (0.35, 1.05),
+    "gemini-1.5-pro": (3.50, 10.50),
+}
+
+
+class RateLimiter:
+    """Token buckets for requests per minute and tokens per minute.
+
+    Either limit can be None to leave it unlimited.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute or 0
+        self._tokens = tokens_per_minute or 0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._requests = min(
+                self.requests_per_minute,
+                self._requests + elapsed * self.requests_per_minute / 60,
+            )
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self.tokens_per_minute,
+                self._tokens + elapsed * self.tokens_per_minute / 60,
+            )
+
+    def _wait_time(self, tokens):
+        wait = 0
+        if self.requests_per_minute and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute and self._tokens < tokens:
+            wait = max(wait, (tokens - self._tokens) * 60 / self.tokens_per_minute)
+        return wait
+
+    async def acquire(self, tokens: int = 0):
+        """Wait until a request using `tokens` tokens is allowed."""
+        if self.tokens_per_minute:
+            # a single prompt bigger than the whole quota has to go through
+            # eventually, so let it through once the bucket is full
+            tokens = min(tokens, self.tokens_per_minute)
+        # holding the lock while sleeping makes callers queue up in order
+        async with self._lock:
+            while True:
+                self._refill()
+                wait = self._wait_time(tokens)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.requests_per_minute:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """Guess whether an exception from an LLM client is an HTTP 429."""
+    for status in (
+        getattr(e, "status_code", None),
+        getattr(e, "code", None),
+        getattr(getattr(e, "response", None), "status_code", None),
+    ):
+        if status == 429:
+            return True
+    if type(e).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests"):
+        return True
+    message = str(e).lower()
+    return "429" in message or "rate limit" in message
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    matches = [name for name in PRICES if name in model]
+    if not matches:
+        return 0.0
+    prompt_price, completion_price = PRICES[max(matches, key=len)]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+def record_completion(llm, prompt_tokens: int, response, seconds: float):
+    """Record the latency, token counts and cost of one LLM call."""
+    model = getattr(getattr(llm, "metadata", None), "model_name", None) or ""
+    completion_tokens = count_tokens(str(response), model)
+    metrics.observe("llm_seconds", seconds)
+    metrics.observe("llm_prompt_tokens", prompt_tokens)
+    metrics.observe("llm_completion_tokens", completion_tokens)
+    metrics.inc("llm_cost_dollars_total", estimate_cost(model, prompt_tokens, completion_tokens))
+
+
+def complete(llm, prompt: str, prompt_tokens: int):
+    """Call llm.complete and record how it went."""
+    start = time.perf_counter()
+    response = llm.complete(prompt)
+    record_completion(llm, prompt_tokens, response, time.perf_counter() - start)
+    return response
+
+
+async def acomplete_with_retry(llm, prompt: str, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0, prompt_tokens: int = None, limiter: RateLimiter = None):
+    """Call llm.acomplete, backing off exponentially (with jitter) on 429s.
+
+    If `prompt_tokens` is given, the successful call is recorded in metrics.
+    If `limiter` is given, every attempt waits for it, retries included,
+    since a retry is charged against the quota like any other request.
+    """
+    attempt = 0
+    while True:
+        if limiter:
+            await limiter.acquire(prompt_tokens or 0)
+        start = time.perf_counter()
+        try:
+            response = await llm.acomplete(prompt)
+            if prompt_tokens is not None:
+                record_completion(llm, prompt_tokens, response, time.perf_counter() - start)
+            return response
+        except Exception as e:
+            if attempt >= max_retries or not is_rate_limit_error(e):
+                raise
+            metrics.inc("llm_rate_limited_total")
+            delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            print(f"Rate limited, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def complete_all(llm, prompts, concurrency: int = 8, limiter: RateLimiter = None, on_result=None, semaphore: asyncio.Semaphore = None):
+    """Run many prompts through the LLM concurrently.
+
+    Args:
+        prompts: iterable of (key, prompt, prompt token count).
+        concurrency: most requests allowed in flight at once.
+        limiter: optional RateLimiter shared by every request.
+        on_result: optional callback, called with (key, response or
+            exception) as each request finishes.
+        semaphore: optional semaphore to use instead of `concurrency`,
+            to share one limit between several calls running at once.
+
+    Returns:
+        Dict of key to response, or to the exception if the request failed.
+    """
+    semaphore = semaphore or asyncio.Semaphore(concurrency)
+
+    async def run(key, prompt, token_count):
+        async with semaphore:
+            try:
+                return key, await acomplete_with_retry(llm, prompt, prompt_tokens=token_count, limiter=limiter)
+            except Exception as e:
+                return key, e
+
+    results = {}
+    tasks = [asyncio.create_task(run(*item)) for item in prompts]
+    for task in asyncio.as_completed(tasks):
+        key, result = await task
+        results[key] = result
+        if on_result:
+            on_result(key, result)
+    return results
@@ -0,0 +1,230 @@
+# counters and histograms for every stage of the pipeline, so a slow run
+# can be blamed on gmail, MIME parsing, tokenizing or the LLM.
+#
+# instrumented code records into the module-level `registry`:
+#
+#     with metrics.timer("gmail_get_seconds"):
+#         ...
+#     metrics.observe("gmail_message_bytes", len(raw))
+#     metrics.inc("gmail_downloaded_bytes_total", len(raw))
+#
+# histograms have fixed buckets picked from the end of their name
+# (_seconds, _bytes, _chars or _tokens), so recording a value is a bisect
+# and a couple of additions. at the end of a run the scripts print a
+# summary and write everything out as JSON or Prometheus text.
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _exponential(start, factor, count):
+    return tuple(start * factor ** i for i in range(count))
+
+
+# 0.5ms to ~4 minutes
+SECONDS_BUCKETS = _exponential(0.0005, 2, 20)
+# 256 bytes to 64MB
+BYTES_BUCKETS = _exponential(256, 2, 19)
+# 16 to 1M tokens
+TOKENS_BUCKETS = _exponential(16, 2, 17)
+
+_BUCKETS_BY_SUFFIX = {
+    "_seconds": SECONDS_BUCKETS,
+    "_bytes": BYTES_BUCKETS,
+    "_chars": BYTES_BUCKETS,
+    "_tokens": TOKENS_BUCKETS,
+}
+
+
+class Counter:
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def to_dict(self):
+        return {"type": "counter", "help": self.help, "value": self.value}
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, plus their sum, min and max."""
+
+    def __init__(self, name, buckets, help=""):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # the last count is for values above the biggest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q: float):
+        """Estimate a quantile by interpolating within its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = self.buckets[index - 1] if index else self.min
+                high = self.buckets[index] if index < len(self.buckets) else self.max
+                low = max(low, self.min)
+                high = min(high, self.max)
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def to_dict(self):
+        return {
+            "type": "histogram",
+            "help": self.help,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": [[bound, count] for bound, count in zip(self.buckets, self.counts)]
+            + [["+Inf", self.counts[-1]]],
+        }
+
+
+class Metrics:
+    """A thread-safe collection of named counters and histograms.
+
+    Set `enabled` to False to make recording a no-op.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Counter(name, help)
+            return metric
+
+    def histogram(self, name: str, buckets=None, help: str = "") -> Histogram:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                if buckets is None:
+                    buckets = _default_buckets(name)
+                metric = self._metrics[name] = Histogram(name, buckets, help)
+            return metric
+
+    def inc(self, name: str, amount=1):
+        if not self.enabled:
+            return
+        metric = self._metrics.get(name) or self.counter(name)
+        with self._lock:
+            metric.value += amount
+
+    def observe(self, name: str, value):
+        if not self.enabled:
+            return
+        metric = self._metrics.get(name) or self.histogram(name)
+        with self._lock:
+            metric.observe(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Observe how long the block takes, in seconds, even if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._metrics.clear()
+
+    def to_dict(self):
+        with self._lock:
+            return {name: metric.to_dict() for name, metric in sorted(self._metrics.items())}
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for name, metric in self.to_dict().items():
+            if metric["help"]:
+                lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            if metric["type"] == "counter":
+                lines.append(f"{name} {metric['value']}")
+                continue
+            cumulative = 0
+            for bound, count in metric["buckets"]:
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum {metric['sum']}")
+            lines.append(f"{name}_count {metric['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Write every metric to `path`, as JSON if it ends in .json and Prometheus text otherwise."""
+        if path.endswith(".json"):
+            text = json.dumps(self.to_dict(), indent=2)
+        else:
+            text = self.to_prometheus()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        """Print a line per metric."""
+        for name, metric in self.to_dict().items():
+            if metric["type"] == "counter":
+                print(f"{name:<36} {_format(name, metric['value'])}")
+            elif metric["count"]:
+                print(
+                    f"{name:<36} n={metric['count']:<7} total={_format(name, metric['sum'])}"
+                    f" mean={_format(name, metric['sum'] / metric['count'])}"
+                    f" p50={_format(name, metric['p50'])} p95={_format(name, metric['p95'])}"
+                    f" max={_format(name, metric['max'])}"
+                )
+
+
+def _default_buckets(name):
+    for suffix, buckets in _BUCKETS_BY_SUFFIX.items():
+        if name.endswith(suffix) or name.endswith(suffix + "_total"):
+            return buckets
+    return SECONDS_BUCKETS
+
+
+def _format(name, value):
+    if "_seconds" in name:
+        return f"{1000 * value:.1f}ms" if value < 1 else f"{value:.2f}s"
+    if "_dollars" in name:
+        return f"${value:.4f}"
+    if isinstance(value, float) and not value.is_integer():
+        return f"{value:.1f}"
+    return f"{int(value)}"
+
+
+registry = Metrics()
+counter = registry.counter
+histogram = registry.histogram
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
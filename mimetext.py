@@ -0,0 +1,249 @@
+# pulls the readable text out of a raw RFC 822 message in one pass.
+# unlike email.message_from_bytes it never builds a tree of the whole
+# message: parts are found by searching for their boundaries, only the
+# headers of each part are parsed, and anything that isn't text (like a
+# big PDF attachment) is skipped without being decoded at all.
+#
+# extract_payload_text does the same for the already parsed message gmail
+# returns with format="full", where attachments aren't included at all.
+
+import base64
+import binascii
+import codecs
+from email.message import Message
+from email.parser import BytesHeaderParser
+from email.policy import compat32
+from html.parser import HTMLParser
+
+DEFAULT_MAX_CHARS = 200000
+
+_header_parser = BytesHeaderParser(policy=compat32)
+
+# tags whose contents are never shown to the reader
+_SKIPPED_TAGS = {"script", "style", "head", "title"}
+# tags that start a new line when rendered
+_BLOCK_TAGS = {
+    "br", "p", "div", "tr", "li", "table", "h1", "h2", "h3", "h4", "h5", "h6",
+    "td", "th", "ul", "ol", "section", "article", "header", "footer", "hr",
+}
+
+
+def extract_text(raw: bytes, max_chars: int = DEFAULT_MAX_CHARS) -> str:
+    """Extract the text of a message, preferring plain text over HTML.
+
+    Args:
+        raw: the whole message, as bytes.
+        max_chars: stop once this many characters have been extracted.
+
+    Returns:
+        The text of every text/plain part, or the text of the HTML
+        version when a part has no plain text alternative.
+    """
+    chunks = []
+    remaining = max_chars
+    for content_type, text in _iter_text_parts(raw):
+        if content_type == "text/html":
+            text = html_to_text(text, remaining)
+        text = text[:remaining]
+        chunks.append(text)
+        remaining -= len(text)
+        if remaining <= 0:
+            break
+    return "".join(chunks)
+
+
+def extract_payload_text(payload: dict, max_chars: int = DEFAULT_MAX_CHARS) -> str:
+    """Like extract_text, for the `payload` of a message fetched with format="full"."""
+    chunks = []
+    remaining = max_chars
+    for content_type, text in _iter_payload_text_parts(payload):
+        if content_type == "text/html":
+            text = html_to_text(text, remaining)
+        text = text[:remaining]
+        chunks.append(text)
+        remaining -= len(text)
+        if remaining <= 0:
+            break
+    return "".join(chunks)
+
+
+def html_to_text(html: str, max_chars: int = DEFAULT_MAX_CHARS) -> str:
+    """Turn HTML into text, stopping once `max_chars` characters are produced."""
+    parser = _TextExtractor(max_chars)
+    # feed in slices so a huge document stops being parsed as soon as
+    # we have enough text
+    for start in range(0, len(html), 65536):
+        parser.feed(html[start:start + 65536])
+        if parser.full:
+            break
+    parser.close()
+    return parser.text()[:max_chars]
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self, max_chars):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.size = 0
+        self.chunks = []
+        self.skip_depth = 0
+
+    @property
+    def full(self):
+        return self.size >= self.max_chars
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self._add("\n")
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _BLOCK_TAGS:
+            self._add("\n")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in _BLOCK_TAGS:
+            self._add("\n")
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self._add(data)
+
+    def _add(self, text):
+        if not self.full:
+            self.chunks.append(text)
+            self.size += len(text)
+
+    def text(self):
+        lines = ("".join(self.chunks)).splitlines()
+        return "\n".join(line.strip() for line in lines if line.strip())
+
+
+def _iter_text_parts(data: bytes):
+    """Yield (content type, decoded text) for each text part of a message."""
+    headers, body = _split_part(data)
+    content_type = headers.get_content_type()
+    maintype = headers.get_content_maintype()
+
+    if (headers.get("Content-Disposition") or "").strip().lower().startswith("attachment"):
+        return
+
+    if maintype == "multipart":
+        boundary = headers.get_param("boundary")
+        if not boundary:
+            return
+        parts = _split_multipart(body, boundary.encode("latin-1"))
+        if content_type == "multipart/alternative":
+            # every part says the same thing, so only read the best one
+            part = _pick_alternative(parts)
+            parts = [part] if part is not None else []
+        for part in parts:
+            yield from _iter_text_parts(part)
+    elif content_type == "message/rfc822":
+        # forwarded emails
+        yield from _iter_text_parts(body)
+    elif content_type in ("text/plain", "text/html"):
+        payload = _decode_transfer_encoding(
+            body, (headers.get("Content-Transfer-Encoding") or "").strip().lower()
+        )
+        yield content_type, _decode_charset(payload, headers.get_content_charset())
+
+
+def _iter_payload_text_parts(part: dict):
+    """Yield (content type, decoded text) for each text part of a gmail payload."""
+    headers = Message()
+    for header in part.get("headers", []):
+        if header["name"].lower() in ("content-type", "content-disposition"):
+            headers[header["name"]] = header["value"]
+    content_type = (part.get("mimeType") or headers.get_content_type()).lower()
+    body = part.get("body", {})
+
+    if part.get("filename") or body.get("attachmentId"):
+        return
+    if (headers.get("Content-Disposition") or "").strip().lower().startswith("attachment"):
+        return
+
+    if content_type.startswith("multipart/"):
+        parts = part.get("parts", [])
+        if content_type == "multipart/alternative":
+            plain = [p for p in parts if p.get("mimeType") == "text/plain"]
+            other = [p for p in parts if p.get("mimeType") == "text/html" or (p.get("mimeType") or "").startswith("multipart/")]
+            parts = (plain or other)[:1]
+        for child in parts:
+            yield from _iter_payload_text_parts(child)
+    elif content_type == "message/rfc822":
+        for child in part.get("parts", []):
+            yield from _iter_payload_text_parts(child)
+    elif content_type in ("text/plain", "text/html") and body.get("data"):
+        # gmail has already undone the transfer encoding
+        payload = base64.urlsafe_b64decode(body["data"].encode("ascii"))
+        yield content_type, _decode_charset(payload, headers.get_content_charset())
+
+
+def _split_part(data: bytes):
+    # the headers end at the first blank line
+    crlf = data.find(b"\r\n\r\n")
+    lf = data.find(b"\n\n")
+    if crlf != -1 and (lf == -1 or crlf < lf):
+        end, separator = crlf, 4
+    elif lf != -1:
+        end, separator = lf, 2
+    else:
+        return _header_parser.parsebytes(data), b""
+    return _header_parser.parsebytes(data[:end + separator]), data[end + separator:]
+
+
+def _split_multipart(body: bytes, boundary: bytes):
+    delimiter = b"--" + boundary
+    parts = []
+    start = body.find(delimiter)
+    while start != -1:
+        start += len(delimiter)
+        if body[start:start + 2] == b"--":
+            break # the closing delimiter
+        # the rest of the delimiter line is ignored
+        line_end = body.find(b"\n", start)
+        if line_end == -1:
+            break
+        end = body.find(b"\n" + delimiter, line_end)
+        if end == -1:
+            parts.append(body[line_end + 1:])
+            break
+        part_end = end - 1 if body[end - 1:end] == b"\r" else end
+        parts.append(body[line_end + 1:part_end])
+        start = end + 1
+    return parts
+
+
+def _pick_alternative(parts):
+    html = None
+    for part in parts:
+        headers, _ = _split_part(part)
+        content_type = headers.get_content_type()
+        if content_type == "text/plain":
+            return part
+        if html is None and (content_type == "text/html" or headers.get_content_maintype() == "multipart"):
+            html = part
+    return html
+
+
+def _decode_transfer_encoding(payload: bytes, encoding: str) -> bytes:
+    try:
+        if encoding == "base64":
+            return binascii.a2b_base64(payload)
+        if encoding == "quoted-printable":
+            return binascii.a2b_qp(payload)
+    except (binascii.Error, ValueError):
+        pass
+    return payload
+
+
+def _decode_charset(payload: bytes, charset) -> str:
+    try:
+        codecs.lookup(charset or "utf-8")
+    except LookupError:
+        charset = "utf-8"
+    return payload.decode(charset or "utf-8", errors="replace")
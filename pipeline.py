@@ -0,0 +1,87 @@
+# fetches pages of search results in a background thread so that
+# talking to Gmail overlaps with whatever the caller does with each page
+# (usually waiting on the LLM)
+
+import queue
+import threading
+
+# marks the end of the stream
+_DONE = object()
+
+
+class _ProducerError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def prefetch_pages(searcher, query: str, max_results=None, next_token=None, prefetch: int = 2):
+    """Iterate over every page of results for a search, fetching ahead.
+
+    A background thread follows `next_token` and keeps up to `prefetch`
+    pages waiting in a bounded queue. When the queue is full the thread
+    blocks until the caller takes a page, so memory stays bounded no
+    matter how big the mailbox is.
+
+    Only the background thread talks to `searcher`, so it must not be used
+    from anywhere else until iteration finishes.
+
+    Yields:
+        Dicts with "messages" and "next_token", as returned by
+        `GmailSearcher.search_messages`.
+    """
+    def pages():
+        token = next_token
+        while True:
+            page = searcher.search_messages(
+                query, max_results=max_results, next_token=token
+            )
+            yield page
+            token = page["next_token"]
+            if not token:
+                break
+
+    return prefetch_iter(pages(), prefetch)
+
+
+def prefetch_iter(items, depth: int = 2):
+    """Iterate over `items` while a background thread pulls ahead.
+
+    Up to `depth` items are kept waiting in a bounded queue. Exceptions
+    raised while producing an item are re-raised in the caller.
+    """
+    buffer = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def put(item):
+        # wake up every so often so an abandoned iterator doesn't leave
+        # the thread blocked forever
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_ProducerError(e))
+            return
+        put(_DONE)
+
+    producer = threading.Thread(target=produce, name="prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _ProducerError):
+                raise item.exception
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,156 @@
+# a cheap local check for whether an email could be a flight itinerary,
+# so obvious airline marketing never gets sent to the LLM.
+#
+# each email gets a score from a handful of regexes: pairs of airport
+# codes, confirmation codes, flight numbers, departure/arrival wording and
+# times, and who it's from. marketing wording counts against it. emails
+# scoring under the threshold are skipped (and printed, so you can check
+# what's being thrown away and tune the threshold).
+
+import re
+
+DEFAULT_THRESHOLD = 3
+
+# only look at the start of huge emails, the good stuff is near the top
+MAX_SCAN_CHARS = 100000
+
+# three letter words that look like airport codes but usually aren't
+_NOT_AIRPORTS = {
+    "THE", "AND", "FOR", "YOU", "ARE", "NOT", "BUT", "ALL", "ANY", "CAN", "HAS",
+    "HER", "WAS", "ONE", "OUR", "OUT", "DAY", "GET", "HIS", "HOW", "NEW", "NOW",
+    "OLD", "SEE", "TWO", "WAY", "WHO", "USD", "EUR", "GBP", "CAD", "PDF", "CSS",
+    "URL", "API", "FAQ", "OFF", "TOP", "VIP", "APP", "UTC", "PST", "EST", "PDT",
+    "EDT", "CST", "MST", "BCC", "USA",
+}
+
+_AIRPORT_PAIR = re.compile(
+    r"\b([A-Z]{3})\b\s*(?:to|-|–|—|→|->|&rarr;|=E2=86=92|>)\s*\b([A-Z]{3})\b"
+)
+_CONFIRMATION = re.compile(
+    r"(?i:confirmation(?: code| number| #)?|record locator|booking reference|reservation code|PNR)"
+    # up to three words in between, like "confirmation code is HXYZQP"
+    r"(?:\W{1,20}\w{1,20}){0,3}?\W{1,20}\b([A-Z0-9]{6})\b"
+)
+_FLIGHT_NUMBER = re.compile(r"(?i:\bflight)\s*(?:#|no\.?|number)?\s*\d{1,4}\b|\b[A-Z]{2}\s?\d{2,4}\b")
+_TIME = re.compile(r"\b\d{1,2}:\d{2}\s?(?:[AaPp]\.?[Mm]\b\.?)?")
+_TRAVEL_WORDS = re.compile(
+    r"(?i)\b(?:depart(?:s|ure|ing)?|arriv(?:e|es|al|ing)|boarding pass|gate|seat|terminal|layover|nonstop|check[- ]in)\b"
+)
+_MARKETING_WORDS = re.compile(
+    r"(?i)(?:\bsale\b|% off|\bdeals?\b|fares? from|book now|save up to|limited time|"
+    r"\bpromo(?:tion)?\b|sweepstakes|bonus miles|earn up to|don't miss)"
+)
+_FROM_HEADER = re.compile(r"(?im)^From:.*?@([\w.-]+)")
+
+# domains itineraries usually come from
+TRAVEL_DOMAINS = (
+    "alaskaair.com", "jetblue.com", "hawaiianairlines.com", "united.com",
+    "delta.com", "aa.com", "southwest.com", "britishairways.com", "aircanada.com",
+    "virginatlantic.com", "lufthansa.com", "airfrance.com", "klm.com", "qantas.com",
+    "tripit.com", "expedia.com", "kayak.com", "booking.com", "orbitz.com",
+    "priceline.com", "hopper.com",
+)
+
+
+class ItineraryPrefilter:
+    """Scores emails and decides which ones are worth sending to the LLM.
+
+    Args:
+        threshold: emails scoring below this are skipped.
+        travel_domains: sender domains that make an email more likely to
+            be an itinerary (subdomains count too).
+    """
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, travel_domains=TRAVEL_DOMAINS):
+        self.threshold = threshold
+        self.travel_domains = tuple(travel_domains)
+        self.kept = 0
+        self.skipped = 0
+
+    def score(self, text: str, sender: str = None):
+        """Score an email.
+
+        Args:
+            text: the body of the email.
+            sender: the sender's address or domain, if known. If not, it's
+                looked for in a From: header at the top of the text.
+
+        Returns:
+            (score, list of the reasons that contributed to it)
+        """
+        text = text[:MAX_SCAN_CHARS]
+        score = 0
+        reasons = []
+
+        pairs = [
+            (a, b) for a, b in _AIRPORT_PAIR.findall(text)
+            if a != b and a not in _NOT_AIRPORTS and b not in _NOT_AIRPORTS
+        ]
+        if pairs:
+            score += 2
+            reasons.append(f"airports {pairs[0][0]}-{pairs[0][1]}")
+
+        if _CONFIRMATION.search(text):
+            score += 3
+            reasons.append("confirmation code")
+
+        if _FLIGHT_NUMBER.search(text):
+            score += 1
+            reasons.append("flight number")
+
+        if _TIME.search(text):
+            score += 1
+            reasons.append("times")
+
+        travel_words = {w.lower() for w in _TRAVEL_WORDS.findall(text)}
+        if travel_words:
+            score += min(2, len(travel_words))
+            reasons.append("travel words")
+
+        marketing_words = {w.lower() for w in _MARKETING_WORDS.findall(text)}
+        if marketing_words:
+            score -= min(3, len(marketing_words))
+            reasons.append(f"marketing ({', '.join(sorted(marketing_words)[:3])})")
+
+        domain = self._sender_domain(text, sender)
+        if domain and any(
+            domain == d or domain.endswith("." + d) for d in self.travel_domains
+        ):
+            score += 1
+            reasons.append(f"from {domain}")
+
+        return score, reasons
+
+    def filter(self, messages):
+        """Drop the messages that probably aren't itineraries.
+
+        Args:
+            messages: messages as returned by GmailSearcher.search_messages.
+
+        Returns:
+            The messages that scored at least the threshold.
+        """
+        kept = []
+        for message in messages:
+            extra_info = message.get("extra_info", {})
+            score, reasons = self.score(message["text"], extra_info.get("from"))
+            if score >= self.threshold:
+                kept.append(message)
+                self.kept += 1
+            else:
+                self.skipped += 1
+                print(f"Skipping message {extra_info.get('id')} (score {score}: {', '.join(reasons) or 'nothing'})")
+        return kept
+
+    def _sender_domain(self, text, sender):
+        if sender:
+            return sender.rsplit("@", 1)[-1].strip(" >").lower()
+        match = _FROM_HEADER.search(text, 0, 20000)
+        if match:
+            return match.group(1).lower().rstrip(".")
+        return None
+
+    def report(self):
+        total = self.kept + self.skipped
+        if total:
+            print(f"Prefilter skipped {self.skipped} of {total} emails ({100 * self.skipped / total:.0f}%)")
@@ -0,0 +1,448 @@
+# looks for regexes in generated extraction code that could take
+# super-linear time on big emails, like `from ([A-Z]+).* to ([A-Z]+)` or
+# the `.*`-laden HTML patterns in sample_generated_code.py, run with
+# re.search over hundreds of KB of HTML.
+#
+# every literal pattern passed to the re module gets
+#   * a static check of its parse tree for nested quantifiers (exponential
+#     backtracking) and for unbounded quantifiers that can match the same
+#     text one after the other (polynomial backtracking)
+#   * a fuzz run against adversarial inputs of doubling length, under a
+#     time limit, to measure how its running time actually grows
+# and the results can be turned into text to show the LLM.
+#
+#   python regex_audit.py sample_generated_code.py
+
+import ast
+import math
+import string
+import sys
+import time
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError: # python < 3.11
+    import sre_parse
+    import sre_constants
+
+import re
+
+from rules import _FLAGS_POSITION, _constant_flags
+from sandbox import TimeLimitExceeded, time_limit
+
+_RE_FUNCTIONS = {"search", "match", "fullmatch", "findall", "finditer", "split", "sub", "subn", "compile"}
+_FLAGS_POSITION = dict(_FLAGS_POSITION, compile=1)
+
+# characters used to work out what a part of a pattern can match
+_PROBE = string.printable + "é→"
+# preferred characters for building inputs, most readable first
+_PREFERRED = string.ascii_letters + string.digits + " -_=.:;,/<>\"'\n\t" + _PROBE
+
+_MAXREPEAT = sre_constants.MAXREPEAT
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+_POSSESSIVE = getattr(sre_constants, "POSSESSIVE_REPEAT", None)
+
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: str.isdigit,
+    sre_constants.CATEGORY_NOT_DIGIT: lambda c: not c.isdigit(),
+    sre_constants.CATEGORY_SPACE: str.isspace,
+    sre_constants.CATEGORY_NOT_SPACE: lambda c: not c.isspace(),
+    sre_constants.CATEGORY_WORD: lambda c: c.isalnum() or c == "_",
+    sre_constants.CATEGORY_NOT_WORD: lambda c: not (c.isalnum() or c == "_"),
+}
+
+DEFAULT_MAX_LENGTH = 128000 # longest fuzz input, in characters
+DEFAULT_RUN_TIMEOUT = 2.0 # seconds allowed for one match attempt
+DEFAULT_SLOW_MS = 20 # a pattern taking longer than this at the longest input is slow
+
+
+def find_patterns(source: str):
+    """Find every literal pattern passed to the re module.
+
+    Returns:
+        List of dicts with lineno, call (e.g. "search"), pattern and flags.
+        Flags that aren't constant (like a variable) are None.
+    """
+    patterns = []
+    for node in ast.walk(ast.parse(source)):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name)
+            and node.func.value.id == "re"
+            and node.func.attr in _RE_FUNCTIONS
+            and node.args
+            and isinstance(node.args[0], ast.Constant)
+            and isinstance(node.args[0].value, str)
+        ):
+            flags_node = None
+            if len(node.args) > _FLAGS_POSITION[node.func.attr]:
+                flags_node = node.args[_FLAGS_POSITION[node.func.attr]]
+            for keyword in node.keywords:
+                if keyword.arg == "flags":
+                    flags_node = keyword.value
+            patterns.append({
+                "lineno": node.lineno,
+                "call": node.func.attr,
+                "pattern": node.args[0].value,
+                "flags": _constant_flags(flags_node),
+            })
+    patterns.sort(key=lambda p: p["lineno"])
+    return patterns
+
+
+def static_findings(pattern: str, flags: int = 0):
+    """Look for backtracking hazards in a pattern's parse tree.
+
+    Returns:
+        List of (kind, description) where kind is "exponential" or
+        "polynomial".
+    """
+    try:
+        tree = _parse(pattern, flags)
+    except re.error as e:
+        return [("invalid", str(e))]
+    findings = []
+    _walk(tree, findings, inside_repeat=False)
+    return findings
+
+
+def _parse(pattern, flags):
+    tree = list(sre_parse.parse(pattern, flags))
+    if flags & re.DOTALL:
+        tree = _dotall(tree)
+    return tree
+
+
+def _dotall(items):
+    # with re.S, `.` matches newlines too, so make it a set of everything
+    out = []
+    for op, av in items:
+        if op == sre_constants.ANY:
+            out.append((sre_constants.IN, [(sre_constants.NEGATE, None)]))
+        elif op in _REPEATS or op == _POSSESSIVE:
+            low, high, body = av
+            out.append((op, (low, high, _dotall(list(body)))))
+        elif op == sre_constants.SUBPATTERN:
+            out.append((op, av[:-1] + (_dotall(list(av[-1])),)))
+        elif op == sre_constants.BRANCH:
+            out.append((op, (av[0], [_dotall(list(branch)) for branch in av[1]])))
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            out.append((op, (av[0], _dotall(list(av[1])))))
+        elif op == getattr(sre_constants, "ATOMIC_GROUP", None):
+            out.append((op, _dotall(list(av))))
+        else:
+            out.append((op, av))
+    return out
+
+
+def _walk(items, findings, inside_repeat):
+    unbounded = [] # unbounded repeats seen so far in this sequence
+    for index, (op, av) in enumerate(items):
+        if op in _REPEATS:
+            low, high, body = av
+            body = list(body)
+            if high == _MAXREPEAT or high > 100:
+                if inside_repeat:
+                    findings.append((
+                        "exponential",
+                        f"a repeated group contains another unbounded quantifier ({_describe(body)})",
+                    ))
+                chars = _chars(body)
+                for earlier_index, earlier_chars, earlier_body in unbounded:
+                    between = items[earlier_index + 1:index]
+                    if chars & earlier_chars and _chars(between) <= earlier_chars | chars:
+                        findings.append((
+                            "polynomial",
+                            f"{_describe(earlier_body)} and {_describe(body)} can match the same text, "
+                            "so every way of splitting it between them gets tried",
+                        ))
+                        break
+                unbounded.append((index, chars, body))
+                _walk(body, findings, inside_repeat=True)
+            else:
+                _walk(body, findings, inside_repeat)
+        elif op == sre_constants.SUBPATTERN:
+            _walk(list(av[-1]), findings, inside_repeat)
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                _walk(list(branch), findings, inside_repeat)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            _walk(list(av[1]), findings, inside_repeat)
+
+
+def _chars(items):
+    """The set of probe characters any part of `items` could consume."""
+    chars = set()
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            chars.add(chr(av))
+        elif op == sre_constants.NOT_LITERAL:
+            chars.update(c for c in _PROBE if c != chr(av))
+        elif op == sre_constants.ANY:
+            chars.update(c for c in _PROBE if c != "\n")
+        elif op == sre_constants.IN:
+            chars.update(c for c in _PROBE if _in_set(av, c))
+        elif op in _REPEATS or op == _POSSESSIVE:
+            chars |= _chars(list(av[2]))
+        elif op == sre_constants.SUBPATTERN:
+            chars |= _chars(list(av[-1]))
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                chars |= _chars(list(branch))
+        elif op == getattr(sre_constants, "ATOMIC_GROUP", None):
+            chars |= _chars(list(av))
+    return chars
+
+
+def _in_set(av, c):
+    negate = False
+    matched = False
+    for op, value in av:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            matched = matched or c == chr(value)
+        elif op == sre_constants.RANGE:
+            matched = matched or value[0] <= ord(c) <= value[1]
+        elif op == sre_constants.CATEGORY:
+            test = _CATEGORIES.get(value)
+            matched = matched or bool(test and test(c))
+    return matched != negate
+
+
+def _describe(body):
+    text = _render(body, expand=None, n=1)
+    chars = _chars(body)
+    if len(chars) > 60:
+        return "a wildcard-like repeat"
+    return f"a repeat of {text!r}" if text else "an empty repeat"
+
+
+def _sample(chars):
+    for c in _PREFERRED:
+        if c in chars:
+            return c
+    return "a"
+
+
+def _render(items, expand, n, counter=None):
+    """Build a string matching `items`.
+
+    Every repeat is rendered at its minimum length (or once), except the
+    repeat numbered `expand` (counting unbounded repeats in order), which
+    is rendered `n` times.
+    """
+    if counter is None:
+        counter = [0]
+    out = []
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            out.append(chr(av))
+        elif op in (sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN):
+            out.append(_sample(_chars([(op, av)])))
+        elif op in _REPEATS or op == _POSSESSIVE:
+            low, high, body = av
+            count = max(low, 1) if high else 0
+            if high == _MAXREPEAT or high > 100:
+                if counter[0] == expand:
+                    count = max(count, n)
+                counter[0] += 1
+            out.append(_render(list(body), expand, n, counter) * count)
+        elif op == sre_constants.SUBPATTERN:
+            out.append(_render(list(av[-1]), expand, n, counter))
+        elif op == sre_constants.BRANCH:
+            out.append(_render(list(av[1][0]), expand, n, counter))
+        elif op == getattr(sre_constants, "ATOMIC_GROUP", None):
+            out.append(_render(list(av), expand, n, counter))
+    return "".join(out)
+
+
+def _count_unbounded(items):
+    count = 0
+    for op, av in items:
+        if op in _REPEATS or op == _POSSESSIVE:
+            if av[1] == _MAXREPEAT or av[1] > 100:
+                count += 1
+            count += _count_unbounded(list(av[2]))
+        elif op == sre_constants.SUBPATTERN:
+            count += _count_unbounded(list(av[-1]))
+        elif op == sre_constants.BRANCH:
+            count += _count_unbounded(list(av[1][0]))
+        elif op == getattr(sre_constants, "ATOMIC_GROUP", None):
+            count += _count_unbounded(list(av))
+    return count
+
+
+def adversarial_inputs(pattern: str, flags: int = 0):
+    """Ways of building long inputs that almost, but don't quite, match.
+
+    Returns:
+        List of (name, function from a length to an input string).
+    """
+    tree = _parse(pattern, flags)
+    # leave off the last thing the pattern needs, so the match fails at
+    # the very end after doing as much work as possible
+    prefix = tree[:-1] if len(tree) > 1 else tree
+    generators = []
+
+    once = _render(prefix, expand=None, n=1) or "a"
+    # a character the pattern can't use anywhere, to end inputs with
+    used = _chars(tree)
+    breaker = next((c for c in _PREFERRED if c not in used), "")
+
+    def repeated_prefix(length, once=once):
+        # lots of places where a match could start
+        return (once * (length // len(once) + 1))[:length]
+
+    generators.append(("repeated prefix", repeated_prefix))
+
+    for k in range(_count_unbounded(prefix)):
+        def pumped(length, k=k):
+            # one quantifier given a long run of text to chew through
+            base = len(_render(prefix, expand=k, n=1))
+            text = _render(prefix, expand=k, n=max(1, length - base))
+            return text[:length * 2] + breaker
+        generators.append((f"quantifier {k + 1} pumped", pumped))
+    return generators
+
+
+def fuzz(pattern: str, max_length: int = DEFAULT_MAX_LENGTH, run_timeout: float = DEFAULT_RUN_TIMEOUT, flags: int = 0):
+    """Time a pattern against adversarial inputs of doubling length.
+
+    Returns:
+        Dict with the worst input kind, its timings as [length, seconds]
+        pairs, the estimated growth exponent (1 is linear, 2 quadratic),
+        whether a run hit the time limit, and whether it was too slow to
+        try the longer inputs at all.
+    """
+    compiled = re.compile(pattern, flags)
+    worst = {"input": None, "timings": [], "exponent": 0.0, "timed_out": False, "stopped_early": False}
+    for name, generate in adversarial_inputs(pattern, flags):
+        timings = []
+        timed_out = False
+        stopped_early = False
+        length = 1000
+        while length <= max_length:
+            text = generate(length)
+            start = time.perf_counter()
+            try:
+                with time_limit(run_timeout):
+                    compiled.search(text)
+            except TimeLimitExceeded:
+                timed_out = True
+                timings.append([len(text), run_timeout])
+                break
+            elapsed = time.perf_counter() - start
+            timings.append([len(text), elapsed])
+            # no point waiting around for the bigger sizes
+            if elapsed > run_timeout / 4:
+                stopped_early = length * 2 <= max_length
+                break
+            length *= 2
+        exponent = _growth(timings)
+        if (timed_out, stopped_early, exponent) > (worst["timed_out"], worst["stopped_early"], worst["exponent"]):
+            worst = {"input": name, "timings": timings, "exponent": exponent, "timed_out": timed_out, "stopped_early": stopped_early}
+    return worst
+
+
+def _growth(timings):
+    # slope of log(time) against log(length) between the last two sizes
+    # that took long enough to measure
+    measurable = [(n, t) for n, t in timings if t > 0.0005]
+    if len(measurable) < 2:
+        return 1.0 if timings else 0.0
+    (n1, t1), (n2, t2) = measurable[-2], measurable[-1]
+    if n2 <= n1:
+        return 1.0
+    return max(0.0, math.log(t2 / t1) / math.log(n2 / n1))
+
+
+def audit(source: str, max_length: int = DEFAULT_MAX_LENGTH, run_timeout: float = DEFAULT_RUN_TIMEOUT, slow_ms: float = DEFAULT_SLOW_MS, cache: dict = None):
+    """Audit every regex in some generated code.
+
+    Fuzzing uses SIGALRM, so this has to run on the main thread.
+
+    Args:
+        cache: a dict to keep what was found for each pattern in, so that
+            auditing the next revision of the code only fuzzes the
+            patterns that are new. Only share one between calls with the
+            same max_length and run_timeout.
+
+    Returns:
+        List of per-pattern reports, each with lineno, call, pattern,
+        static findings, fuzz results and a verdict: "catastrophic",
+        "super-linear", "warning" or "ok".
+    """
+    try:
+        patterns = find_patterns(source)
+    except SyntaxError:
+        # nothing to audit; the harness will reject it anyway
+        return []
+    reports = []
+    seen = {} if cache is None else cache
+    for found in patterns:
+        pattern = found["pattern"]
+        # flags that aren't constant can't be known here, so go without
+        flags = found["flags"] or 0
+        if (pattern, flags) not in seen:
+            findings = static_findings(pattern, flags)
+            if any(kind == "invalid" for kind, _ in findings):
+                result = {"input": None, "timings": [], "exponent": 0.0, "timed_out": False, "stopped_early": False}
+            else:
+                result = fuzz(pattern, max_length, run_timeout, flags)
+            seen[pattern, flags] = (findings, result)
+        findings, result = seen[pattern, flags]
+        slowest = result["timings"][-1][1] * 1000 if result["timings"] else 0.0
+        if result["timed_out"]:
+            verdict = "catastrophic"
+        elif (result["exponent"] >= 1.6 or result["stopped_early"]) and slowest > slow_ms:
+            verdict = "super-linear"
+        elif findings:
+            verdict = "warning"
+        else:
+            verdict = "ok"
+        reports.append(dict(found, findings=findings, fuzz=result, slowest_ms=slowest, verdict=verdict))
+    return reports
+
+
+def is_dangerous(reports) -> bool:
+    return any(report["verdict"] in ("catastrophic", "super-linear") for report in reports)
+
+
+def format_report(reports, only_problems: bool = False) -> str:
+    """Describe the audit in plain text, for people or for the LLM."""
+    lines = []
+    for report in reports:
+        if only_problems and report["verdict"] == "ok":
+            continue
+        pattern = report["pattern"]
+        if len(pattern) > 120:
+            pattern = pattern[:117] + "..."
+        fuzz_result = report["fuzz"]
+        flags = f", {re.RegexFlag(report['flags'])!r}" if report.get("flags") else ""
+        lines.append(f"line {report['lineno']}: re.{report['call']}(r'{pattern}'{flags})")
+        lines.append(f"  verdict: {report['verdict']}")
+        for kind, description in report["findings"]:
+            lines.append(f"  {kind}: {description}")
+        if fuzz_result["timings"]:
+            length, seconds = fuzz_result["timings"][-1]
+            if fuzz_result["timed_out"]:
+                growth = "hit the time limit"
+            elif fuzz_result["stopped_early"]:
+                growth = "too slow to try longer inputs"
+            else:
+                growth = f"time grows like length^{fuzz_result['exponent']:.1f}"
+            lines.append(f"  worst input ({fuzz_result['input']}): {1000 * seconds:.1f}ms at {length} characters, {growth}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: python regex_audit.py path/to/generated_code.py")
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        reports = audit(f.read())
+    print(format_report(reports))
+    sys.exit(1 if is_dangerous(reports) else 0)
@@ -0,0 +1,380 @@
+# records the gmail API responses and LLM completions a run gets, so the
+# scripts can be run again later without a gmail account or LLM key, and
+# always get the same answers. that makes it possible to benchmark the
+# pipeline (see benchmarks/bench_pipeline.py) and compare changes fairly.
+#
+# the scripts pick the mode from environment variables:
+#   REPLAY=record   talk to gmail and the LLM as usual, saving everything
+#   REPLAY=replay   serve the saved responses, no network needed
+#   REPLAY_ARCHIVE  where to keep them (default fixtures.db)
+#   REPLAY_LATENCY  in replay mode, "recorded" to wait as long as the
+#                   original call took (the default), or a fixed number
+#                   of seconds per call, e.g. 0 to go as fast as possible
+#
+# record with an empty messages.db and responses.db, otherwise messages
+# and completions served from those never reach gmail or the LLM and
+# don't get recorded.
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import types
+import zlib
+
+from response_cache import ResponseCache
+
+DEFAULT_ARCHIVE = "fixtures.db"
+
+# gmail API methods that return another resource rather than a request
+_RESOURCES = {"users", "messages", "history", "threads", "labels"}
+
+
+class ReplayMiss(Exception):
+    """Raised when replaying a call that was never recorded."""
+
+
+class FixtureArchive:
+    """A SQLite file of recorded responses and how long each one took."""
+
+    def __init__(self, path: str = DEFAULT_ARCHIVE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS calls (
+                kind TEXT,
+                key TEXT,
+                response BLOB,
+                seconds REAL,
+                PRIMARY KEY (kind, key)
+            )
+            """
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+    def get(self, kind: str, key: str):
+        """Get (response, seconds) for a recorded call, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, seconds FROM calls WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0])), row[1]
+
+    def put(self, kind: str, key: str, response, seconds: float):
+        data = zlib.compress(json.dumps(response).encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?)", (kind, key, data, seconds)
+            )
+            self._conn.commit()
+
+    def get_meta(self, name: str, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, name: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _call_key(path, kwargs):
+    return ResponseCache.key(".".join(path), json.dumps(kwargs, sort_keys=True, default=str))
+
+
+def _describe(path, kwargs):
+    args = ", ".join(f"{k}={v!r}" for k, v in sorted(kwargs.items()))
+    return f"{'.'.join(path)}({args})"
+
+
+class _Resource:
+    """Stands in for a gmail API resource like service.users().messages()."""
+
+    def __init__(self, backend, path, real=None):
+        self._backend = backend
+        self._path = path
+        self._real = real
+
+    def _real_resource(self):
+        return self._real
+
+    def __getattr__(self, name):
+        def method(**kwargs):
+            real_resource = self._real_resource()
+            real = getattr(real_resource, name)(**kwargs) if real_resource is not None else None
+            path = self._path + (name,)
+            if name in _RESOURCES:
+                return _Resource(self._backend, path, real)
+            return _Request(self._backend, path, kwargs, real)
+        return method
+
+
+class _Request:
+    def __init__(self, backend, path, kwargs, real=None):
+        self.backend = backend
+        self.path = path
+        self.kwargs = kwargs
+        self.real = real
+        self.key = _call_key(path, kwargs)
+
+    def execute(self):
+        return self.backend.execute(self)
+
+
+class _Batch:
+    """Stands in for a BatchHttpRequest, calling `callback` for each request."""
+
+    def __init__(self, backend, callback, real_service=None):
+        self._backend = backend
+        self._callback = callback
+        self._requests = []
+        self._real_service = real_service
+
+    def add(self, request, request_id=None):
+        self._requests.append((request, request_id))
+
+    def execute(self):
+        self._backend.execute_batch(self._requests, self._callback, self._real_service)
+
+
+class RecordingService(_Resource):
+    """Wraps a real gmail service, saving every response it gets.
+
+    Args:
+        service: the service from googleapiclient.discovery.build, or a
+            function returning the service for the calling thread (like
+            GmailSearcher.thread_service).
+        archive: where to save responses.
+    """
+
+    def __init__(self, service, archive: FixtureArchive):
+        super().__init__(self, ())
+        self._service = service if callable(service) else lambda: service
+        self.archive = archive
+
+    def _real_resource(self):
+        return self._service()
+
+    def new_batch_http_request(self, callback):
+        return _Batch(self, callback, self._service())
+
+    def execute(self, request):
+        start = time.perf_counter()
+        try:
+            response = request.real.execute()
+        except Exception as e:
+            status = getattr(getattr(e, "resp", None), "status", None)
+            if status is not None:
+                self.archive.put("gmail", request.key, {"error": int(status), "content": str(e)}, time.perf_counter() - start)
+            raise
+        self.archive.put("gmail", request.key, response, time.perf_counter() - start)
+        return response
+
+    def execute_batch(self, requests, callback, real_service):
+        recorded = {}
+
+        def record(request_id, response, exception):
+            if exception is None:
+                recorded[request_id] = response
+            callback(request_id, response, exception)
+
+        batch = real_service.new_batch_http_request(callback=record)
+        keys = {}
+        for request, request_id in requests:
+            batch.add(request.real, request_id=request_id)
+            keys[request_id] = request.key
+        start = time.perf_counter()
+        batch.execute()
+        # a batch is one round trip, so share its time between the requests
+        seconds = (time.perf_counter() - start) / max(1, len(requests))
+        for request_id, response in recorded.items():
+            self.archive.put("gmail", keys[request_id], response, seconds)
+
+
+class ReplayService(_Resource):
+    """Serves recorded gmail responses in place of a real service.
+
+    Args:
+        archive: the recorded responses.
+        latency: None to wait as long as each original call took, or a
+            fixed number of seconds per call.
+    """
+
+    def __init__(self, archive: FixtureArchive, latency: float = None):
+        super().__init__(self, ())
+        self.archive = archive
+        self.latency = latency
+
+    def new_batch_http_request(self, callback):
+        return _Batch(self, callback)
+
+    def _lookup(self, request):
+        recorded = self.archive.get("gmail", request.key)
+        if recorded is None:
+            raise ReplayMiss(f"No recorded response for {_describe(request.path, request.kwargs)}")
+        return recorded
+
+    def execute(self, request):
+        response, seconds = self._lookup(request)
+        _sleep(seconds if self.latency is None else self.latency)
+        if isinstance(response, dict) and set(response) == {"error", "content"}:
+            raise _http_error(response["error"], response["content"])
+        return response
+
+    def execute_batch(self, requests, callback, real_service=None):
+        results = []
+        total = 0.0
+        for request, request_id in requests:
+            try:
+                response, seconds = self._lookup(request)
+                total += seconds
+                results.append((request_id, response, None))
+            except ReplayMiss as e:
+                results.append((request_id, None, e))
+        # a batch is one round trip
+        _sleep(total if self.latency is None else self.latency)
+        for request_id, response, exception in results:
+            callback(request_id, response, exception)
+
+
+def _sleep(seconds):
+    if seconds:
+        time.sleep(seconds)
+
+
+def _http_error(status, content):
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    return HttpError(httplib2.Response({"status": status}), content.encode("utf-8"))
+
+
+class ReplayedCompletion:
+    """What a replayed LLM call returns; prints as the completion text."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+
+class RecordingLLM:
+    """Wraps a llama_index LLM, saving every completion it returns."""
+
+    def __init__(self, llm, archive: FixtureArchive):
+        self.llm = llm
+        self.archive = archive
+        self.metadata = llm.metadata
+        archive.set_meta("model_name", llm.metadata.model_name)
+
+    def _key(self, prompt):
+        return ResponseCache.key(self.metadata.model_name, prompt)
+
+    def complete(self, prompt, **kwargs):
+        start = time.perf_counter()
+        response = self.llm.complete(prompt, **kwargs)
+        self.archive.put("llm", self._key(prompt), str(response), time.perf_counter() - start)
+        return response
+
+    async def acomplete(self, prompt, **kwargs):
+        start = time.perf_counter()
+        response = await self.llm.acomplete(prompt, **kwargs)
+        self.archive.put("llm", self._key(prompt), str(response), time.perf_counter() - start)
+        return response
+
+
+class ReplayLLM:
+    """Serves recorded completions in place of a real LLM.
+
+    Args:
+        archive: the recorded completions.
+        latency: None to wait as long as each original call took, or a
+            fixed number of seconds per call.
+    """
+
+    def __init__(self, archive: FixtureArchive, latency: float = None):
+        self.archive = archive
+        self.latency = latency
+        self.metadata = types.SimpleNamespace(model_name=archive.get_meta("model_name", "replay"))
+        self.misses = 0
+
+    def _lookup(self, prompt):
+        recorded = self.archive.get("llm", ResponseCache.key(self.metadata.model_name, prompt))
+        if recorded is None:
+            self.misses += 1
+            raise ReplayMiss(f"No recorded completion for a {len(prompt)} character prompt")
+        text, seconds = recorded
+        return ReplayedCompletion(text), seconds if self.latency is None else self.latency
+
+    def complete(self, prompt, **kwargs):
+        response, seconds = self._lookup(prompt)
+        _sleep(seconds)
+        return response
+
+    async def acomplete(self, prompt, **kwargs):
+        response, seconds = self._lookup(prompt)
+        if seconds:
+            await asyncio.sleep(seconds)
+        return response
+
+
+def mode():
+    """Return "record", "replay" or None, from the REPLAY environment variable."""
+    value = os.environ.get("REPLAY", "").strip().lower()
+    if value in ("", "off", "0"):
+        return None
+    if value not in ("record", "replay"):
+        raise ValueError(f"REPLAY should be record or replay, not {value!r}")
+    return value
+
+
+_archive = None
+
+
+def archive() -> FixtureArchive:
+    """The archive named by REPLAY_ARCHIVE, opened once."""
+    global _archive
+    if _archive is None:
+        _archive = FixtureArchive(os.environ.get("REPLAY_ARCHIVE", DEFAULT_ARCHIVE))
+    return _archive
+
+
+def _latency():
+    value = os.environ.get("REPLAY_LATENCY", "recorded").strip().lower()
+    return None if value == "recorded" else float(value)
+
+
+def install(searcher):
+    """Point a GmailSearcher at a recording or replaying service, if REPLAY is set."""
+    current = mode()
+    if current == "record":
+        searcher.service = RecordingService(searcher.thread_service, archive())
+    elif current == "replay":
+        searcher.service = ReplayService(archive(), _latency())
+
+
+def llm(make_llm):
+    """Get the LLM to use, given a function that builds the real one.
+
+    The real LLM is only built when not replaying, so replaying needs no
+    API key.
+    """
+    current = mode()
+    if current == "replay":
+        return ReplayLLM(archive(), _latency())
+    if current == "record":
+        return RecordingLLM(make_llm(), archive())
+    return make_llm()
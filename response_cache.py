@@ -0,0 +1,116 @@
+# remembers what the LLM said about each email, so re-running a script
+# over emails it has already seen (say, after a crash halfway through a
+# mailbox) doesn't pay for the same LLM calls again.
+#
+# responses are keyed by a hash of everything that went into the prompt:
+# the model, a version number for the prompt template, the extraction
+# code (for generate.py) and the email body.
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+# hash big strings a slice at a time rather than encoding them in one go
+_HASH_CHUNK_CHARS = 1 << 20
+
+
+class ResponseCache:
+    """A SQLite cache of LLM responses.
+
+    Args:
+        path: the database file.
+        ttl: seconds before a response expires, or None to keep forever.
+        max_entries: the least recently used responses are evicted past this.
+    """
+
+    def __init__(self, path: str = "responses.db", ttl: float = None, max_entries: int = 100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT,
+                created REAL,
+                last_access REAL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)"
+        )
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Hash the things a response depends on into a cache key."""
+        digest = hashlib.sha256()
+        for part in parts:
+            part = "" if part is None else str(part)
+            # prefix each part with its length so ("ab", "c") and ("a", "bc")
+            # get different keys
+            digest.update(f"{len(part)}:".encode("ascii"))
+            for start in range(0, len(part), _HASH_CHUNK_CHARS):
+                digest.update(part[start:start + _HASH_CHUNK_CHARS].encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """Get a cached response, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row and self.ttl is not None and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self._count -= 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response):
+        now = time.time()
+        with self._lock:
+            exists = self._conn.execute(
+                "SELECT 1 FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, str(response), now, now),
+            )
+            if not exists:
+                self._count += 1
+            if self._count > self.max_entries:
+                # evict a tenth at a time so we don't do this on every put
+                evict = self._count - int(self.max_entries * 0.9)
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN"
+                    " (SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+                    (evict,),
+                )
+                self._count -= evict
+            self._conn.commit()
+
+    def report(self):
+        total = self.hits + self.misses
+        if total:
+            print(f"LLM cache: {self.hits} hits, {self.misses} misses ({100 * self.hits / total:.0f}% hit rate)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,328 @@
+# runs the extraction functions that generate.py gets the LLM to write
+# (see sample_generated_code.py) over lots of emails.
+#
+# generated extractors are a long list of blocks like
+#     if 'Confirmation code' in email_body:
+#         match = re.search(r'...', email_body)
+# and every email pays for every block. RuleEngine compiles the function
+# with every regex that has a literal pattern compiled up front, and can
+# wrap each block to count how often it fires and how long it takes
+# (profile), or to say which block found each itinerary (trace). it
+# returns exactly what the original function would, at about the same
+# speed: the `in` tests and regex searches are already C loops, and
+# scanning for every marker in one pass (even with an Aho-Corasick
+# automaton in Rust) was only measured at a few percent faster.
+
+import ast
+import re
+import time
+
+DEFAULT_FUNCTION_NAME = "extract_itinerary_details"
+
+# where the flags argument goes for each function in the re module
+_FLAGS_POSITION = {
+    "search": 2,
+    "match": 2,
+    "fullmatch": 2,
+    "findall": 2,
+    "finditer": 2,
+    "split": 3,
+    "sub": 4,
+    "subn": 4,
+}
+
+_PATTERNS = "__patterns__"
+
+# wrapped around the body of each rule when profiling
+_PROFILE_TEMPLATE = """
+__rule_start__ = __clock__()
+try:
+    pass
+finally:
+    __rule_done__(RULE, __rule_start__)
+"""
+
+# wrapped around the body of each rule when tracing, to see what the
+# function's result looked like when the rule finished
+_TRACE_TEMPLATE = """
+try:
+    pass
+finally:
+    __rule_fired__(RULE, RESULT)
+"""
+
+
+class RuleEngine:
+    """A compiled version of a generated extraction function.
+
+    Each top-level `if` statement in the function is a rule. With
+    `profile` on, the engine counts how often each rule fires and how long
+    its body takes; see rule_stats(). With `trace` on, extract_traced()
+    says which rule produced each itinerary.
+
+    Args:
+        source: the Python source of the generated module.
+        function_name: the name of the extraction function in it.
+    """
+
+    def __init__(self, source: str, function_name: str = DEFAULT_FUNCTION_NAME, filename: str = "<generated>", profile: bool = False, trace: bool = False):
+        self.source = source
+        self.function_name = function_name
+        tree = ast.parse(source, filename)
+        function = _find_function(tree, function_name)
+        if function is None:
+            raise ValueError(f"No function called {function_name} in {filename}")
+        if not function.args.args:
+            raise ValueError(f"{function_name} doesn't take an email body")
+        body_arg = function.args.args[0].arg
+        result_name = _result_name(function)
+
+        rewriter = _Rewriter(rewrite_patterns=_imports_re(tree) and not _assigns(function, "re"))
+        function.body = [rewriter.visit(statement) for statement in function.body]
+        self.patterns = [re.compile(pattern, flags) for pattern, flags in rewriter.patterns]
+
+        self.rules = []
+        for statement in function.body:
+            if not isinstance(statement, ast.If):
+                continue
+            if trace:
+                statement.body = _traced(statement.body, len(self.rules), result_name)
+            if profile:
+                statement.body = _profiled(statement.body, len(self.rules))
+            self.rules.append({
+                "lineno": statement.lineno,
+                "markers": _markers(statement.test, body_arg),
+            })
+        ast.fix_missing_locations(tree)
+        self.rule_hits = [0] * len(self.rules)
+        self.rule_seconds = [0.0] * len(self.rules)
+        # (rule, length of the result) for each rule that ran, while tracing
+        self._fired = None
+
+        namespace = {
+            "__name__": "generated_extractor",
+            _PATTERNS: self.patterns,
+            "__clock__": time.perf_counter,
+            "__rule_done__": self._rule_done,
+            "__rule_fired__": self._rule_fired,
+        }
+        exec(compile(tree, filename, "exec"), namespace)
+        self._function = namespace[function_name]
+
+    @classmethod
+    def from_file(cls, path: str, function_name: str = DEFAULT_FUNCTION_NAME, **options):
+        with open(path) as f:
+            return cls(f.read(), function_name, filename=path, **options)
+
+    def extract(self, email_body):
+        return self._function(email_body)
+
+    __call__ = extract
+
+    def extract_traced(self, email_body):
+        """Extract, and work out which rule added each itinerary.
+
+        The engine must be built with `trace` on. A rule gets the credit
+        for the items the result list grew by while its body ran.
+
+        Returns:
+            (result, rules): what extract() returns, and for each item of
+            the result, the index into self.rules of the rule that added
+            it, or None if that can't be told. `rules` is None if the
+            result isn't a list.
+        """
+        self._fired = []
+        try:
+            result = self.extract(email_body)
+            fired = self._fired
+        finally:
+            self._fired = None
+        if not isinstance(result, list):
+            return result, None
+        rules = [None] * len(result)
+        done = 0
+        for rule, length in fired:
+            if length is None:
+                continue
+            for i in range(done, min(length, len(result))):
+                rules[i] = rule
+            done = max(done, length)
+        if done == 0 and len({rule for rule, _ in fired}) == 1:
+            # couldn't see the list, but only one rule could have added to it
+            rules = [fired[0][0]] * len(result)
+        return result, rules
+
+    def _rule_done(self, rule, started):
+        self.rule_hits[rule] += 1
+        self.rule_seconds[rule] += time.perf_counter() - started
+
+    def _rule_fired(self, rule, result):
+        if self._fired is not None:
+            self._fired.append((rule, len(result) if isinstance(result, list) else None))
+
+    def rule_stats(self):
+        """How often each rule fired and how long it took, when profiling."""
+        return [
+            dict(rule, hits=hits, seconds=seconds)
+            for rule, hits, seconds in zip(self.rules, self.rule_hits, self.rule_seconds)
+        ]
+
+
+class _Rewriter(ast.NodeTransformer):
+    def __init__(self, rewrite_patterns):
+        self.rewrite_patterns = rewrite_patterns
+        # (pattern, flags) -> index into the compiled patterns
+        self.patterns = {}
+
+    def visit_FunctionDef(self, node):
+        # nested functions see different variables, leave them alone
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_Lambda = visit_FunctionDef
+
+    def visit_Call(self, node):
+        node = self.generic_visit(node)
+        if not self.rewrite_patterns:
+            return node
+        func = node.func
+        if not (
+            isinstance(func, ast.Attribute)
+            and isinstance(func.value, ast.Name)
+            and func.value.id == "re"
+            and func.attr in _FLAGS_POSITION
+            and node.args
+            and isinstance(node.args[0], ast.Constant)
+            and isinstance(node.args[0].value, str)
+            and not any(isinstance(a, ast.Starred) for a in node.args)
+            and not any(k.arg is None for k in node.keywords)
+        ):
+            return node
+
+        flags_position = _FLAGS_POSITION[func.attr]
+        args = node.args[1:]
+        keywords = list(node.keywords)
+        flags_node = None
+        if len(node.args) > flags_position:
+            flags_node = node.args[flags_position]
+            args = node.args[1:flags_position] + node.args[flags_position + 1:]
+        for keyword in keywords:
+            if keyword.arg == "flags":
+                flags_node = keyword.value
+                keywords.remove(keyword)
+                break
+        flags = _constant_flags(flags_node)
+        if flags is None:
+            return node
+
+        pattern = node.args[0].value
+        try:
+            re.compile(pattern, flags)
+        except re.error:
+            # leave it to fail at the same point the original would
+            return node
+        compiled = self._compiled(pattern, flags)
+        if compiled is None:
+            return node
+        return ast.copy_location(
+            ast.Call(
+                func=ast.Attribute(value=compiled, attr=func.attr, ctx=ast.Load()),
+                args=args,
+                keywords=keywords,
+            ),
+            node,
+        )
+
+    def _compiled(self, pattern, flags):
+        """An expression for the compiled pattern, or None to leave the call alone."""
+        index = self.patterns.setdefault((pattern, flags), len(self.patterns))
+        return ast.Subscript(
+            value=ast.Name(id=_PATTERNS, ctx=ast.Load()),
+            slice=ast.Constant(value=index),
+            ctx=ast.Load(),
+        )
+
+
+def _find_function(tree, name):
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == name:
+            return node
+    return None
+
+
+def _assigns(function, name):
+    for node in ast.walk(function):
+        if isinstance(node, ast.Name) and node.id == name and not isinstance(node.ctx, ast.Load):
+            return True
+        if isinstance(node, (ast.Global, ast.Nonlocal)) and name in node.names:
+            return True
+    return False
+
+
+def _imports_re(tree):
+    for node in tree.body:
+        if isinstance(node, ast.Import) and any(a.name == "re" and a.asname is None for a in node.names):
+            return True
+    return False
+
+
+def _profiled(body, rule):
+    wrapper = ast.parse(_PROFILE_TEMPLATE.replace("RULE", str(rule))).body
+    wrapper[1].body = body
+    return wrapper
+
+
+def _traced(body, rule, result_name):
+    result = f"locals().get({result_name!r})" if result_name else "None"
+    wrapper = ast.parse(_TRACE_TEMPLATE.replace("RULE", str(rule)).replace("RESULT", result)).body
+    wrapper[0].body = body
+    return wrapper
+
+
+def _result_name(function):
+    """The variable the function ends with `return <name>` of, if it does."""
+    if function.body and isinstance(function.body[-1], ast.Return):
+        value = function.body[-1].value
+        if isinstance(value, ast.Name):
+            return value.id
+    return None
+
+
+def _markers(node, body_arg):
+    """The strings a rule's test looks for, in `'marker' in email_body` or
+    `'marker' in email_body.lower()`."""
+    markers = []
+    for child in ast.walk(node):
+        if not (
+            isinstance(child, ast.Compare)
+            and len(child.ops) == 1
+            and isinstance(child.ops[0], ast.In)
+            and isinstance(child.left, ast.Constant)
+            and isinstance(child.left.value, str)
+        ):
+            continue
+        target = child.comparators[0]
+        if isinstance(target, ast.Call) and not target.args and isinstance(target.func, ast.Attribute) and target.func.attr == "lower":
+            target = target.func.value
+        if isinstance(target, ast.Name) and target.id == body_arg and child.left.value not in markers:
+            markers.append(child.left.value)
+    return markers
+
+
+def _constant_flags(node):
+    """Evaluate a flags argument like `re.I | re.S`, or None if it isn't constant."""
+    if node is None:
+        return 0
+    for child in ast.walk(node):
+        if isinstance(child, (ast.Expression, ast.BinOp, ast.BitOr, ast.Constant, ast.Load)):
+            continue
+        if isinstance(child, ast.Attribute) and isinstance(child.value, ast.Name) and child.value.id == "re":
+            continue
+        if isinstance(child, ast.Name) and child.id == "re":
+            continue
+        return None
+    try:
+        flags = eval(compile(ast.Expression(body=node), "<flags>", "eval"), {"re": re})
+    except Exception:
+        return None
+    return flags if isinstance(flags, (int, re.RegexFlag)) else None
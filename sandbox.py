@@ -0,0 +1,33 @@
+# limits for running code the LLM wrote, which can hang on a regex with
+# catastrophic backtracking
+
+import contextlib
+import signal
+
+
+class TimeLimitExceeded(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    """Raise TimeLimitExceeded if the block runs for longer than `seconds`.
+
+    Uses SIGALRM, so it only works in the main thread, on POSIX systems.
+    The re module checks for signals while matching, so this does stop
+    runaway regexes. A falsy `seconds` means no limit.
+    """
+    if not seconds:
+        yield
+        return
+
+    def handler(signum, frame):
+        raise TimeLimitExceeded(f"Took longer than {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
@@ -0,0 +1,220 @@
+# a local on-disk cache of downloaded messages, so repeated runs over the
+# same mailbox don't have to download and decode every email again.
+# emails don't change once delivered so entries never go stale, they are
+# only evicted (least recently used first) to keep the file under a size cap
+#
+# entries are keyed by message and the extractor that pulled the text out
+# (see GmailSearcher.extractor), and lookups only return entries from the
+# one asked for, so changing parsers never mixes two kinds of text, and
+# scripts using different parsers can share a store without overwriting
+# each other. messages that had no text are kept as entries without a
+# body, so they aren't downloaded again either.
+
+import sqlite3
+import threading
+import time
+import zlib
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024 # 1GB of compressed bodies
+
+_CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT,
+    thread_id TEXT,
+    snippet TEXT,
+    body BLOB,
+    size INTEGER,
+    last_access REAL,
+    date INTEGER,
+    extractor TEXT,
+    skipped TEXT,
+    PRIMARY KEY (id, extractor)
+)
+"""
+
+
+class MessageStore:
+    def __init__(self, path: str = "messages.db", max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        # the searcher may be driven from a background thread (see pipeline.py)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(_CREATE_TABLE)
+        # stores made before these columns were added. their entries have no
+        # extractor, so they're never returned and get downloaded again
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(messages)")]
+        for column, kind in (("date", "INTEGER"), ("extractor", "TEXT"), ("skipped", "TEXT")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE messages ADD COLUMN {column} {kind}")
+        # and stores keyed by message id alone, which only had room for
+        # one extractor's text
+        key = [row[1] for row in self._conn.execute("PRAGMA table_info(messages)") if row[5]]
+        if key == ["id"]:
+            self._rekey()
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS messages_last_access ON messages (last_access)"
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM messages"
+        ).fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def __contains__(self, message_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM messages WHERE id = ?", (message_id,)
+            ).fetchone()
+        return row is not None
+
+    def get_many(self, message_ids, extractor: str = None):
+        """Look up several messages at once.
+
+        Args:
+            extractor: only return messages whose text was extracted this
+                way. None returns them whatever extracted them.
+
+        Returns:
+            Dict of message id to message data (id, threadId, snippet, date,
+            body) for the ids that are in the store. Missing ids are left
+            out. Messages that were skipped have "skipped" (why, like
+            "empty") instead of a body.
+        """
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+        found = {}
+        with self._lock:
+            # stay well under sqlite's limit on query parameters
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                query = f"SELECT id, thread_id, snippet, date, body, skipped FROM messages WHERE id IN ({placeholders})"
+                if extractor is not None:
+                    query += " AND extractor = ?"
+                    chunk = chunk + [extractor]
+                for row in self._conn.execute(query, chunk).fetchall():
+                    found[row[0]] = _message_data(*row)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE messages SET last_access = ? WHERE id = ? AND (? IS NULL OR extractor = ?)",
+                    [(now, message_id, extractor, extractor) for message_id in found],
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, messages_data, extractor: str = None):
+        """Add message data dicts (as returned by get_message_data) to the store.
+
+        A dict with "skipped" instead of a body is stored as a message
+        that shouldn't be downloaded again.
+
+        Args:
+            extractor: how the text of the messages was extracted.
+        """
+        now = time.time()
+        rows = []
+        for message_data in messages_data:
+            skipped = message_data.get("skipped")
+            body = None if skipped else zlib.compress(message_data["body"].encode("utf-8"))
+            rows.append((
+                message_data["id"],
+                message_data.get("threadId"),
+                message_data.get("snippet"),
+                body,
+                len(body) if body else 0,
+                now,
+                message_data.get("date"),
+                extractor,
+                skipped,
+            ))
+        if not rows:
+            return
+        with self._lock:
+            for row in rows:
+                previous = self._conn.execute(
+                    "SELECT size FROM messages WHERE id = ? AND extractor IS ?", (row[0], row[7])
+                ).fetchone()
+                if previous:
+                    self._total_bytes -= previous[0]
+                self._total_bytes += row[4]
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO messages (id, thread_id, snippet, body, size, last_access, date, extractor, skipped)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._evict()
+            self._conn.commit()
+
+    def iter_messages(self, batch_size: int = 500, extractor: str = None):
+        """Iterate over every message with a body in the store, in no particular order.
+
+        Args:
+            extractor: only messages whose text was extracted this way.
+        """
+        last_id = ""
+        query = "SELECT id, thread_id, snippet, date, body, skipped FROM messages WHERE id > ? AND body IS NOT NULL"
+        if extractor is not None:
+            query += " AND extractor = ?"
+        query += " ORDER BY id LIMIT ?"
+        while True:
+            parameters = (last_id, extractor, batch_size) if extractor is not None else (last_id, batch_size)
+            with self._lock:
+                rows = self._conn.execute(query, parameters).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield _message_data(*row)
+            last_id = rows[-1][0]
+
+    def _evict(self):
+        # drop the least recently used messages until we're comfortably
+        # under the cap, so we don't evict on every single insert
+        if self._total_bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        cursor = self._conn.execute(
+            "SELECT id, extractor, size FROM messages ORDER BY last_access"
+        )
+        evicted = []
+        for message_id, extractor, size in cursor:
+            if self._total_bytes <= target:
+                break
+            evicted.append((message_id, extractor))
+            self._total_bytes -= size
+        cursor.close()
+        self._conn.executemany("DELETE FROM messages WHERE id = ? AND extractor IS ?", evicted)
+
+    def _rekey(self):
+        # sqlite can't change a table's primary key, so copy it into a new one
+        self._conn.execute("ALTER TABLE messages RENAME TO messages_by_id")
+        self._conn.execute("DROP INDEX IF EXISTS messages_last_access")
+        self._conn.execute(_CREATE_TABLE)
+        self._conn.execute(
+            "INSERT INTO messages (id, thread_id, snippet, body, size, last_access, date, extractor, skipped)"
+            " SELECT id, thread_id, snippet, body, size, last_access, date, extractor, skipped FROM messages_by_id"
+        )
+        self._conn.execute("DROP TABLE messages_by_id")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _message_data(message_id, thread_id, snippet, date, body, skipped):
+    message_data = {
+        "id": message_id,
+        "threadId": thread_id,
+        "snippet": snippet,
+        "date": date,
+    }
+    if skipped:
+        message_data["skipped"] = skipped
+    else:
+        message_data["body"] = zlib.decompress(body).decode("utf-8")
+    return message_data
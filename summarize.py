@@ -1,45 +1,73 @@
 import dotenv
 dotenv.load_dotenv()
 
+import asyncio
+from collections import deque
+
 # llamaindex deps
 from llama_index.core import Settings
 from llama_index.llms.openai import OpenAI
 from llama_index.llms.gemini import Gemini
-import tiktoken
 # from llama_index.core.agent import ReActAgent
 # from llama_index.tools.google import GmailToolSpec
 
-from gmail import GmailSearcher
+import metrics
+from gmail import GmailSearcher, SyncCheckpoint
+from llm import RateLimiter, complete, complete_all
+from pipeline import prefetch_iter
+from prefilter import ItineraryPrefilter
+import replay
+from response_cache import ResponseCache
+from store import MessageStore
+from tokens import fit_prompt
 
 searcher = GmailSearcher()
+# keep downloaded emails on disk so re-runs don't fetch them again
+searcher.store = MessageStore("messages.db")
+# set REPLAY=record to save everything gmail and the LLM send back, and
+# REPLAY=replay to run from the saved copy offline (see replay.py)
+replay.install(searcher)
 
 # dotenv is taking care of the OpenAI API key for us
 #MODEL = "gpt-4o"
 MODEL = "gpt-3.5-turbo"
-Settings.llm = OpenAI(model=MODEL)
+Settings.llm = replay.llm(lambda: OpenAI(model=MODEL))
 
 # Settings.llm = Gemini(
 #     model="models/gemini-1.5-pro-latest",
 #     temperature=0.1
 # )
 
-def sliceUntilFits(string, max_tokens):
-    enc = tiktoken.encoding_for_model(MODEL)
-    while True:
-        encoded = enc.encode(string)    
-        print(f"Number of tokens: {len(encoded)}")
-        if len(encoded) > max_tokens:
-            print("Message too long, slicing it down")
-            string = string[-10000:] # slice off the last 10000 characters
-        else:
-            return string
+# send lots of emails to the LLM at once rather than waiting for each one.
+# set USE_ASYNC to False to go back to one at a time.
+USE_ASYNC = True
+CONCURRENCY = 8 # requests in flight at once
+# pages being summarized at once, so the next page's emails go out while
+# the slowest answers for this one are still coming back
+PAGES_IN_FLIGHT = 2
+# keep these under your account's quota so we slow down instead of
+# getting rate limited (429s are still retried with backoff)
+limiter = RateLimiter(requests_per_minute=500, tokens_per_minute=200000)
 
+# most emails matching the search are airline spam, so skip the ones that
+# obviously aren't itineraries without asking the LLM. lower the threshold
+# if real itineraries are being skipped.
+prefilter = ItineraryPrefilter(threshold=3)
 
-def summarizeMessages(messages):
-    for message in messages:
-        print("Handling a message")
-        print(message['extra_info'])
-        instructions = f"""
+# remember the LLM's answer for every email so re-runs don't pay for it again.
+# bump PROMPT_VERSION whenever you change the prompt below.
+PROMPT_VERSION = 1
+cache = ResponseCache("responses.db")
+
+# timings, sizes, tokens and LLM cost for every stage are written here at
+# the end (Prometheus text format, or JSON if the name ends in .json)
+METRICS_FILE = "metrics.prom"
+
+def cacheKey(message):
+    return ResponseCache.key(Settings.llm.metadata.model_name, PROMPT_VERSION, message['text'])
+
+def buildPrompt(message):
+    instructions = f"""
             Attached is the body of an email message. If the email is a flight itinerary, summarize the origin and destination of the flight in JSON, like this:
             {{
                 isItinerary: true,
@@ -54,23 +82,108 @@ def summarizeMessages(messages):
             
             Message is below this line:
             ------------
-            {message['text']}
             """
-        # openai has a maximum string length it can handle
-        instructions = sliceUntilFits(instructions, 128000)
-        response = Settings.llm.complete(instructions)
+    # openai has a maximum string length it can handle
+    return fit_prompt(instructions, message['text'], 128000, MODEL)
+
+def summarizeMessages(messages):
+    for message in messages:
+        print("Handling a message")
+        print(message['extra_info'])
+        key = cacheKey(message)
+        response = cache.get(key)
+        if response is None:
+            instructions, token_count = buildPrompt(message)
+            print(f"Number of tokens: {token_count}")
+            response = complete(Settings.llm, instructions, token_count)
+            cache.put(key, response)
         print(response)
 
-next_token = None
-while True:
-    # TODO: get the LLM to think of good searches
-    messageResults = searcher.search_messages(
-        "your flight itinerary", 
-        max_results=2, 
-        next_token=next_token
-    )
-    summarizeMessages(messageResults['messages'])
-    if messageResults['next_token']:
-        next_token = messageResults['next_token']
-    else:
-        break
+# the same thing, but with all the messages in flight at once. responses
+# are printed as they arrive, in whatever order the LLM finishes them, and
+# then all together in message order once the whole page is done.
+# returns the ids of the messages that couldn't be summarized
+async def asummarizeMessages(messages, semaphore=None):
+    keys = {}
+    prompts = []
+    responses = {}
+    for message in messages:
+        message_id = message['extra_info']['id']
+        keys[message_id] = cacheKey(message)
+        cached = cache.get(keys[message_id])
+        if cached is not None:
+            print(f"Message {message_id}:")
+            print(cached)
+            responses[message_id] = cached
+            continue
+        instructions, token_count = buildPrompt(message)
+        prompts.append((message_id, instructions, token_count))
+
+    def printResult(message_id, response):
+        if isinstance(response, Exception):
+            print(f"Error summarizing message {message_id}: {response}")
+            return
+        cache.put(keys[message_id], response)
+        print(f"Message {message_id}:")
+        print(response)
+
+    responses.update(await complete_all(
+        Settings.llm, prompts, concurrency=CONCURRENCY, limiter=limiter, on_result=printResult, semaphore=semaphore
+    ))
+
+    if responses:
+        print("This page in message order:")
+    failed = []
+    for message in messages:
+        message_id = message['extra_info']['id']
+        response = responses[message_id]
+        if isinstance(response, Exception):
+            failed.append(message_id)
+            print(f"Message {message_id}: error: {response}")
+        else:
+            print(f"Message {message_id}: {response}")
+    return failed
+
+async def asummarizePages(pages):
+    # shared by every page, so CONCURRENCY is the limit across all of them
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    inFlight = deque()
+    while True:
+        # getting the next page can block, so don't do it on the event loop
+        messageResults = await asyncio.to_thread(next, pages, None)
+        if messageResults is not None:
+            task = asyncio.create_task(asummarizeMessages(prefilter.filter(messageResults['messages']), semaphore))
+            inFlight.append((messageResults, task))
+        # pages are checkpointed in order, so a restart never skips one.
+        # messages that failed are tried again on the next run
+        while inFlight and (messageResults is None or len(inFlight) >= PAGES_IN_FLIGHT or inFlight[0][1].done()):
+            page, task = inFlight.popleft()
+            failed = await task
+            checkpoint.page_done(page, failed)
+        if messageResults is None:
+            break
+
+# only emails that arrived since the last run are summarized, and an
+# interrupted run picks up where it left off
+checkpoint = SyncCheckpoint("sync_checkpoint.json")
+
+# the next few pages are fetched from gmail while the LLM works on this one
+# TODO: get the LLM to think of good searches
+pages = prefetch_iter(
+    searcher.sync_messages(
+        "your flight itinerary",
+        checkpoint,
+        max_results=25 if USE_ASYNC else 2
+    ),
+    4
+)
+if USE_ASYNC:
+    asyncio.run(asummarizePages(pages))
+else:
+    for messageResults in pages:
+        summarizeMessages(prefilter.filter(messageResults['messages']))
+        checkpoint.page_done(messageResults)
+prefilter.report()
+cache.report()
+metrics.registry.summary()
+metrics.registry.write(METRICS_FILE)
@@ -0,0 +1,77 @@
+import ast
+
+from compact import compact
+
+# setting a key is the same whether one rule fires or both, so merges of
+# these rules keep the output the same
+SETS_KEYS = '''import re
+
+def extract_itinerary_details(body):
+    details = {}
+    if "JetBlue" in body:
+        details["airline"] = "JetBlue"
+    if "Alaska Airlines" in body:
+        details["airline"] = "Alaska"
+    if "jetblue.com" in body:
+        details["airline"] = "JetBlue"
+    return [details] if details else []
+'''
+
+# each rule adds its own itinerary, so merging two that both fire on an
+# email loses one
+APPENDS = '''import re
+
+def extract_itinerary_details(body):
+    itineraries = []
+    if "JetBlue" in body:
+        itineraries.append({"origin": "JFK"})
+    if "jetblue.com" in body:
+        itineraries.append({"origin": "JFK"})
+    return itineraries
+'''
+
+SUBSUMED = '''import re
+
+def extract_itinerary_details(body):
+    details = {}
+    if "JetBlue" in body:
+        details["airline"] = "JetBlue"
+    if "JetBlue" in body and "Itinerary" in body:
+        details["airline"] = "JetBlue"
+    return [details] if details else []
+'''
+
+TEXTS = [
+    "Your JetBlue Itinerary, see jetblue.com",
+    "Alaska Airlines confirmation",
+    "Book now at jetblue.com",
+    "Nothing to see here",
+]
+
+
+def rule_tests(source):
+    function = ast.parse(source).body[-1]
+    return [ast.unparse(statement.test) for statement in function.body if isinstance(statement, ast.If)]
+
+
+def test_rules_with_the_same_body_are_merged():
+    compacted, report = compact(SETS_KEYS, TEXTS)
+
+    assert report["rules_before"] == 3
+    assert report["rules_after"] == 2
+    assert rule_tests(compacted) == ["'JetBlue' in body or 'jetblue.com' in body", "'Alaska Airlines' in body"]
+
+
+def test_merges_that_change_the_output_are_rejected():
+    compacted, report = compact(APPENDS, TEXTS)
+
+    assert report["merged"] == []
+    assert report["rejected"] == 1
+    assert compacted == APPENDS
+
+
+def test_a_test_subsumed_by_another_is_dropped():
+    compacted, report = compact(SUBSUMED, TEXTS)
+
+    assert report["rules_after"] == 1
+    assert rule_tests(compacted) == ["'JetBlue' in body"]
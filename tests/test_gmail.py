@@ -0,0 +1,204 @@
+import base64
+
+import pytest
+
+import metrics
+from gmail import GmailSearcher
+from replay import FixtureArchive, ReplayService, _call_key
+
+GET = ("users", "messages", "get")
+
+
+def raw_message(message_id, text):
+    source = (
+        f"From: Alaska Airlines <info@ifly.alaskaair.com>\r\n"
+        f"Subject: Your trip {message_id}\r\n"
+        f"Content-Type: text/plain; charset=utf-8\r\n"
+        f"\r\n"
+        f"{text}\r\n"
+    )
+    return {
+        "id": message_id,
+        "threadId": f"thread-{message_id}",
+        "snippet": text[:20],
+        "internalDate": "1700000000000",
+        "raw": base64.urlsafe_b64encode(source.encode("utf-8")).decode("ascii"),
+    }
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = FixtureArchive(str(tmp_path / "fixtures.db"))
+    yield archive
+    archive.close()
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.registry.reset()
+    yield
+    metrics.registry.reset()
+
+
+def record(archive, response, **kwargs):
+    archive.put("gmail", _call_key(GET, dict(userId="me", **kwargs)), response, 0.0)
+
+
+def batched_searcher(archive):
+    searcher = GmailSearcher()
+    searcher.service = ReplayService(archive, latency=0)
+    searcher.use_batch_requests = True
+    searcher.use_streaming_parser = True
+    searcher.batch_size = 2
+    return searcher
+
+
+def test_batched_fetch_skips_messages_that_fail(archive, capsys):
+    for message_id in ("a", "c", "d"):
+        record(archive, raw_message(message_id, f"Confirmation code ABC12{message_id}"), id=message_id, format="raw")
+    # b was never recorded, so its part of the batch fails
+    messages = [{"id": message_id} for message_id in ("a", "b", "c", "d")]
+
+    results = batched_searcher(archive).get_messages_data(messages)
+
+    assert [m["id"] for m in results] == ["a", "c", "d"]
+    assert "Confirmation code ABC12c" in results[1]["body"]
+    assert results[0]["date"] == 1700000000
+    assert "Can't get message data for b" in capsys.readouterr().out
+
+
+def test_batched_fetch_skips_messages_that_cant_be_parsed(archive, capsys):
+    record(archive, raw_message("a", "Your flight from SEA to SFO"), id="a", format="raw")
+    # no raw body to decode
+    record(archive, {"id": "b", "threadId": "thread-b", "snippet": ""}, id="b", format="raw")
+
+    results = batched_searcher(archive).get_messages_data([{"id": "a"}, {"id": "b"}])
+
+    assert [m["id"] for m in results] == ["a"]
+    assert "Can't parse message b" in capsys.readouterr().out
+
+
+def test_messages_without_text_are_not_downloaded_again(archive, tmp_path):
+    from store import MessageStore
+
+    record(archive, raw_message("a", "Your flight from SEA to SFO"), id="a", format="raw")
+    record(archive, raw_message("b", ""), id="b", format="raw")
+    searcher = batched_searcher(archive)
+    searcher.store = MessageStore(str(tmp_path / "messages.db"))
+
+    assert [m["id"] for m in searcher.get_messages_data([{"id": "a"}, {"id": "b"}])] == ["a"]
+    downloaded = metrics.registry.to_dict()["gmail_downloaded_bytes_total"]["value"]
+    assert [m["id"] for m in searcher.get_messages_data([{"id": "a"}, {"id": "b"}])] == ["a"]
+    assert metrics.registry.to_dict()["gmail_downloaded_bytes_total"]["value"] == downloaded
+    assert searcher.store.get_many(["b"], searcher.extractor)["b"]["skipped"] == "empty"
+    searcher.store.close()
+
+
+def test_fetching_one_at_a_time_skips_messages_that_fail(archive, capsys):
+    for message_id in ("a", "c"):
+        full = {
+            "id": message_id,
+            "threadId": f"thread-{message_id}",
+            "snippet": "",
+            "sizeEstimate": 1000,
+            "payload": {
+                "mimeType": "text/plain",
+                "headers": [{"name": "From", "value": "info@ifly.alaskaair.com"}],
+                "body": {"data": base64.urlsafe_b64encode(b"Confirmation code HXYZQP").decode("ascii")},
+            },
+        }
+        record(archive, full, id=message_id, format="full")
+    searcher = GmailSearcher()
+    searcher.service = ReplayService(archive, latency=0)
+    searcher.two_phase = True
+    searcher.fetch_threads = 2
+
+    results = searcher.get_messages_data([{"id": "a"}, {"id": "b"}, {"id": "c"}])
+
+    assert [m["id"] for m in results] == ["a", "c"]
+    assert results[0]["body"] == "Confirmation code HXYZQP"
+    assert results[0]["from"] == "info@ifly.alaskaair.com"
+    assert "Can't get message data for b" in capsys.readouterr().out
+
+
+def test_sync_retries_messages_that_failed_last_time(archive, tmp_path):
+    from gmail import SyncCheckpoint
+
+    for message_id in ("a", "b"):
+        record(archive, raw_message(message_id, f"Confirmation code ABC12{message_id}"), id=message_id, format="raw")
+    # the rest of the search comes back empty
+    search = dict(userId="me", q="your flight itinerary", maxResults=10, pageToken=None)
+    archive.put("gmail", _call_key(("users", "messages", "list"), search), {}, 0.0)
+    checkpoint = SyncCheckpoint(str(tmp_path / "checkpoint.json"))
+    checkpoint.reset("your flight itinerary")
+    checkpoint.start_crawl("your flight itinerary", "100")
+    checkpoint.page_done({"messages": [], "next_token": None}, failed=["a", "b"])
+    assert checkpoint.crawl is None
+    checkpoint.start_crawl("your flight itinerary", "200")
+    searcher = batched_searcher(archive)
+
+    pages = list(searcher.sync_messages("your flight itinerary", SyncCheckpoint(checkpoint.path)))
+
+    assert pages[0]["retry"]
+    assert [m["extra_info"]["id"] for m in pages[0]["messages"]] == ["a", "b"]
+    assert pages[1]["messages"] == []
+    checkpoint = SyncCheckpoint(checkpoint.path)
+    checkpoint.page_done(pages[0], failed=["b"])
+    assert SyncCheckpoint(checkpoint.path).failed == ["b"]
+
+
+def test_messages_triage_skipped_are_checked_again(archive, tmp_path):
+    from gmail import METADATA_HEADERS
+    from store import MessageStore
+
+    class Triage:
+        def __init__(self, keep):
+            self.keep_all = keep
+
+        def keep(self, info):
+            return self.keep_all, "not like past hits"
+
+    headers = [{"name": "From", "value": "info@ifly.alaskaair.com"}]
+    full = {
+        "id": "a",
+        "threadId": "thread-a",
+        "snippet": "",
+        "sizeEstimate": 1000,
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": headers,
+            "body": {"data": base64.urlsafe_b64encode(b"Confirmation code HXYZQP").decode("ascii")},
+        },
+    }
+    metadata = {"id": "a", "threadId": "thread-a", "sizeEstimate": 1000, "payload": {"headers": headers}}
+    record(archive, metadata, id="a", format="metadata", metadataHeaders=METADATA_HEADERS)
+    record(archive, full, id="a", format="full")
+    searcher = GmailSearcher()
+    searcher.service = ReplayService(archive, latency=0)
+    searcher.two_phase = True
+    searcher.store = MessageStore(str(tmp_path / "messages.db"))
+
+    searcher.triage = Triage(False)
+    assert searcher.get_messages_data([{"id": "a"}]) == []
+    # the history has learned more since, and now wants it
+    searcher.triage = Triage(True)
+    assert [m["id"] for m in searcher.get_messages_data([{"id": "a"}])] == ["a"]
+    searcher.store.close()
+
+
+@pytest.mark.parametrize("fetch_threads", [1, 2])
+def test_unbatched_raw_fetch_skips_messages_that_fail(archive, capsys, fetch_threads):
+    record(archive, raw_message("a", "Your flight from SEA to SFO"), id="a", format="raw")
+    # b was never recorded, and c has no raw body to decode
+    record(archive, {"id": "c", "threadId": "thread-c", "snippet": ""}, id="c", format="raw")
+    searcher = GmailSearcher()
+    searcher.service = ReplayService(archive, latency=0)
+    searcher.use_streaming_parser = True
+    searcher.fetch_threads = fetch_threads
+
+    results = searcher.get_messages_data([{"id": "a"}, {"id": "b"}, {"id": "c"}])
+
+    assert [m["id"] for m in results] == ["a"]
+    output = capsys.readouterr().out
+    assert "Can't get message data for b" in output
+    assert "Can't parse message c" in output
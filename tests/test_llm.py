@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import llm
+import metrics
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+class FlakyLLM:
+    """Says it's rate limited `failures` times, then answers."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    async def acomplete(self, prompt):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RateLimited("429 Too Many Requests")
+        return f"response to {prompt}"
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.acquired = []
+
+    async def acquire(self, tokens=0):
+        self.acquired.append(tokens)
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.registry.reset()
+    yield
+    metrics.registry.reset()
+
+
+def test_retries_after_rate_limit():
+    model = FlakyLLM(failures=2)
+    response = asyncio.run(llm.acomplete_with_retry(model, "hello", base_delay=0.001))
+    assert response == "response to hello"
+    assert model.calls == 3
+    assert metrics.registry.to_dict()["llm_rate_limited_total"]["value"] == 2
+
+
+def test_gives_up_after_max_retries():
+    model = FlakyLLM(failures=10)
+    with pytest.raises(RateLimited):
+        asyncio.run(llm.acomplete_with_retry(model, "hello", max_retries=2, base_delay=0.001))
+    assert model.calls == 3
+
+
+def test_other_errors_are_not_retried():
+    class Broken:
+        calls = 0
+
+        async def acomplete(self, prompt):
+            self.calls += 1
+            raise ValueError("bad prompt")
+
+    model = Broken()
+    with pytest.raises(ValueError):
+        asyncio.run(llm.acomplete_with_retry(model, "hello", base_delay=0.001))
+    assert model.calls == 1
+
+
+def test_limiter_is_acquired_for_every_attempt():
+    model = FlakyLLM(failures=1)
+    limiter = CountingLimiter()
+    results = asyncio.run(llm.complete_all(model, [("a", "hello", None)], limiter=limiter))
+    assert results == {"a": "response to hello"}
+    assert limiter.acquired == [0, 0]
+
+
+def test_shared_semaphore_limits_concurrent_calls():
+    class SlowLLM:
+        running = 0
+        most = 0
+
+        async def acomplete(self, prompt):
+            self.running += 1
+            self.most = max(self.most, self.running)
+            await asyncio.sleep(0.01)
+            self.running -= 1
+            return prompt
+
+    async def two_pages(model):
+        semaphore = asyncio.Semaphore(2)
+        finished = []
+        pages = [[(f"{page}-{i}", "hello", None) for i in range(4)] for page in range(2)]
+        await asyncio.gather(*(
+            llm.complete_all(model, prompts, on_result=lambda key, _: finished.append(key), semaphore=semaphore)
+            for prompts in pages
+        ))
+        return finished
+
+    model = SlowLLM()
+    finished = asyncio.run(two_pages(model))
+    assert model.most == 2
+    assert sorted(finished) == ["0-0", "0-1", "0-2", "0-3", "1-0", "1-1", "1-2", "1-3"]
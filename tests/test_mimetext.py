@@ -0,0 +1,79 @@
+import base64
+
+from mimetext import extract_payload_text, extract_text
+
+ALTERNATIVE_WITH_ATTACHMENT = b"""\
+From: JetBlue <reservations@jetblue.com>\r
+Subject: Your itinerary\r
+Content-Type: multipart/mixed; boundary="outer"\r
+\r
+--outer\r
+Content-Type: multipart/alternative; boundary="inner"\r
+\r
+--inner\r
+Content-Type: text/plain; charset=utf-8\r
+\r
+Flight 123 from JFK to SFO\r
+--inner\r
+Content-Type: text/html; charset=utf-8\r
+\r
+<p>Flight <b>123</b> from JFK to SFO</p>\r
+--inner--\r
+--outer\r
+Content-Type: application/pdf; name="itinerary.pdf"\r
+Content-Disposition: attachment; filename="itinerary.pdf"\r
+Content-Transfer-Encoding: base64\r
+\r
+JVBERi0xLjQKJcfsj6IKNSAwIG9iago8PC9MZW5ndGggNiAwIFI+PgpzdHJlYW0K\r
+--outer--\r
+"""
+
+
+def test_only_the_plain_alternative_is_read_and_attachments_are_skipped():
+    assert extract_text(ALTERNATIVE_WITH_ATTACHMENT) == "Flight 123 from JFK to SFO"
+
+
+def test_quoted_printable_in_a_non_utf8_charset():
+    raw = (
+        b"Content-Type: text/plain; charset=iso-8859-1\r\n"
+        b"Content-Transfer-Encoding: quoted-printable\r\n"
+        b"\r\n"
+        b"Vol de Z=FCrich =E0 Montr=E9al, r=E9servation ABC=\r\n"
+        b"123\r\n"
+    )
+
+    assert extract_text(raw) == "Vol de Zürich à Montréal, réservation ABC123\r\n"
+
+
+def test_text_parts_sent_as_attachments_are_skipped():
+    raw = (
+        b'Content-Type: multipart/mixed; boundary="b"\r\n'
+        b"\r\n"
+        b"--b\r\n"
+        b"Content-Type: text/plain\r\n"
+        b"\r\n"
+        b"Your trip to SFO\r\n"
+        b"--b\r\n"
+        b"Content-Type: text/plain\r\n"
+        b'Content-Disposition: attachment; filename="terms.txt"\r\n'
+        b"\r\n"
+        b"Terms and conditions\r\n"
+        b"--b--\r\n"
+    )
+
+    assert extract_text(raw) == "Your trip to SFO"
+
+
+def test_payload_text_parts_sent_as_attachments_are_skipped():
+    def part(text, **extra):
+        return dict(mimeType="text/plain", body={"data": base64.urlsafe_b64encode(text).decode("ascii")}, **extra)
+
+    payload = {
+        "mimeType": "multipart/mixed",
+        "parts": [
+            part(b"Your trip to SFO"),
+            part(b"Terms and conditions", headers=[{"name": "Content-Disposition", "value": "attachment"}]),
+        ],
+    }
+
+    assert extract_payload_text(payload) == "Your trip to SFO"
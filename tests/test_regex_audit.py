@@ -0,0 +1,27 @@
+import re
+
+from regex_audit import audit, find_patterns
+
+SOURCE = '''import re
+def extract_itinerary_details(body):
+    a = re.search(r"from (.*)\\n(.*)\\n.*x", body, re.S)
+    b = re.findall(r"[A-Z]{3}", body, flags=re.I | re.M)
+    c = re.sub(r"\\s+", " ", body)
+    d = re.search(r"code", body, FLAGS)
+    return a, b, c, d
+'''
+
+
+def test_flags_are_read_from_the_call():
+    flags = [found["flags"] for found in find_patterns(SOURCE)]
+
+    assert flags == [re.S, re.I | re.M, 0, None]
+
+
+def test_dotall_patterns_are_fuzzed_with_dotall():
+    cache = {}
+    reports = audit(SOURCE, max_length=8000, run_timeout=1.0, cache=cache)
+
+    # with re.S every .* can run past the newlines, which makes it cubic
+    assert reports[0]["verdict"] == "super-linear"
+    assert ("from (.*)\\n(.*)\\n.*x", re.S) in cache
@@ -0,0 +1,59 @@
+from store import MessageStore
+
+
+def message(message_id, body="Confirmation code HXYZQP"):
+    return {"id": message_id, "threadId": f"thread-{message_id}", "snippet": body[:10], "date": 1700000000, "body": body}
+
+
+def test_lookups_only_return_text_from_the_same_extractor(tmp_path):
+    store = MessageStore(str(tmp_path / "messages.db"))
+    store.put_many([message("a")], "payload-1")
+    store.put_many([message("b")], "bs4-1")
+
+    assert list(store.get_many(["a", "b"], "payload-1")) == ["a"]
+    assert sorted(store.get_many(["a", "b"])) == ["a", "b"]
+    assert [m["id"] for m in store.iter_messages(extractor="bs4-1")] == ["b"]
+    store.close()
+
+
+def test_skipped_messages_are_remembered_without_a_body(tmp_path):
+    store = MessageStore(str(tmp_path / "messages.db"))
+    store.put_many([message("a"), {"id": "b", "threadId": "thread-b", "skipped": "empty"}], "payload-1")
+
+    found = store.get_many(["a", "b"], "payload-1")
+    assert found["a"]["body"] == "Confirmation code HXYZQP"
+    assert found["b"]["skipped"] == "empty"
+    assert "body" not in found["b"]
+    assert [m["id"] for m in store.iter_messages()] == ["a"]
+    store.close()
+
+
+def test_each_extractor_keeps_its_own_copy(tmp_path):
+    store = MessageStore(str(tmp_path / "messages.db"))
+    store.put_many([message("a", "Confirmation code HXYZQP")], "payload-1")
+    store.put_many([message("a", "<p>Confirmation code HXYZQP</p>")], "bs4-1")
+
+    assert store.get_many(["a"], "payload-1")["a"]["body"] == "Confirmation code HXYZQP"
+    assert store.get_many(["a"], "bs4-1")["a"]["body"] == "<p>Confirmation code HXYZQP</p>"
+    assert len(store) == 2
+    store.close()
+
+
+def test_stores_keyed_by_id_alone_are_rekeyed(tmp_path):
+    import sqlite3
+
+    path = str(tmp_path / "messages.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE messages (id TEXT PRIMARY KEY, thread_id TEXT, snippet TEXT,"
+        " body BLOB, size INTEGER, last_access REAL, date INTEGER, extractor TEXT, skipped TEXT)"
+    )
+    conn.commit()
+    conn.close()
+    store = MessageStore(path)
+    store.put_many([message("a")], "payload-1")
+    store.put_many([message("a")], "bs4-1")
+
+    assert list(store.get_many(["a"], "payload-1")) == ["a"]
+    assert list(store.get_many(["a"], "bs4-1")) == ["a"]
+    store.close()
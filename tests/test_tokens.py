@@ -0,0 +1,50 @@
+import random
+
+import pytest
+import tiktoken
+
+import tokens
+
+# the same pre-tokenizer as cl100k_base
+PATTERN = r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+
+WORDS = [" flight", " from", " to", "Flight", "café", " Zürich", "東京", " ✈️", "<td>", "</td>", "123", "\n\n"]
+
+
+def small_encoding():
+    # the real encodings are downloaded on first use, so build a little
+    # byte-level BPE that needs nothing from the network. every merge is
+    # made of two tokens that already exist, like a trained vocabulary.
+    ranks = {bytes([byte]): byte for byte in range(256)}
+    for word in WORDS:
+        word = word.encode("utf-8")
+        for end in range(2, len(word) + 1):
+            ranks.setdefault(word[:end], len(ranks))
+    return tiktoken.Encoding("small", pat_str=PATTERN, mergeable_ranks=ranks, special_tokens={})
+
+
+@pytest.fixture(autouse=True)
+def encoding(monkeypatch):
+    encoding = small_encoding()
+    monkeypatch.setattr(tokens, "get_encoding", lambda model: encoding)
+    return encoding
+
+
+def test_short_text_is_left_alone():
+    text = "Flight 123 from SEA to SFO"
+
+    assert tokens.truncate_tokens(text, 100, "gpt-3.5-turbo") == (text, tokens.count_tokens(text, "gpt-3.5-turbo"))
+
+
+def test_truncated_text_never_goes_over_the_budget():
+    pieces = WORDS + ["京", "é", "→", " ", "a", "Z", "9", "<", "\r\n"]
+    rng = random.Random(0)
+    for _ in range(2000):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(1, 80)))
+        max_tokens = rng.randint(1, 40)
+
+        truncated, count = tokens.truncate_tokens(text, max_tokens, "gpt-3.5-turbo")
+
+        assert count == tokens.count_tokens(truncated, "gpt-3.5-turbo")
+        assert count <= max_tokens
+        assert text.startswith(truncated)
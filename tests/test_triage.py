@@ -0,0 +1,27 @@
+from triage import HitHistory
+
+
+def history_with_hits(tmp_path, count=25):
+    history = HitHistory(str(tmp_path / "hit_history.json"))
+    for i in range(count):
+        history.record({"from": "Alaska <info@ifly.alaskaair.com>", "sizeEstimate": 10000 + i}, True)
+    return history
+
+
+def test_query_is_left_alone_until_there_are_enough_hits(tmp_path):
+    assert history_with_hits(tmp_path, count=3).query("your flight itinerary") == "your flight itinerary"
+
+
+def test_query_is_narrowed_without_guessing_about_attachments(tmp_path):
+    query = history_with_hits(tmp_path).query("your flight itinerary")
+    assert query == "your flight itinerary larger:5000 smaller:20048 from:(alaskaair.com)"
+
+
+def test_every_few_runs_search_everything(tmp_path):
+    history = history_with_hits(tmp_path)
+    queries = [history.query("q", explore_every=3) for _ in range(2)]
+    history.save()
+
+    history = HitHistory(history.path)
+    queries.append(history.query("q", explore_every=3))
+    assert [query == "q" for query in queries] == [False, False, True]
@@ -0,0 +1,74 @@
+# fits prompts into the model's context window.
+# the email body is tokenized once and cut at the exact token boundary,
+# and the instructions (including any code) are never trimmed
+
+import functools
+
+import tiktoken
+
+import metrics
+
+# no real text averages anywhere near this many characters per token, so
+# anything past max_tokens * this many characters can be dropped before
+# tokenizing without changing the result
+MAX_CHARS_PER_TOKEN = 16
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Get the tiktoken encoding for a model, loading it only once."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # not an OpenAI model, count as if it was one
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def fit_prompt(instructions: str, body: str, max_tokens: int, model: str):
+    """Append as much of `body` to `instructions` as fits in `max_tokens`.
+
+    Returns:
+        (prompt, number of tokens in the prompt)
+    """
+    enc = get_encoding(model)
+    instruction_tokens = len(enc.encode(instructions, disallowed_special=()))
+    budget = max_tokens - instruction_tokens
+    if budget <= 0:
+        print("Instructions alone don't fit, leaving out the email body")
+        return instructions, instruction_tokens
+
+    body, body_tokens = truncate_tokens(body, budget, model)
+    return instructions + body, instruction_tokens + body_tokens
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str):
+    """Cut `text` down to at most `max_tokens` tokens.
+
+    Returns:
+        (text, number of tokens in it)
+    """
+    enc = get_encoding(model)
+    with metrics.timer("truncate_seconds"):
+        text = text[:max_tokens * MAX_CHARS_PER_TOKEN]
+        tokens = enc.encode(text, disallowed_special=())
+        if len(tokens) > max_tokens:
+            print(f"Message too long ({len(tokens)} tokens), truncating it to {max_tokens}")
+            metrics.inc("truncated_messages_total")
+            tokens = tokens[:max_tokens]
+            while True:
+                # a cut in the middle of a character would come back as a
+                # replacement character, which can take more tokens than
+                # the bytes it replaces, so leave the partial one out.
+                # re-encoding can also split the last word differently, so
+                # drop tokens until the text really fits
+                text = enc.decode_bytes(tokens).decode("utf-8", errors="ignore")
+                encoded = enc.encode(text, disallowed_special=())
+                if len(encoded) <= max_tokens:
+                    break
+                tokens = tokens[:-1]
+            tokens = encoded
+    return text, len(tokens)
@@ -0,0 +1,206 @@
+# decides which messages are worth downloading from what gmail says about
+# them with format="metadata" (who sent it, the subject, and its size),
+# which costs a few hundred bytes instead of the whole message. see
+# GmailSearcher.two_phase.
+#
+# HitHistory remembers the sender and size of every message that turned
+# out to be an itinerary or not, which makes triage sharper and can
+# narrow the gmail search itself:
+#   your flight itinerary larger:8000 smaller:400000 from:(alaskaair.com OR united.com)
+# so gmail doesn't even list most of the marketing. a narrowed search
+# can't find itineraries unlike the ones before, so it's opt-in, and
+# every few runs the whole search is done again to learn from.
+
+import json
+import os
+from email.utils import parseaddr
+
+from prefilter import TRAVEL_DOMAINS
+
+# bigger than any itinerary, even with a PDF attached
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+# hits needed before trusting what they have in common
+DEFAULT_MIN_HITS = 20
+# every this many narrowed searches, search for everything instead
+DEFAULT_EXPLORE_EVERY = 5
+# a sender with this many misses and no hits is skipped
+DEFAULT_MIN_MISSES = 5
+# how far outside the sizes of past hits a message can be
+SIZE_SLACK = 2
+# gmail queries have a length limit, and a longer allowlist wouldn't
+# narrow much anyway
+MAX_ALLOWLIST_DOMAINS = 40
+# hit sizes remembered
+_MAX_SIZES = 1000
+
+
+def sender_domain(sender):
+    """The domain an address like `Alaska Airlines <info@ifly.alaskaair.com>`
+    belongs to, e.g. alaskaair.com, or None."""
+    if not sender:
+        return None
+    address = parseaddr(sender)[1] or sender
+    if "@" not in address:
+        return None
+    labels = address.rsplit("@", 1)[1].strip(" >.").lower().split(".")
+    # keep three labels for domains like ba.co.uk
+    keep = 3 if len(labels) > 2 and len(labels[-1]) == 2 and len(labels[-2]) <= 3 else 2
+    return ".".join(labels[-keep:]) or None
+
+
+def _is_travel_domain(domain, travel_domains):
+    return any(domain == d or domain.endswith("." + d) for d in travel_domains)
+
+
+class HitHistory:
+    """Senders and sizes of the messages that were, or weren't, itineraries.
+
+    Kept in a JSON file, so each run learns from the ones before it.
+    """
+
+    def __init__(self, path: str = "hit_history.json"):
+        self.path = path
+        # domain -> [hits, misses]
+        self.domains = {}
+        self.hit_sizes = []
+        self.hits = 0
+        self.attachment_hits = 0
+        # how many times query() has been asked for a search
+        self.queries = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.domains = data.get("domains", {})
+            self.hit_sizes = data.get("hit_sizes", [])
+            self.hits = data.get("hits", 0)
+            self.attachment_hits = data.get("attachment_hits", 0)
+            self.queries = data.get("queries", 0)
+
+    def record(self, info, was_itinerary: bool):
+        """Remember whether a message was an itinerary.
+
+        Args:
+            info: the message's extra_info from GmailSearcher, which has
+                "from", "sizeEstimate" and "hasAttachment" when the message
+                was fetched in two phases. Messages read from the store
+                don't, and are only counted by sender if they have one.
+        """
+        domain = sender_domain(info.get("from"))
+        if domain:
+            counts = self.domains.setdefault(domain, [0, 0])
+            counts[0 if was_itinerary else 1] += 1
+        if was_itinerary and info.get("sizeEstimate"):
+            self.hits += 1
+            self.hit_sizes = (self.hit_sizes + [info["sizeEstimate"]])[-_MAX_SIZES:]
+            if info.get("hasAttachment"):
+                self.attachment_hits += 1
+
+    def hits_from(self, domain):
+        return self.domains.get(domain, [0, 0])[0]
+
+    def misses_from(self, domain):
+        return self.domains.get(domain, [0, 0])[1]
+
+    def size_bounds(self, min_hits: int = DEFAULT_MIN_HITS):
+        """(smallest, biggest) size worth downloading, or None until there are enough hits."""
+        if self.hits < min_hits or not self.hit_sizes:
+            return None
+        return min(self.hit_sizes) // SIZE_SLACK, max(self.hit_sizes) * SIZE_SLACK
+
+    def query(self, base_query: str, min_hits: int = DEFAULT_MIN_HITS, allowlist: bool = True, explore_every: int = DEFAULT_EXPLORE_EVERY) -> str:
+        """Narrow a gmail search to messages like the past hits.
+
+        Nothing is added until there have been `min_hits` hits. The
+        allowlist leaves out itineraries from senders that have never
+        sent one before, and the size limits ones much bigger or smaller
+        than any before, so every `explore_every`th call (counted across
+        runs, once saved) returns `base_query` as it is, to find and learn
+        from those too. 0 always narrows.
+        """
+        self.queries += 1
+        if explore_every and self.queries % explore_every == 0:
+            return base_query
+        bounds = self.size_bounds(min_hits)
+        if bounds is None:
+            return base_query
+        parts = [base_query, f"larger:{bounds[0]} smaller:{bounds[1]}"]
+        domains = sorted(domain for domain, (hits, _) in self.domains.items() if hits)
+        if allowlist and 0 < len(domains) <= MAX_ALLOWLIST_DOMAINS:
+            parts.append(f"from:({' OR '.join(domains)})")
+        return " ".join(parts)
+
+    def save(self):
+        data = {
+            "domains": self.domains,
+            "hit_sizes": self.hit_sizes,
+            "hits": self.hits,
+            "attachment_hits": self.attachment_hits,
+            "queries": self.queries,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+class MetadataTriage:
+    """Decides from a message's metadata whether to download the rest of it.
+
+    Messages from travel domains, or from senders that have sent
+    itineraries before, are always kept. Others are skipped if they're
+    huge, a very different size to every past hit, or from a sender that
+    has only ever sent non-itineraries.
+
+    Args:
+        history: a HitHistory to learn from, or None.
+        travel_domains: sender domains that are always kept.
+        max_bytes: messages bigger than this are skipped.
+    """
+
+    def __init__(self, history: HitHistory = None, travel_domains=TRAVEL_DOMAINS, max_bytes: int = DEFAULT_MAX_BYTES, min_misses: int = DEFAULT_MIN_MISSES):
+        self.history = history
+        self.travel_domains = tuple(travel_domains)
+        self.max_bytes = max_bytes
+        self.min_misses = min_misses
+        self.kept = 0
+        self.skipped = 0
+
+    def keep(self, info):
+        """Whether to download a message.
+
+        Args:
+            info: dict with the message's "from", "subject" and
+                "sizeEstimate".
+
+        Returns:
+            (keep, reason)
+        """
+        keep, reason = self._decide(info)
+        if keep:
+            self.kept += 1
+        else:
+            self.skipped += 1
+        return keep, reason
+
+    def _decide(self, info):
+        domain = sender_domain(info.get("from"))
+        size = info.get("sizeEstimate") or 0
+        if domain and _is_travel_domain(domain, self.travel_domains):
+            return True, f"from {domain}"
+        if self.history is not None and domain and self.history.hits_from(domain):
+            return True, f"{domain} has sent itineraries before"
+        if size > self.max_bytes:
+            return False, f"{size} bytes"
+        if self.history is not None:
+            bounds = self.history.size_bounds()
+            if bounds and not bounds[0] <= size <= bounds[1]:
+                return False, f"{size} bytes, itineraries have been {bounds[0]}-{bounds[1]}"
+            misses = self.history.misses_from(domain) if domain else 0
+            if misses >= self.min_misses:
+                return False, f"none of {misses} emails from {domain} were itineraries"
+        return True, ""
+
+    def report(self):
+        total = self.kept + self.skipped
+        if total:
+            print(f"Triage skipped downloading {self.skipped} of {total} emails ({100 * self.skipped / total:.0f}%)")